@@ -1,4 +1,4 @@
-__all__ = ['Analysis']
+__all__ = ['Analysis', 'Storage']
 
 import logging
 # see the advice on logging and libraries in
@@ -27,3 +27,4 @@ def stop_logging():
     core.log.clear_handlers(logger)  # this _should_ do the job...
 
 from analysis import Analysis
+from datastore import Storage
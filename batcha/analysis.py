@@ -3,114 +3,531 @@ from MDAnalysis import collection, SelectionError
 
 import tables
 import numpy
+import json
+import time
 import os
 
 from batcha.utils import split_path
-from batcha.datastore import Table, Array
+from batcha.datastore import Table, Array, RaggedArray, read_column
+from batcha.parallel import run_parallel
+from batcha.timeseries import frame_timeseries
+from batcha.cache import FrameCache
+from batcha.frames import select_frames, regular_step, iter_frames, frame_times, start_time
+from batcha.instrument import RunProfile, peak_memory, bytes_read
+from batcha.datastore import _require_group
+from batcha.results import open_results
+from batcha.fingerprint import processor_description, fingerprint, topology_hash, trajectory_identity
 
 class Analysis():
-    def __init__(self, filename, title="datastore", readonly=True):
+    # table with the index and time of every processed frame
+    FRAMES_PATH = '/frames'
+    
+    def __init__(self, filename, title="datastore", readonly=True, sink=None, storage=None):
+        """ Open the datastore at filename. With filename=None nothing is stored
+        locally and the results are passed to sink(blocks) instead, a list of
+        picklable blocks (see Table.drain_block) on every flush and on save().
+        
+        storage (a datastore.Storage) sets the chunking and compression of the
+        nodes created by this Analysis, unless a node gets its own storage.
+        By default new nodes are created like before storage options existed.
+        """
         self._filename = filename
         self._title = title
         self._readonly = readonly
+        self.sink = sink
+        self._storage = storage
+        if filename is None and sink is None:
+            raise Exception('An Analysis without a file needs a sink for its results')
         self._h5f = self.open_or_create()
         self.reset()
 
+    @staticmethod
+    def open_results(filename, **kwargs):
+        """ Open the results stored in filename for lazy reading without setting
+        up an Analysis, see batcha.results.open_results for the arguments.
+        """
+        return open_results(filename, **kwargs)
+
     def reset(self):
         # nodes holds all Table and Array objects which take care of table creation and writing
         self._nodes = {}
         # the following dicts store the actual analyses which are processed
         self._sequential = {}
         self._timeseries = {}
+        self._processors = []
+        # class and constructor arguments of the processors by path
+        self._descriptions = {}
+        self._frames_index = None
+        self._frames_time = None
 
-    def get_or_create_array(self, path):
+    def get_or_create_array(self, path, ragged=False, storage=None):
         if path not in self._nodes:
-            self._nodes[path] = Array(self._h5f, path)
+            if ragged:
+                self._nodes[path] = RaggedArray(self._h5f, path, storage or self._storage)
+            else:
+                self._nodes[path] = Array(self._h5f, path, storage=storage or self._storage)
+        elif storage is not None:
+            # only an explicit storage replaces the one of an existing node
+            self._nodes[path].storage = storage
         return self._nodes[path]
             
-    def get_or_create_column(self, path, format):
+    def get_or_create_column(self, path, format, storage=None):
+        """ Returns the column at path, the storage options apply to its whole table """
         (table_path, col_name) = split_path(path)
         if table_path not in self._nodes:
-            self._nodes[table_path] = Table(self._h5f, table_path)
+            self._nodes[table_path] = Table(self._h5f, table_path, storage or self._storage)
+        elif storage is not None:
+            # only an explicit storage replaces the one of an existing table
+            self._nodes[table_path].storage = storage
         return self._nodes[table_path].column(col_name, format)
     
     #analysis.add_metadata('/metadata/trajectory', { 'psf': psf_file, 'pdb': pdb_file, 'dcd': dcd_file, 'frames': num_frames, 'firsttimestep': first_timestep, 'dt': dt })
-    def add_metadata(self, path, data, format=tables.StringCol(64)):
+    def add_metadata(self, path, data, format=tables.StringCol(64), storage=None):
         #path is to the table
         #data has the columns
         
         print "Loading metadata..."
         for k, v in data.items():
             col_path = '%s/%s' % (path, k)
-            col = self.get_or_create_column(col_path, format)
+            col = self.get_or_create_column(col_path, format, storage)
             col.load(str(v))
         print "Done."
     
     #analysis.add_timeseries('/protein/dihedrals/PEPA_139', Timeseries.Dihedral(trj.selectAtoms("atom PEPA 139 N", "atom PEPA 139 CA", "atom PEPA 139 CB", "atom PEPA 139 CG")))
-    def add_timeseries(self, path, timeseries, format=tables.Float32Col()):
+    def add_timeseries(self, path, timeseries, format=tables.Float32Col(), storage=None):
         if path in self._timeseries:
             raise Exception('Timeseries with path %s already exists in this analysis!' % path)
         else:
-            col = self.get_or_create_column(path, format)
+            col = self.get_or_create_column(path, format, storage)
             self._timeseries[path] = (timeseries, col)
+            self._descriptions[path] = processor_description(timeseries)
    
     #analysis.add_to_sequence('/protein/rmsd/backbone', RMSD(ref, trj, selection='backbone')) 
-    def add_to_sequence(self, path, processor, format=tables.Float32Col(), array=False):
+    #analysis.add_to_sequence('/channel/cylinder', CylinderSearch(...), array='ragged')
+    def add_to_sequence(self, path, processor, format=tables.Float32Col(), array=False, storage=None):
+        """ Add a sequential processor. Its per-frame results are stored in a table column,
+        in a VLArray of pickled objects (array=True) or in a typed ragged array (array='ragged').
+        storage overrides the storage options of the Analysis for the node.
+        """
         if path in self._sequential:
             raise Exception('Sequential processor with path %s already exists in this analysis!' % path)
         else:
             if array:
-                node = self.get_or_create_array(path)
+                node = self.get_or_create_array(path, ragged=(array == 'ragged'), storage=storage)
             else:
-                node = self.get_or_create_column(path, format)
+                node = self.get_or_create_column(path, format, storage)
             self._sequential[path] = (processor, node)
+            self._descriptions[path] = processor_description(processor)
     
-    def run(self, trj, ref):
+    def run(self, trj, ref, n_workers=1, universe_kwargs=None, flush_every=None, resume=False, start=None, stop=None, step=None, frames=None, report_path=None, incremental=False, reuse=False):
+        """ Run all timeseries and sequential analyses over the trajectory.
+        
+        The trajectory is read in a single pass: the timeseries which can be
+        computed frame by frame (see batcha.timeseries) run in the same loop
+        as the sequential processors, before them. Only unsupported timeseries
+        types still need the separate pass of the MDAnalysis collection.
+        Returns a dict with the frames decoded, the estimated bytes read,
+        the number of passes over the trajectory and the hit rate of the
+        frame cache shared by the processors (also kept as self.stats).
+
+        With n_workers > 1 the frame processors are run over contiguous
+        frame blocks in a multiprocessing pool. Every worker opens its own
+        Universe objects from the files of trj and ref (universe_kwargs are
+        passed to the Universe constructor) and the results are merged back
+        in frame order.
+        
+        With flush_every=N (serial runs only) the new results of every
+        processor are drained into their nodes and appended to the HDF5
+        file every N frames, so memory stays bounded and partial results
+        survive a crash. save() writes whatever is left.
+        
+        Every flush records a checkpoint (frames committed and the state of
+        the processors) on the nodes. With resume=True every node continues
+        from the last checkpoint found in the file instead of frame 0: its
+        processors skip the frames it already holds. Processors which carry
+        state across frames should implement get_state() and set_state(state).
+        
+        incremental=True is resume for trajectories which grew since the last
+        run: nodes without a checkpoint continue after the rows they already
+        hold, so only the new frames are read and appended (new paths, or
+        tables which miss a registered column, start from frame 0).
+        
+        save() records a fingerprint of every path on its node (see
+        batcha.fingerprint): the topology and trajectory files, the frame
+        selection and the processor class and arguments. With reuse=True the
+        nodes which hold all selected frames with matching fingerprints are
+        not computed again. The other nodes are computed from frame 0 (or
+        continue from their stored frames with resume or incremental).
+        
+        start, stop and step select a range of frames like a slice, frames
+        is an explicit list of 0-based frame indices. The trajectory seeks to
+        the selected frames and their indices and times are stored in the
+        FRAMES_PATH table. The timeseries collection only supports evenly
+        spaced frames. Checkpoints count processed frames of the selection,
+        so a run must be resumed with the same selection.
+        
+        The returned stats include a 'profile' report: the time spent
+        decoding frames, the total and per-frame time of every processor,
+        the write time and the peak memory. save() adds its own time and the
+        bytes written per node. With report_path the report is also appended
+        as JSON to a string array at that path in the file.
+        """
+        resume = resume or incremental
+        if (flush_every or resume) and n_workers > 1:
+            raise Exception('Streaming (flush_every), resume and incremental runs are not supported with n_workers > 1')
+        if (resume or reuse) and self._h5f is None:
+            raise Exception('Resume and reuse need a datastore file')
         self._trj = trj
         self._ref = ref
+        trajectory = self._trj.trajectory
+        self._indices = select_frames(trajectory.numframes, start, stop, step, frames)
+        num_frames = len(self._indices)
+        self.stats = { 'frames_decoded': 0, 'bytes_read': 0, 'trajectory_passes': 0 }
+        self._profile = RunProfile()
+        self._report_path = report_path
+        
+        # timeseries computed frame by frame come first so they see the raw coordinates
+        self._processors = []
+        collection_timeseries = []
+        for path, tpl in self._timeseries.items():
+            p = frame_timeseries(tpl[0])
+            if p is None:
+                collection_timeseries.append(path)
+            else:
+                self._processors.append((path, p, tpl[1]))
+        for path, tpl in self._sequential.items():
+            self._processors.append((path, tpl[0], tpl[1]))
+        # selections, centers of mass and coordinates shared by the processors
+        self._cache = FrameCache()
+        for path, p, node in self._processors:
+            if hasattr(p, 'frame_cache'):
+                p.frame_cache = self._cache
+        
+        if len(self._timeseries) + len(self._sequential) > 0:
+            self._frames_index = self.get_or_create_column('%s/index' % self.FRAMES_PATH, tables.Int32Col())
+            self._frames_time = self.get_or_create_column('%s/time' % self.FRAMES_PATH, tables.Float32Col())
         
-        if len(self._timeseries) > 0:
+        # new nodes are sized for the frames of this run
+        for n in self._frame_nodes():
+            n.expected_rows = num_frames
+        
+        self._fingerprints = self._compute_fingerprints() if self._h5f is not None else {}
+        # stored frame times are offset by the time of the first frame (the processors rewind anyway)
+        self._start_time = start_time(trajectory)
+        
+        # start is a position in the frame selection from here on, every node
+        # continues from its own start (the frames it already holds)
+        states = {}
+        self._node_starts = {}
+        if resume:
+            states = self._resume(incremental)
+        if reuse:
+            skipped = self._reuse(num_frames, resume)
+            collection_timeseries = [ path for path in collection_timeseries if path not in skipped ]
+            self._processors = [ (path, p, node) for path, p, node in self._processors if path not in skipped ]
+        start = min([ self._node_start(n) for n in self._frame_nodes() ] or [0])
+        if resume:
+            print "Resuming analysis after %d frames" % start
+        self._frames_loaded = self._node_start(self._nodes.get(self.FRAMES_PATH))
+        
+        # the collection computes all its timeseries from the earliest start
+        collection_start = min([ self._node_start(self._node_for(path)) for path in collection_timeseries ] or [num_frames])
+        if len(collection_timeseries) > 0 and collection_start == num_frames:
+            print "No new frames for the timeseries collection, skipping it"
+            collection_timeseries = []
+        
+        if len(collection_timeseries) > 0:
             print "Starting timeseries analysis..."
             collection.clear()
-            for path, tpl in self._timeseries.items():
+            for path in collection_timeseries:
                 print " Adding timeseries: %s" % path
-                collection.addTimeseries(tpl[0])
+                collection.addTimeseries(self._timeseries[path][0])
             
             print " Computing..."
-            collection.compute(self._trj.trajectory)
+            t = time.time()
+            read = bytes_read()
+            remaining = self._indices[collection_start:]
+            skip = regular_step(remaining)
+            if skip is None:
+                raise Exception('The timeseries collection (%s) only supports evenly spaced frames' % ', '.join(collection_timeseries))
+            if remaining[-1] == trajectory.numframes - 1 and skip == 1:
+                collection.compute(trajectory, start=int(remaining[0]))
+            else:
+                # the stop frame of the collection is inclusive
+                collection.compute(trajectory, start=int(remaining[0]), stop=int(remaining[-1]), skip=skip)
+            self._count_pass(len(remaining), bytes_read() - read if read is not None else None)
+            self.stats['collection_time'] = time.time() - t
             print " Done computing."
         
             print "Loading data..."
-            for i, path in enumerate(self._timeseries.keys()):
-                print " loading table %s with %d values..." % (path, len(collection[i][0]))
-                self._timeseries[path][1].load(list(collection[i][0]))
+            for i, path in enumerate(collection_timeseries):
+                values = list(collection[i][0])[:len(remaining)]
+                if len(values) != len(remaining):
+                    print "WARNING: timeseries %s has %d values for %d frames" % (path, len(values), len(remaining))
+                print " loading table %s with %d values..." % (path, len(values))
+                col = self._timeseries[path][1]
+                col.discard(self._node_start(self._node_for(path)) - collection_start)
+                col.load(values)
             print "Done timeseries analysis."
         
-        if len(self._sequential) > 0:
-            print "Running sequential analyses..."
-            for path, tpl in self._sequential.items():
+        if len(self._processors) > 0 and n_workers > 1:
+            print "Running frame analyses with %d workers..." % n_workers
+            read = self._profile.bytes_read
+            results = run_parallel([ (path, p) for path, p, node in self._processors ], self._trj, self._ref, n_workers, universe_kwargs, self._indices, self._profile, self._cache)
+            self._count_pass(num_frames, self._profile.bytes_read - read if self._profile.bytes_read is not None else None)
+            print " Loading result data..."
+            for (path, p, node), r in zip(self._processors, results):
+                self._declare(node, p)
+                node.load(r)
+            print "Done frame analysis."
+        elif len(self._processors) > 0:
+            print "Running frame analyses..."
+            for path, p, node in self._processors:
                 print " Preparing %s" % path
-                tpl[0].prepare(ref=self._ref, trj=self._trj)
-            frames = self._trj.trajectory
-            print " Processing %d frames..." % frames.numframes
-            for i, f in enumerate(frames):
-                if i % len(frames)/10 == 0:
+                p.prepare(ref=self._ref, trj=self._trj)
+                self._declare(node, p)
+                if path in states and hasattr(p, 'set_state'):
+                    p.set_state(states[path])
+            print " Processing %d frames..." % (num_frames - start)
+            self._drained = dict([ (path, 0) for path, p, node in self._processors ])
+            # processors skip the frames their node already holds
+            starts = [ (path, p, self._node_start(self._node_for(path))) for path, p, node in self._processors ]
+            # seek to the selected frames (and past a checkpoint) instead of decoding skipped frames
+            remaining = self._indices[start:]
+            read = self._profile.bytes_read
+            for i, (index, f) in enumerate(self._profile.timed_frames(iter_frames(trajectory, remaining))):
+                i += start
+                if i % max(num_frames/10, 1) == 0:
                     print ".",
-                for path, tpl in self._sequential.items():
-                    tpl[0].process(f)
+                self._cache.advance(index)
+                for path, p, s in starts:
+                    if i >= s:
+                        self._profile.process(path, p, f)
+                if flush_every and (i+1) % flush_every == 0:
+                    self.flush_sequential(i+1)
+            self._count_pass(len(remaining), self._profile.bytes_read - read if read is not None else None)
             print " done."
             print " Loading result data..."
-            for path, tpl in self._sequential.items():
-                tpl[1].load(tpl[0].results())
-            print "Done sequential analysis."
+            for path, p, node in self._processors:
+                node.load(self._drain(path, p))
+            print "Done frame analysis."
+        self._load_frames(num_frames)
+        self._frames_done = num_frames
+        self.stats.update(self._cache.stats())
+        print "Cache hit rate: %.1f%% (%d hits, %d misses)" % (100*self.stats['cache_hit_rate'], self.stats['cache_hits'], self.stats['cache_misses'])
+        print "Decoded %(frames_decoded)d frames (%(bytes_read)d bytes read) in %(trajectory_passes)d trajectory pass(es)." % self.stats
+        if self.stats.get('bytes_read_estimated'):
+            print " The bytes read could not be measured, they are estimated from the trajectory size."
+        self.stats['profile'] = self._profile.report()
+        self._print_profile(self.stats['profile'])
+        return self.stats
+    
+    def _print_profile(self, report):
+        print "Read %(frames)d frames in %(read_time).2f s, processing %(process_time).2f s, writing %(write_time).2f s, peak memory %(peak_memory_kb)d kB" % report
+        for path, t in sorted(report['processors'].items(), key=lambda (path, t): -t['total_time']):
+            print " %-40s %8.2f s %10.2f ms/frame" % (path, t['total_time'], 1000*t['time_per_frame'])
+    
+    def _count_pass(self, num_frames, read=None):
+        """ Account for a pass over num_frames frames of the trajectory which read
+        read bytes in self.stats. If the bytes read could not be measured they are
+        estimated from the size of the trajectory and bytes_read_estimated is set.
+        """
+        if read is None:
+            trajectory = self._trj.trajectory
+            read = int(num_frames*os.path.getsize(trajectory.filename)/float(trajectory.numframes))
+            self.stats['bytes_read_estimated'] = True
+        self.stats['frames_decoded'] += num_frames
+        self.stats['bytes_read'] += read
+        self.stats['trajectory_passes'] += 1
+    
+    def _load_frames(self, frames):
+        """ Load the index and time of the selected frames up to position frames into the FRAMES_PATH table """
+        if self._frames_index is None or frames <= self._frames_loaded:
+            return
+        indices = self._indices[self._frames_loaded:frames]
+        self._frames_index.load(list(indices))
+        self._frames_time.load(list(frame_times(self._trj.trajectory, indices, self._start_time)))
+        self._frames_loaded = frames
+    
+    def _check_frames(self, start):
+        """ Make sure the stored frames are the first start frames of the selection """
+        try:
+            stored = read_column(self._h5f, self.FRAMES_PATH, 'index', 0, start)
+        except tables.NoSuchNodeError:
+            return
+        if len(stored) > 0 and not numpy.array_equal(stored, self._indices[:len(stored)]):
+            raise Exception('Cannot resume: the frame selection differs from the frames stored in %s' % self.FRAMES_PATH)
+    
+    def _declare(self, node, processor):
+        """ Give node the labels and the table column format which a prepared processor declares """
+        if getattr(processor, 'labels', None) is not None:
+            node.set_labels(processor.labels)
+        if hasattr(processor, 'column_format') and not isinstance(node, (Array, RaggedArray)):
+            node.format = processor.column_format()
+    
+    def _drain(self, path, processor):
+        """ Returns the results of a frame processor which have not been loaded yet """
+        if hasattr(processor, 'drain'):
+            return processor.drain()
+        # processors without drain() keep all their results, only return the new ones
+        res = list(processor.results()[self._drained[path]:])
+        self._drained[path] += len(res)
+        return res
+    
+    def _node_for(self, path):
+        """ Returns the Table or Array node which stores the given sequential path """
+        if path in self._nodes:
+            return self._nodes[path]
+        return self._nodes[split_path(path)[0]]
+    
+    def _frame_nodes(self):
+        """ Returns the Table and Array nodes which store per-frame data """
+        nodes = {}
+        for path in self._timeseries.keys() + self._sequential.keys():
+            n = self._node_for(path)
+            nodes[id(n)] = n
+        if self.FRAMES_PATH in self._nodes:
+            n = self._nodes[self.FRAMES_PATH]
+            nodes[id(n)] = n
+        return nodes.values()
+    
+    def _processor_states(self, node):
+        """ Returns the states of the frame processors stored in node """
+        states = {}
+        for path, p, n in self._processors:
+            if self._node_for(path) is node and hasattr(p, 'get_state'):
+                states[path] = p.get_state()
+        return states
+    
+    def _node_start(self, node):
+        """ Returns the number of selected frames the node already holds """
+        return self._node_starts.get(id(node), 0)
+    
+    def _resume(self, incremental=False):
+        """ Prepare the nodes for continuing from the frames they hold.
         
+        Every node continues from its checkpoint (or, if incremental, from
+        the rows it holds when it has no checkpoint). Rows written after that
+        are removed. Returns the processor states stored with the checkpoints.
+        """
+        states = {}
+        for n in self._frame_nodes():
+            (frames, node_states) = n.checkpoint()
+            if incremental and frames == 0:
+                frames = n.stored_rows()
+            if isinstance(n, Table) and not n.has_columns():
+                # a registered column is missing, the whole table is computed again
+                frames = 0
+                node_states = {}
+            if frames > len(self._indices):
+                raise Exception('%s holds %d frames, more than the %d selected frames' % (getattr(n, 'full_path', None) or n.path, frames, len(self._indices)))
+            n.truncate(frames)
+            self._node_starts[id(n)] = frames
+            states.update(node_states)
+        if len(self._node_starts) > 0:
+            self._check_frames(max(self._node_starts.values()))
+        return states
+    
+    def _compute_fingerprints(self):
+        """ Returns the fingerprint of every per-frame path for this run """
+        # the processors are prepared on the current frame of the reference
+        run = (topology_hash(self._trj), trajectory_identity(self._trj), topology_hash(self._ref), trajectory_identity(self._ref), self._ref.trajectory.frame, self._indices)
+        descriptions = dict(self._descriptions)
+        if self._frames_index is not None:
+            for name in ('index', 'time'):
+                descriptions['%s/%s' % (self.FRAMES_PATH, name)] = ('frames', name)
+        return dict([ (path, fingerprint(run, d)) for path, d in descriptions.items() ])
+    
+    def _node_paths(self, node):
+        """ Returns the fingerprinted paths stored in node """
+        return [ path for path in self._fingerprints if self._node_for(path) is node ]
+    
+    def _reuse(self, num_frames, resume=False):
+        """ Skip the nodes which hold all selected frames with matching fingerprints.
+        
+        Returns the skipped paths. The other nodes are truncated to be computed
+        again, unless resuming.
+        """
+        skipped = []
+        for n in self._frame_nodes():
+            paths = self._node_paths(n)
+            stored = n.fingerprints()
+            if n.stored_rows() == num_frames and all([ stored.get(path) == self._fingerprints[path] for path in paths ]):
+                self._node_starts[id(n)] = num_frames
+                skipped += paths
+            elif not resume:
+                n.truncate(0)
+        if len(skipped) > 0:
+            print "Reusing the stored results of: %s" % ', '.join(sorted(skipped))
+        return skipped
+    
+    def flush_sequential(self, frames):
+        """ Drain the new sequential results into their nodes, append them to the file
+        and record a checkpoint at the given number of processed frames.
+        """
+        t = time.time()
+        for path, p, node in self._processors:
+            node.load(self._drain(path, p))
+        self._load_frames(frames)
+        if self.sink is not None:
+            self._send([ n.drain_block(partial=True) for n in self._frame_nodes() ])
+        else:
+            for n in self._frame_nodes():
+                if frames < self._node_start(n):
+                    # nothing new for this node yet
+                    continue
+                n.write(partial=True)
+                n.set_checkpoint(frames, self._processor_states(n))
+            self._h5f.flush()
+        self._profile.write_time += time.time() - t
+    
+    def _send(self, blocks):
+        blocks = [ b for b in blocks if b is not None ]
+        if len(blocks) > 0:
+            self.sink(blocks)
+    
     def save(self):
+        t = time.time()
+        if self.sink is not None:
+            print "Sending all tables and arrays to the sink..."
+            self._send([ n.drain_block() for n in self._nodes.values() ])
+            self._update_report(time.time() - t)
+            return
         print "Setting up and saving all tables and arrays..."
         for path, n in self._nodes.items():
             print " Node: %s" % path
             n.write()
+        if getattr(self, '_frames_done', None):
+            for n in self._frame_nodes():
+                n.set_checkpoint(self._frames_done, self._processor_states(n))
+                n.set_fingerprints(dict([ (path, self._fingerprints[path]) for path in self._node_paths(n) ]))
+        self._update_report(time.time() - t)
+        if getattr(self, '_report_path', None):
+            self.store_report(self.stats, self._report_path)
+    
+    def _update_report(self, save_time):
+        """ Add the save time and the bytes written per node to the profile of the last run """
+        report = getattr(self, 'stats', {}).get('profile')
+        if report is None:
+            return
+        report['save_time'] = save_time
+        report['bytes_written'] = dict([ (path, n.bytes_written) for path, n in self._nodes.items() ])
+        report['peak_memory_kb'] = peak_memory()
+        print "Saved in %.2f s, %d bytes written" % (save_time, sum(report['bytes_written'].values()))
+    
+    def store_report(self, report, path='/batcha/reports'):
+        """ Append a run report as a JSON string to the array at path """
+        try:
+            node = self._h5f.getNode(path)
+        except tables.NoSuchNodeError:
+            (group, name) = split_path(path)
+            node = self._h5f.createVLArray(_require_group(self._h5f, group), name, tables.VLStringAtom())
+        node.append(json.dumps(report, default=str))
+        node.flush()
         
     def close(self):
+        if self._h5f is None:
+            return
         print "Closing H5 file..."
         self._h5f.flush()
         self._h5f.close()
@@ -119,6 +536,8 @@ class Analysis():
         """ 
         Create the pytables data file at the given filename.
         """
+        if self._filename is None:
+            return None
         if not os.path.exists(self._filename):
             if self._readonly:
                 raise Exception('Read-only open requested on file (%s) that doesn\'t exist!' % self._filename)
@@ -0,0 +1,122 @@
+""" Batch runs of one analysis over many trajectories.
+
+Every (psf, dcd) input is analyzed in a worker of a multiprocessing pool by
+an Analysis without a file. Its result blocks are sent over a queue to a
+single writer process, which owns the HDF5 file and appends them below one
+group per trajectory. Only the writer touches the file, so there are no
+concurrent HDF5 writes.
+
+    def spec(analysis, trj, ref):
+        analysis.add_timeseries('/timeseries/com', Timeseries.CenterOfMass(trj.atoms))
+        analysis.add_to_sequence('/rmsd/backbone', RMSD('backbone'))
+
+    run_batch('replicas.h5', spec, [ (psf, dcd) for dcd in dcds ], n_workers=8)
+
+The spec is called with the Analysis and the Universes of every input, it
+has to be picklable (a module level function).
+"""
+import os
+import multiprocessing
+
+import tables
+
+from batcha.analysis import Analysis
+from batcha.datastore import write_block
+
+import logging
+logger = logging.getLogger('batcha.batch')
+
+def trajectory_name(dcd):
+    """ Returns the name of the group of a trajectory (the file name without extension) """
+    return os.path.splitext(os.path.basename(dcd))[0]
+
+def batch_inputs(inputs):
+    """ Returns (name, psf, dcd) for every (psf, dcd) or (name, psf, dcd) input """
+    named = []
+    for i in inputs:
+        if len(i) == 2:
+            i = (trajectory_name(i[1]),) + tuple(i)
+        named.append(tuple(i))
+    names = [ n for (n, psf, dcd) in named ]
+    if len(set(names)) != len(names):
+        raise Exception('Trajectory names are not unique, give a name with every input: %s' % names)
+    return named
+
+class QueueSink(object):
+    """ Analysis sink sending the result blocks of one trajectory to the writer """
+
+    def __init__(self, queue, name):
+        self._queue = queue
+        self.name = name
+
+    def __call__(self, blocks):
+        self._queue.put((self.name, blocks))
+
+def _writer(filename, title, queue):
+    """ Writer process: append the blocks from the queue until it gets None """
+    h5f = tables.openFile(filename, mode='a', title=title)
+    nodes = {}
+    try:
+        while True:
+            msg = queue.get()
+            if msg is None:
+                break
+            (name, blocks) = msg
+            for block in blocks:
+                write_block(h5f, nodes, block, root='/%s' % name)
+            h5f.flush()
+    finally:
+        h5f.close()
+
+_queue = None
+
+def _init_worker(queue):
+    global _queue
+    _queue = queue
+
+def _run_one(args):
+    from MDAnalysis import Universe
+    (spec, name, psf, dcd, ref_files, universe_kwargs, storage, run_kwargs) = args
+    trj = Universe(psf, dcd, **universe_kwargs)
+    if ref_files is None:
+        ref = Universe(psf, dcd, **universe_kwargs)
+    else:
+        ref = Universe(*ref_files, **universe_kwargs)
+    analysis = Analysis(None, sink=QueueSink(_queue, name), storage=storage)
+    spec(analysis, trj, ref)
+    stats = analysis.run(trj=trj, ref=ref, **run_kwargs)
+    analysis.save()
+    return stats
+
+def run_batch(filename, spec, inputs, ref=None, n_workers=None, universe_kwargs=None, flush_every=1000, title="datastore", storage=None, **run_kwargs):
+    """ Run the analysis built by spec over every input and store the results in filename.
+
+    inputs are (psf, dcd) or (name, psf, dcd) tuples, the results of an input
+    are stored below the group /name (the dcd file name by default). ref are
+    the files of the reference Universe, by default every trajectory is its
+    own reference. storage (a datastore.Storage) is used for the nodes of
+    every trajectory. Results are sent to the writer every flush_every frames,
+    the remaining keyword arguments are passed to Analysis.run. Returns the
+    run statistics of every trajectory by name.
+    """
+    inputs = batch_inputs(inputs)
+    n_workers = n_workers or multiprocessing.cpu_count()
+    universe_kwargs = universe_kwargs or {}
+    run_kwargs['flush_every'] = flush_every
+    jobs = [ (spec, name, psf, dcd, ref, universe_kwargs, storage, run_kwargs) for (name, psf, dcd) in inputs ]
+
+    queue = multiprocessing.Queue()
+    writer = multiprocessing.Process(target=_writer, args=(filename, title, queue))
+    writer.start()
+    logger.info("Analyzing %d trajectories with %d workers" % (len(jobs), n_workers))
+    pool = multiprocessing.Pool(n_workers, _init_worker, (queue,))
+    try:
+        stats = pool.map(_run_one, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+        queue.put(None)
+        writer.join()
+    if writer.exitcode != 0:
+        raise Exception('The writer process failed (exit code %s), %s is incomplete' % (writer.exitcode, filename))
+    return dict(zip([ name for (name, psf, dcd) in inputs ], stats))
@@ -0,0 +1,79 @@
+""" Frame scoped cache shared by the processors of an Analysis run.
+
+Selections are memoized by (universe, selection string) for the whole run,
+centers of mass and coordinates of a selection are memoized for the current
+frame only. Analysis.run advances the cache on every frame. Processors which
+move the coordinates of the Timestep in place (e.g. the RMSD fit) must call
+invalidate() afterwards.
+
+Processors opt in with a frame_cache class attribute (NO_CACHE by default),
+which Analysis.run replaces with the FrameCache of the run.
+"""
+from batcha.geometry import center_of_mass
+
+class NullCache(object):
+    """ Same interface as FrameCache without caching anything """
+    hits = 0
+    misses = 0
+
+    def select(self, universe, selection):
+        return universe.selectAtoms(selection)
+
+    def center_of_mass(self, atoms, box=None):
+        return center_of_mass(atoms.coordinates(), atoms.masses(), box)
+
+    def coordinates(self, atoms):
+        return atoms.coordinates()
+
+    def advance(self, frame):
+        pass
+
+    def invalidate(self):
+        pass
+
+class FrameCache(NullCache):
+
+    def __init__(self):
+        self._selections = {}
+        self._values = {}
+        self._frame = None
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, cache, key, compute):
+        if key in cache:
+            self.hits += 1
+            return cache[key]
+        self.misses += 1
+        value = cache[key] = compute()
+        return value
+
+    def select(self, universe, selection):
+        return self._get(self._selections, (id(universe), selection), lambda: universe.selectAtoms(selection))
+
+    def center_of_mass(self, atoms, box=None):
+        return self._get(self._values, ('com', id(atoms), box is not None), lambda: center_of_mass(atoms.coordinates(), atoms.masses(), box))
+
+    def coordinates(self, atoms):
+        return self._get(self._values, ('coordinates', id(atoms)), lambda: atoms.coordinates())
+
+    def advance(self, frame):
+        """ Drop the values of the previous frame when the trajectory moves to a new frame """
+        if frame != self._frame:
+            self._values = {}
+            self._frame = frame
+
+    def invalidate(self):
+        """ Drop the values of the current frame (the coordinates have been modified) """
+        self._values = {}
+
+    def add(self, stats):
+        """ Add the hits and misses of the stats of another cache (e.g. of a parallel worker) """
+        self.hits += stats['cache_hits']
+        self.misses += stats['cache_misses']
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return { 'cache_hits': self.hits, 'cache_misses': self.misses, 'cache_hit_rate': self.hits/float(lookups) if lookups else 0.0 }
+
+NO_CACHE = NullCache()
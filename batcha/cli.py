@@ -0,0 +1,222 @@
+""" Command line driver: batcha run config.yaml
+
+The config describes the inputs and the analyses declaratively (YAML if
+PyYAML is installed, JSON otherwise):
+
+    output: results.h5
+    topology: system.psf
+    trajectory: run1.dcd            # or trajectories: [run1.dcd, run2.dcd, ...]
+    reference: [system.psf, system.pdb]   # optional, default: the trajectory
+    workers: 4
+    chunk_size: 1000
+    storage: {complib: 'blosc:lz4', complevel: 5}    # see datastore.Storage
+    frames: {start: 0, stop: 1000, step: 10}
+    incremental: true               # only analyze the frames added since the last run
+    reuse: true                     # skip the stored results which are up to date
+    metadata:
+      - path: /metadata/trajectory
+        data: {psf: system.psf, dcd: run1.dcd}
+    timeseries:
+      - path: /timeseries/com/protein
+        type: CenterOfMass          # an MDAnalysis.Timeseries class
+        selection: protein          # or selections: [...] for Dihedral etc.
+    sequence:
+      - path: /protein/rmsd/backbone
+        module: rmsd.RMSD           # a class in batcha/modules
+        kwargs: {selection: backbone}
+      - path: /channel/cylinder
+        module: cylindersearch.CylinderSearch
+        args: [segid A, segid B, resname TIP3]
+        array: ragged
+        storage: {complevel: 9}             # storage of this node only
+
+A single trajectory is run with Analysis.run (workers split its frames),
+several trajectories with batch.run_batch (one trajectory per worker, each
+stored below /<trajectory name>). The command line options override the
+config, unknown or invalid keys are reported before anything is run.
+"""
+import os
+import sys
+import json
+import argparse
+
+import tables
+
+from batcha.datastore import Storage
+
+def load_config(filename):
+    """ Returns the config dict of a YAML or JSON file """
+    with open(filename) as f:
+        text = f.read()
+    if os.path.splitext(filename)[1].lower() == '.json':
+        return json.loads(text)
+    try:
+        import yaml
+    except ImportError:
+        try:
+            return json.loads(text)
+        except ValueError:
+            raise Exception('PyYAML is needed to read %s (or use a JSON config)' % filename)
+    return yaml.safe_load(text)
+
+# the keys of a config, of its frames and storage and of its metadata, timeseries and sequence entries
+CONFIG_KEYS = ['output', 'topology', 'trajectory', 'trajectories', 'reference', 'universe', 'workers', 'chunk_size',
+               'storage', 'frames', 'incremental', 'reuse', 'metadata', 'timeseries', 'sequence']
+FRAMES_KEYS = ['start', 'stop', 'step', 'frames']
+STORAGE_KEYS = ['complib', 'complevel', 'shuffle', 'chunkshape', 'expectedrows']
+ENTRY_KEYS = { 'metadata': ['path', 'data', 'storage'],
+               'timeseries': ['path', 'type', 'selection', 'selections', 'code', 'format', 'storage'],
+               'sequence': ['path', 'module', 'args', 'kwargs', 'format', 'array', 'storage'] }
+REQUIRED_KEYS = { 'metadata': ['path', 'data'], 'timeseries': ['path', 'type'], 'sequence': ['path', 'module'] }
+
+def _check_keys(d, allowed, where):
+    if not isinstance(d, dict):
+        raise Exception('%s must be a mapping' % where)
+    unknown = sorted(set(d.keys()) - set(allowed))
+    if len(unknown) > 0:
+        raise Exception('Unknown key(s) in %s: %s (expected %s)' % (where, ', '.join(unknown), ', '.join(allowed)))
+
+def check_config(config):
+    """ Raises an Exception for the first unknown or invalid key of a config dict """
+    _check_keys(config, CONFIG_KEYS, 'the config')
+    for key in ('output', 'topology'):
+        if not config.get(key):
+            raise Exception('The config has no %s' % key)
+    if not (config.get('trajectory') or config.get('trajectories')):
+        raise Exception('The config has no trajectory or trajectories')
+    for key in ('workers', 'chunk_size'):
+        if config.get(key) is not None and not (isinstance(config[key], int) and config[key] > 0):
+            raise Exception('%s must be a positive integer, not %r' % (key, config[key]))
+    _check_keys(config.get('frames') or {}, FRAMES_KEYS, 'frames')
+    _check_keys(config.get('storage') or {}, STORAGE_KEYS, 'storage')
+    for section in ('metadata', 'timeseries', 'sequence'):
+        entries = config.get(section, [])
+        if not isinstance(entries, list):
+            raise Exception('%s must be a list' % section)
+        for i, entry in enumerate(entries):
+            where = '%s entry %d' % (section, i+1)
+            _check_keys(entry, ENTRY_KEYS[section], where)
+            for key in REQUIRED_KEYS[section]:
+                if key not in entry:
+                    raise Exception('%s has no %s' % (where, key))
+            _check_keys(entry.get('storage') or {}, STORAGE_KEYS, 'the storage of %s' % where)
+            if entry.get('array', False) not in (False, True, 'ragged'):
+                raise Exception('array of %s must be true, false or ragged, not %r' % (where, entry['array']))
+
+def column_format(spec):
+    """ Returns the PyTables column for a format name (e.g. Float32Col) and optional shape """
+    if spec is None:
+        return tables.Float32Col()
+    if isinstance(spec, dict):
+        shape = spec.get('shape')
+        if shape is not None:
+            return getattr(tables, spec['type'])(shape=tuple(shape))
+        return getattr(tables, spec['type'])()
+    return getattr(tables, spec)()
+
+def storage(spec):
+    """ Returns the Storage for a dict of Storage arguments or None """
+    if not spec:
+        return None
+    return Storage(**spec)
+
+def module_class(name):
+    """ Returns the class for 'module.Class' in batcha/modules """
+    (module, cls) = name.rsplit('.', 1)
+    m = __import__('batcha.modules.%s' % module, fromlist=[cls])
+    try:
+        return getattr(m, cls)
+    except AttributeError:
+        raise Exception('No class %s in batcha.modules.%s' % (cls, module))
+
+class ConfigSpec(object):
+    """ Adds the metadata, timeseries and sequential processors of a config to an Analysis.
+    It is picklable, so it can be used as the spec of batch.run_batch.
+    """
+
+    def __init__(self, config):
+        self.metadata = config.get('metadata', [])
+        self.timeseries = config.get('timeseries', [])
+        self.sequence = config.get('sequence', [])
+
+    def __call__(self, analysis, trj, ref):
+        from MDAnalysis import Timeseries
+        for m in self.metadata:
+            analysis.add_metadata(m['path'], m['data'], storage=storage(m.get('storage')))
+        for t in self.timeseries:
+            selections = t.get('selections') or [t['selection']]
+            atoms = trj.selectAtoms(*selections)
+            cls = getattr(Timeseries, t['type'])
+            if 'code' in t:
+                timeseries = cls(t['code'], atoms)
+            else:
+                timeseries = cls(atoms)
+            analysis.add_timeseries(t['path'], timeseries, format=column_format(t.get('format')), storage=storage(t.get('storage')))
+        for s in self.sequence:
+            processor = module_class(s['module'])(*s.get('args', []), **s.get('kwargs', {}))
+            analysis.add_to_sequence(s['path'], processor, format=column_format(s.get('format')), array=s.get('array', False), storage=storage(s.get('storage')))
+
+def run(config):
+    """ Run the analyses of a config dict """
+    from MDAnalysis import Universe
+    from batcha.analysis import Analysis
+    from batcha.batch import run_batch
+
+    check_config(config)
+    spec = ConfigSpec(config)
+    trajectories = config.get('trajectories') or [config['trajectory']]
+    reference = config.get('reference')
+    universe_kwargs = config.get('universe', {})
+    frames = config.get('frames') or {}
+    run_kwargs = dict([ (k, frames.get(k)) for k in ('start', 'stop', 'step', 'frames') ])
+    workers = config.get('workers', 1)
+    chunk_size = config.get('chunk_size')
+
+    if len(trajectories) > 1:
+        if config.get('incremental') or config.get('reuse'):
+            raise Exception('Incremental runs and reuse are only supported for a single trajectory')
+        inputs = [ (config['topology'], dcd) for dcd in trajectories ]
+        return run_batch(config['output'], spec, inputs, ref=reference, n_workers=workers, universe_kwargs=universe_kwargs, flush_every=chunk_size or 1000, storage=storage(config.get('storage')), **run_kwargs)
+
+    trj = Universe(config['topology'], trajectories[0], **universe_kwargs)
+    if reference is None:
+        ref = Universe(config['topology'], trajectories[0], **universe_kwargs)
+    else:
+        ref = Universe(*reference, **universe_kwargs)
+    analysis = Analysis(config['output'], readonly=False, storage=storage(config.get('storage')))
+    spec(analysis, trj, ref)
+    stats = analysis.run(trj=trj, ref=ref, n_workers=workers, flush_every=chunk_size if workers == 1 else None, incremental=config.get('incremental', False), reuse=config.get('reuse', False), **run_kwargs)
+    analysis.save()
+    analysis.close()
+    return stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='batcha', description='Batch analysis of MDAnalysis trajectories')
+    commands = parser.add_subparsers(dest='command')
+    p = commands.add_parser('run', help='run the analyses of a config file')
+    p.add_argument('config', help='YAML or JSON config file')
+    p.add_argument('-o', '--output', help='HDF5 output file')
+    p.add_argument('-w', '--workers', type=int, help='number of worker processes')
+    p.add_argument('-c', '--chunk-size', type=int, help='frames between writes to the output file')
+    p.add_argument('--start', type=int, help='first frame (0-based)')
+    p.add_argument('--stop', type=int, help='frame to stop before')
+    p.add_argument('--step', type=int, help='process every step-th frame')
+    p.add_argument('--incremental', action='store_true', default=None, help='only analyze the frames added since the last run')
+    p.add_argument('--reuse', action='store_true', default=None, help='skip the analyses whose stored results are up to date')
+    args = parser.parse_args(argv)
+
+    config = load_config(args.config)
+    for key in ('output', 'workers', 'chunk_size', 'incremental', 'reuse'):
+        if getattr(args, key) is not None:
+            config[key] = getattr(args, key)
+    for key in ('start', 'stop', 'step'):
+        if getattr(args, key) is not None:
+            config.setdefault('frames', {})[key] = getattr(args, key)
+    if 'output' not in config:
+        parser.error('no output file in the config or on the command line')
+    stats = run(config)
+    print json.dumps(stats, indent=1, default=str)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,45 @@
+""" Zero-copy access to the coordinates of atom groups.
+
+Processors create a CoordinateView for each atom group in prepare. Every frame
+CoordinateView.get(ts) returns the coordinates of the group straight from
+ts._pos: a view if the atoms are contiguous, otherwise a gather into a buffer
+which is allocated once and reused for every frame. The returned array is only
+valid until the next call, copy it if it has to be kept.
+"""
+import numpy
+
+def atom_indices(atom_group):
+    """ Returns the indices of the atoms of atom_group in the coordinate array of a Timestep """
+    return numpy.array([ a.number for a in atom_group.atoms ], dtype=numpy.intp)
+
+class CoordinateView(object):
+    """ Coordinates of an atom group (or an array of atom indices) in a Timestep """
+
+    def __init__(self, atoms, dtype=numpy.float32):
+        if isinstance(atoms, numpy.ndarray):
+            self.indices = atoms
+        else:
+            self.indices = atom_indices(atoms)
+        self._slice = None
+        self._gather = None
+        n = len(self.indices)
+        if n > 0 and self.indices[-1] - self.indices[0] == n - 1 and numpy.all(numpy.diff(self.indices) == 1):
+            self._slice = slice(self.indices[0], self.indices[-1] + 1)
+        self.buffer = numpy.empty((n, 3), dtype=dtype)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def get(self, ts):
+        """ Returns the (n, 3) coordinates of the group in the Timestep ts """
+        if ts._pos.dtype == self.buffer.dtype:
+            if self._slice is not None:
+                return ts._pos[self._slice]
+            numpy.take(ts._pos, self.indices, axis=0, out=self.buffer)
+            return self.buffer
+        # numpy.take does not cast, gather in the dtype of the Timestep first
+        if self._gather is None or self._gather.dtype != ts._pos.dtype:
+            self._gather = numpy.empty(self.buffer.shape, dtype=ts._pos.dtype)
+        numpy.take(ts._pos, self.indices, axis=0, out=self._gather)
+        self.buffer[:] = self._gather
+        return self.buffer
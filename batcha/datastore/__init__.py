@@ -1,7 +1,10 @@
 from tables import *
 from batcha.utils import split_path
 
-# import numpy
+import tables
+
+import numpy
+
 # import os
 # import inspect
 
@@ -31,12 +34,162 @@ from batcha.utils import split_path
 #     group = h5file.createGroup("/", 'detector', 'Detector information')
 #     table = h5file.createTable(group, 'readout', Particle, "Readout example")
 
+# tables are stored as a group with one EArray per column (marked by this
+# BATCHA_LAYOUT attribute) so columns can be added or dropped on their own
+COLUMN_LAYOUT = 'columns'
+# rows per block when copying or filling columns
+_COPY_ROWS = 65536
+
+def is_column_table(node):
+    """ True if node is a table stored in the column layout """
+    return isinstance(node, tables.Group) and getattr(node._v_attrs, 'BATCHA_LAYOUT', None) == COLUMN_LAYOUT
+
+def table_rows(node):
+    """ Number of rows of a table in either layout """
+    if isinstance(node, tables.Table):
+        return node.nrows
+    rows = [ array.nrows for array in node._v_children.values() ]
+    return min(rows) if rows else 0
+
+def read_column(h5f, path, name, start=None, stop=None):
+    """ Read rows start..stop of a column of the table at path in either layout """
+    node = h5f.getNode(path)
+    if isinstance(node, tables.Table):
+        return node.read(start, stop, field=name)
+    return node._f_getChild(name).read(start, stop)
+
+class Storage(object):
+    """ Chunking and compression options of a datastore node.
+    
+    complib is a PyTables compressor ('zlib', 'lzo', 'bzip2', 'blosc' or a
+    blosc compressor like 'blosc:lz4'), complevel 0 disables compression.
+    chunkshape is the number of rows per HDF5 chunk (PyTables computes it from
+    expectedrows when it is None). With expectedrows=None the rows expected by
+    the Analysis (the number of frames of the run) are used.
+    """
+    
+    def __init__(self, complib='zlib', complevel=1, shuffle=True, chunkshape=None, expectedrows=None):
+        self.complib = complib
+        self.complevel = complevel
+        self.shuffle = shuffle
+        self.chunkshape = chunkshape
+        self.expectedrows = expectedrows
+    
+    def filters(self):
+        if not self.complevel:
+            return None
+        return Filters(complevel=self.complevel, complib=self.complib, shuffle=self.shuffle)
+    
+    def options(self, expectedrows=None, chunked=True):
+        """ Returns the keyword arguments for creating a node expecting expectedrows rows """
+        options = { 'filters': self.filters() }
+        if self.chunkshape is not None:
+            options['chunkshape'] = (self.chunkshape,)
+        if chunked:
+            options['expectedrows'] = self.expectedrows or expectedrows or 25000
+        return options
+    
+    def __repr__(self):
+        return 'Storage(complib=%r, complevel=%r, shuffle=%r, chunkshape=%r, expectedrows=%r)' % (self.complib, self.complevel, self.shuffle, self.chunkshape, self.expectedrows)
+
+# the filters of the nodes created before storage options existed, their
+# expected rows are the frames of the run like for any other storage
+LEGACY_TABLE_STORAGE = Storage(complevel=0)
+LEGACY_ARRAY_STORAGE = Storage(complevel=1)
+
+def read_ragged(node, start, stop, step=1):
+    """ Returns the frames start..stop (every step-th) of the ragged array group node as a list of arrays """
+    if stop <= start:
+        return []
+    if step == 1:
+        # one contiguous read of the values spanning the frames
+        offsets = node.offsets[start:stop+1]
+        values = node.values.read(offsets[0], offsets[-1])
+        return numpy.split(values, offsets[1:-1] - offsets[0])
+    # only the offsets and values of the selected frames, nearby frames are
+    # read together as long as their span fits in the I/O buffer of the values
+    begins = node.offsets.read(start, stop, step)
+    ends = node.offsets.read(start+1, stop+1, step)
+    span = max(node.values.nrowsinbuf, 1)
+    frames = []
+    i = 0
+    while i < len(begins):
+        j = i + 1
+        while j < len(begins) and ends[j] - begins[i] <= span:
+            j += 1
+        values = node.values.read(begins[i], ends[j-1])
+        frames.extend([ values[begins[k]-begins[i]:ends[k]-begins[i]] for k in xrange(i, j) ])
+        i = j
+    return frames
+
+def _read_checkpoint(h5f, path):
+    """ Returns the (frames, states) checkpoint stored on the node at path or (0, {}) """
+    try:
+        node = h5f.getNode(path)
+    except NoSuchNodeError:
+        return (0, {})
+    # _v_attrs works for leaves and for groups (ragged arrays and column tables)
+    if 'BATCHA_FRAMES' not in node._v_attrs._v_attrnames:
+        return (0, {})
+    return (int(node._v_attrs.BATCHA_FRAMES), node._v_attrs.BATCHA_STATE)
+
+def _write_checkpoint(node, frames, states):
+    """ Record the number of frames committed to node and the processor states at that frame """
+    node._v_attrs.BATCHA_FRAMES = frames
+    node._v_attrs.BATCHA_STATE = states
+
+def _read_fingerprints(h5f, path):
+    """ Returns the fingerprints by path stored on the node at path or {} """
+    try:
+        node = h5f.getNode(path)
+    except NoSuchNodeError:
+        return {}
+    if 'BATCHA_FINGERPRINTS' not in node._v_attrs._v_attrnames:
+        return {}
+    return node._v_attrs.BATCHA_FINGERPRINTS
+
+def _write_fingerprints(node, fingerprints):
+    """ Record the fingerprints of the paths stored in node """
+    node._v_attrs.BATCHA_FINGERPRINTS = fingerprints
+
+def _write_labels(node, labels):
+    """ Record the labels which the stored values index into (e.g. residues) """
+    if labels is not None:
+        node._v_attrs.BATCHA_LABELS = labels
+
+def _require_group(h5f, path):
+    """ Returns the group at path, creating it and its parents if needed """
+    node = h5f.getNode('/')
+    for n in path.split('/')[1:]:
+        if n == '':
+            continue
+        try:
+            node = h5f.getNode(node, n)
+        except NoSuchNodeError:
+            node = h5f.createGroup(node, n)
+            print "Created group: %s" % node._v_pathname
+    return node
+
+def _truncate(h5f, path, frames):
+    """ Remove the rows of the node at path beyond the given number of frames """
+    try:
+        node = h5f.getNode(path)
+    except NoSuchNodeError:
+        return
+    if node.nrows > frames:
+        print "Truncating %s from %d to %d rows" % (path, node.nrows, frames)
+        node.truncate(frames)
+
 class Column(object):
     _data = None # data to be written
     _dirty = False
+    bytes_written = 0
+    storage = None
+    expected_rows = None
     path = None
     name = None
     format = None
+    labels = None # labels the values index into, stored with the node
     
     def __init__(self, path, name, format):
         # print "Creating Column(%s)" % name
@@ -45,14 +198,26 @@ class Column(object):
         self.format = format
         self._data = []
         self._dirty = False
+        self._discard = 0
     
     def load(self, data):
         # print "Loading data:"
-        if type(data) is list:
-            self._data += data
-        else:
-            self._data.append(data)
-        self._dirty = True
+        if type(data) is not list:
+            data = [data]
+        if self._discard > 0:
+            # drop rows which are already stored in the file (see discard)
+            skipped = min(self._discard, len(data))
+            data = data[skipped:]
+            self._discard -= skipped
+        self._data += data
+        self._dirty = len(self._data) > 0
+    
+    def discard(self, count):
+        """ Drop the next count rows passed to load (they are already stored) """
+        self._discard = count
+    
+    def set_labels(self, labels):
+        self.labels = list(labels)
     
     def dirty_row_count(self):
         return len(self._data)
@@ -65,13 +230,25 @@ class Column(object):
         if len(self._data) == 0:
             self._dirty = False
         return row
+    
+    def drain(self, count=None):
+        """ Remove and return the first count dirty rows (all of them by default) as a list """
+        if count is None or count >= len(self._data):
+            rows = self._data
+            self._data = []
+        else:
+            rows = self._data[:count]
+            self._data = self._data[count:]
+        self._dirty = len(self._data) > 0
+        return rows
 
 class Array(Column):
     """ Array inherits from Column because it's basically a table with a single column """
     
-    def __init__(self, h5f, full_path, format=ObjectAtom()):
+    def __init__(self, h5f, full_path, format=ObjectAtom(), storage=None):
         self._h5f = h5f
         self.full_path = full_path
+        self.storage = storage or LEGACY_ARRAY_STORAGE
         (path, name) = split_path(self.full_path)
         super(Array, self).__init__(path, name, format)
     
@@ -90,7 +267,8 @@ class Array(Column):
                 if path == self.full_path:
                     # we are at the array but it doesn't exist yet so create it
                     # node = self._h5f.createEArray(node, self.name, self.format, (len(self._data[0]), ), expectedrows=25000)
-                    node = self._h5f.createVLArray(node, self.name, self.format, filters=Filters(1))
+                    options = self.storage.options(chunked=False)
+                    node = self._h5f.createVLArray(node, self.name, self.format, **options)
                     print "Created array: %s" % path
                 else:
                     # we are at a group that doesn't exist yet
@@ -101,7 +279,7 @@ class Array(Column):
         self._node = node
         return self._node
         
-    def write(self):
+    def write(self, partial=False):
         if self.dirty_row_count() == 0:
             print "Array %s has no rows to write, skipping it!" % self.full_path
             return False
@@ -109,28 +287,223 @@ class Array(Column):
         # first make sure the array is setup
         self.setup()
         
+        _write_labels(self._node, self.labels)
         print "Appending %d rows..." % self.dirty_row_count()
-        while self._dirty:
-            self._node.append(self.next_dirty_row())
+        # the bytes written are the growth of the node (object rows are
+        # pickled by the append, they are not pickled again to count them)
+        size = getattr(self._node, 'size_on_disk', None)
+        pickled = isinstance(self.format, ObjectAtom)
+        for row in self.drain():
+            self._node.append(row)
+            if size is None and not pickled:
+                self.bytes_written += numpy.asarray(row).nbytes
+        if size is not None:
+            self._node.flush()
+            self.bytes_written += self._node.size_on_disk - size
         print " Done."
+    
+    def drain_block(self, partial=False):
+        """ Returns the dirty rows as a picklable block for write_block (None if there are none) """
+        if self.dirty_row_count() == 0:
+            return None
+        return ('array', self.full_path, self.format, self.drain(), self.storage, self.labels, self.expected_rows)
+    
+    def checkpoint(self):
+        return _read_checkpoint(self._h5f, self.full_path)
+    
+    def set_checkpoint(self, frames, states):
+        _write_checkpoint(self.setup(), frames, states)
+    
+    def fingerprints(self):
+        return _read_fingerprints(self._h5f, self.full_path)
+    
+    def set_fingerprints(self, fingerprints):
+        _write_fingerprints(self.setup(), fingerprints)
+    
+    def stored_rows(self):
+        """ Number of frames stored in the file """
+        try:
+            return self._h5f.getNode(self.full_path).nrows
+        except NoSuchNodeError:
+            return 0
+    
+    def truncate(self, frames):
+        _truncate(self._h5f, self.full_path, frames)
+
+class RaggedArray(Column):
+    """ Typed ragged per-frame storage (CSR style).
+    
+    Every frame is a (structured) NumPy array of any length. The group at
+    full_path holds a 'values' table with the rows of all frames back to back,
+    an 'offsets' array where frame i is values[offsets[i]:offsets[i+1]] and a
+    'labels' lookup table. String fields of the frames are interned into the
+    labels and stored as int32 indices.
+    """
+    
+    def __init__(self, h5f, full_path, storage=None):
+        self._h5f = h5f
+        self.full_path = full_path
+        self.storage = storage or LEGACY_ARRAY_STORAGE
+        self._node = None
+        self._labels = []
+        self._label_index = {}
+        self._stored_labels = 0
+        (path, name) = split_path(self.full_path)
+        super(RaggedArray, self).__init__(path, name, None)
+    
+    def set_labels(self, labels):
+        """ Seed the label lookup table (e.g. with the residue labels of a processor) """
+        for l in labels:
+            self._intern(l)
+    
+    def _intern(self, label):
+        if label not in self._label_index:
+            self._label_index[label] = len(self._labels)
+            self._labels.append(label)
+        return self._label_index[label]
+    
+    def _typed(self, frame):
+        """ Returns the frame as a structured array with its string fields interned """
+        frame = numpy.asarray(frame)
+        if frame.dtype.names is None:
+            typed = numpy.empty(len(frame), dtype=[('value', frame.dtype)])
+            typed['value'] = frame
+            frame = typed
+        if not any([ frame.dtype[n].kind in 'SUO' for n in frame.dtype.names ]):
+            return frame
+        dtype = [ (n, numpy.int32 if frame.dtype[n].kind in 'SUO' else frame.dtype[n]) for n in frame.dtype.names ]
+        typed = numpy.empty(len(frame), dtype=dtype)
+        for n in frame.dtype.names:
+            if frame.dtype[n].kind in 'SUO':
+                typed[n] = [ self._intern(str(v)) for v in frame[n] ]
+            else:
+                typed[n] = frame[n]
+        return typed
+    
+    def setup(self, dtype=None, rows_per_frame=None):
+        print "Setting up ragged array at: %s" % (self.full_path)
+        try:
+            self._node = self._h5f.getNode(self.full_path)
+        except NoSuchNodeError:
+            if dtype is None:
+                return None
+            parent = _require_group(self._h5f, self.path)
+            self._node = self._h5f.createGroup(parent, self.name)
+            frames = self.expected_rows
+            values_rows = int(frames*rows_per_frame) if frames and rows_per_frame else None
+            self._h5f.createTable(self._node, 'values', dtype, **self.storage.options(values_rows))
+            offsets_options = self.storage.options(frames and frames+1)
+            offsets_options.pop('chunkshape', None)
+            offsets = self._h5f.createEArray(self._node, 'offsets', Int64Atom(), (0,), **offsets_options)
+            offsets.append(numpy.zeros(1, dtype=numpy.int64))
+            self._h5f.createVLArray(self._node, 'labels', VLStringAtom())
+            print "Created ragged array: %s" % self.full_path
+        else:
+            if self._stored_labels == 0:
+                # continue the lookup table which is already in the file
+                stored = [ l for l in self._node.labels.read() ]
+                n = min(len(stored), len(self._labels))
+                if stored[:n] != self._labels[:n]:
+                    raise Exception('Labels of ragged array %s differ from the labels in the file!' % self.full_path)
+                stored += self._labels[n:]
+                self._labels = stored
+                self._label_index = dict([ (l, i) for i, l in enumerate(stored) ])
+                self._stored_labels = self._node.labels.nrows
+        return self._node
+    
+    def write(self, partial=False):
+        if self.dirty_row_count() == 0:
+            print "Ragged array %s has no rows to write, skipping it!" % self.full_path
+            return False
+        
+        if self._node is None:
+            self.setup()
+        frames = [ self._typed(f) for f in self.drain() ]
+        if self._node is None:
+            # the values table is sized from the frames expected and the rows per frame seen so far
+            self.setup(frames[0].dtype, numpy.mean([ len(f) for f in frames ]))
+        
+        print "Appending %d frames..." % len(frames)
+        values = self._node.values
+        offsets = self._node.offsets
+        lengths = numpy.array([ len(f) for f in frames ], dtype=numpy.int64)
+        if lengths.sum() > 0:
+            rows = numpy.concatenate(frames).astype(values.dtype)
+            values.append(rows)
+            self.bytes_written += rows.nbytes
+        offsets.append(offsets[-1] + numpy.cumsum(lengths))
+        self.bytes_written += lengths.nbytes
+        for l in self._labels[self._stored_labels:]:
+            self._node.labels.append(l)
+        self._stored_labels = len(self._labels)
+        values.flush()
+        offsets.flush()
+        print " Done."
+    
+    def drain_block(self, partial=False):
+        """ Returns the dirty frames as a picklable block for write_block (None if there are none) """
+        if self.dirty_row_count() == 0:
+            return None
+        return ('ragged', self.full_path, list(self._labels), self.drain(), self.storage, self.expected_rows)
+    
+    def labels(self):
+        return self._h5f.getNode(self.full_path).labels.read()
+    
+    def checkpoint(self):
+        return _read_checkpoint(self._h5f, self.full_path)
+    
+    def set_checkpoint(self, frames, states):
+        if self.setup() is not None:
+            _write_checkpoint(self._node, frames, states)
+    
+    def fingerprints(self):
+        return _read_fingerprints(self._h5f, self.full_path)
+    
+    def set_fingerprints(self, fingerprints):
+        if self.setup() is not None:
+            _write_fingerprints(self._node, fingerprints)
+    
+    def stored_rows(self):
+        """ Number of frames stored in the file """
+        try:
+            return self._h5f.getNode(self.full_path).offsets.nrows - 1
+        except NoSuchNodeError:
+            return 0
+    
+    def truncate(self, frames):
+        try:
+            node = self._h5f.getNode(self.full_path)
+        except NoSuchNodeError:
+            return
+        if node.offsets.nrows > frames+1:
+            print "Truncating %s from %d to %d frames" % (self.full_path, node.offsets.nrows-1, frames)
+            node.values.truncate(node.offsets[frames])
+            node.offsets.truncate(frames+1)
 
 class Table(object):
     """ Dataset stored with PyTables
+    
+    The table is a group holding one EArray per column, so adding or dropping
+    a column only writes that column. Tables stored as a PyTables Table by
+    earlier versions are migrated to this layout the first time they are set up.
     """
     
     # PyTables table group, name and description
     
     _h5f = None # HDF5 file object (not initialized by this object)
-    _node = None # the initialized table
+    _node = None # the initialized table group
     
     path = None
     name = None  # name of the table to be created/used
     
     _columns = {}
+    bytes_written = 0
+    expected_rows = None
     
-    def __init__(self, h5f, path):
+    def __init__(self, h5f, path, storage=None):
         # print "Creating Table(%s)" % path
         self._h5f = h5f
+        self.storage = storage or LEGACY_TABLE_STORAGE
         self._node = None
         self._columns = {}
         self.path = path
@@ -150,67 +523,185 @@ class Table(object):
     
     def setup(self):
         print "Setting up table at: %s" % self.path
-        split_path = self.path.split('/')
-        # traverse the path
-        node = self._h5f.getNode('/')
-        for n in split_path[1:]:
-            parent = node._v_pathname
-            path = (parent+'/'+n).replace('//','/')
-            try:
-                # try to get the node
-                node = self._h5f.getNode(path)
-            except NoSuchNodeError:
-                if path == self.path:
-                    # we are at the table but it doesn't exist yet so create it
-                    node = self._h5f.createTable(node, n, self._description(), expectedrows=25000)
-                    print "Created table: %s" % path
-                else:
-                    # we are at a group that doesn't exist yet
-                    node = self._h5f.createGroup(node, n)
-                    print "Created group: %s" % path
-            else:
-                # if we find the node but the descriptions differ (column(s) added or removed)
-                if path == self.path and set(node.description._v_colObjects.keys()) != set(self._description().keys()):
-                    print "Column(s) modified for table: %s" % self.path
-                    print set(node.description._v_colObjects.keys()) ^ set(self._description().keys())
-                    copy_node = self._h5f.createTable(node._v_parent, self.name+'_COPY', self._description(), expectedrows=25000)
-                    node.attrs._f_copy(copy_node)
-                    for i in xrange(node.nrows):
-                        copy_node.row.append()
-                    copy_node.flush()
-                    # copy the data from the old table
-                    for col in node.description._v_colObjects:
-                        # only if the col is in the new table
-                        if col in self._description():
-                            getattr(copy_node.cols, col)[:] = getattr(node.cols, col)[:]
-                    copy_node.flush()
-                    node.remove()
-                    copy_node.move(parent, self.name)
-                    node = copy_node
-                    print "Table %s updated with new column(s)." % self.path
+        parent = _require_group(self._h5f, split_path(self.path)[0] or '/')
+        try:
+            node = self._h5f.getNode(self.path)
+        except NoSuchNodeError:
+            # the table is a group with one extendable array per column
+            node = self._h5f.createGroup(parent, self.name)
+            node._v_attrs.BATCHA_LAYOUT = COLUMN_LAYOUT
+            print "Created table: %s" % self.path
+        else:
+            if isinstance(node, tables.Table):
+                node = self._migrate(node)
+        
+        # add the new columns and drop the ones which are gone
+        existing = set(node._v_children.keys())
+        described = set(self._description().keys())
+        if existing != described:
+            if existing:
+                print "Column(s) modified for table: %s" % self.path
+                print existing ^ described
+            num_rows = table_rows(node)
+            for name in existing - described:
+                node._f_getChild(name).remove()
+            for name in described - existing:
+                self._create_column(node, name, self._columns[name].format, num_rows)
         
-        # node should now be the table object
+        # node should now be the table group
         self._node = node
         return self._node
-        
-    def write(self):
+    
+    def _create_column(self, node, name, format, num_rows=0, fill=None):
+        """ Create the array of a column and fill its first num_rows rows (with fill(start, stop) or the column default) """
+        atom = Atom.from_dtype(numpy.dtype(format.dtype))
+        options = self.storage.options(max(num_rows, self.expected_rows or 0))
+        if 'chunkshape' in options:
+            options['chunkshape'] = options['chunkshape'] + atom.shape
+        array = self._h5f.createEArray(node, name, atom, (0,) + atom.shape, **options)
+        for start in xrange(0, num_rows, _COPY_ROWS):
+            stop = min(start + _COPY_ROWS, num_rows)
+            if fill is not None:
+                array.append(fill(start, stop))
+            else:
+                rows = numpy.empty((stop - start,) + atom.shape, dtype=atom.dtype.base)
+                rows[...] = format.dflt
+                array.append(rows)
+        return array
+    
+    def _migrate(self, table):
+        """ Convert a table stored as a PyTables Table to the column layout """
+        print "Migrating table %s to one array per column..." % self.path
+        parent = table._v_parent
+        table.move(parent, self.name + '_LEGACY')
+        node = self._h5f.createGroup(parent, self.name)
+        node._v_attrs.BATCHA_LAYOUT = COLUMN_LAYOUT
+        for attr in table._v_attrs._v_attrnamesuser:
+            setattr(node._v_attrs, attr, getattr(table._v_attrs, attr))
+        for name, col in table.description._v_colObjects.items():
+            self._create_column(node, name, col, table.nrows, lambda start, stop: table.read(start, stop, field=name))
+        table.remove()
+        print "Table %s migrated." % self.path
+        return node
+    
+    def _rows_to_write(self, partial):
         num_rows = [ col.dirty_row_count() for col in self._columns.values() ]
         num_rows = set(num_rows)
+        if partial:
+            num_rows = set([ min(num_rows) ])
         if len(num_rows) > 1:
             raise Exception('Inconsistent number of rows to write: %s' % num_rows)
-        num_rows = list(num_rows)[0]
+        return list(num_rows)[0]
+    
+    def write(self, partial=False):
+        """ Append the dirty rows of all columns to the table.
+        
+        With partial=True only the rows which are available in every column are
+        written and the rest stay dirty (used when streaming results).
+        """
+        num_rows = self._rows_to_write(partial)
         
         # first make sure the table is setup
         self.setup()
         
         print "Appending %d rows..." % num_rows
-        row = self._node.row
-        for i in range(num_rows):
-            if i % 10 == 0:
-                print '.',
+        # one append per column array
+        if num_rows > 0:
             for col in self._columns.values():
-                row[col.name] = col.next_dirty_row()
-            row.append()
+                array = self._node._f_getChild(col.name)
+                _write_labels(array, col.labels)
+                rows = numpy.asarray(col.drain(num_rows), dtype=array.atom.dtype.base).reshape((num_rows,) + array.atom.shape)
+                array.append(rows)
+                array.flush()
+                self.bytes_written += rows.nbytes
         print " Done."
-        self._node.flush()
     
+    def drain_block(self, partial=False):
+        """ Returns the dirty rows of all columns as a picklable block for write_block (None if there are none) """
+        num_rows = self._rows_to_write(partial)
+        if num_rows == 0:
+            return None
+        return ('table', self.path, [ (col.name, col.format, col.drain(num_rows), col.labels) for col in self._columns.values() ], self.storage, self.expected_rows)
+    
+    def discard(self, count):
+        for col in self._columns.values():
+            col.discard(count)
+    
+    def checkpoint(self):
+        return _read_checkpoint(self._h5f, self.path)
+    
+    def set_checkpoint(self, frames, states):
+        _write_checkpoint(self.setup(), frames, states)
+    
+    def fingerprints(self):
+        return _read_fingerprints(self._h5f, self.path)
+    
+    def set_fingerprints(self, fingerprints):
+        _write_fingerprints(self.setup(), fingerprints)
+    
+    def stored_rows(self):
+        """ Number of rows stored in the file """
+        try:
+            return table_rows(self._h5f.getNode(self.path))
+        except NoSuchNodeError:
+            return 0
+    
+    def has_columns(self):
+        """ True unless the table is stored without some of its columns """
+        try:
+            node = self._h5f.getNode(self.path)
+        except NoSuchNodeError:
+            return True
+        if isinstance(node, tables.Table):
+            stored = set(node.colnames)
+        else:
+            stored = set(node._v_children.keys())
+        return set(self._columns.keys()) <= stored
+    
+    def truncate(self, frames):
+        try:
+            node = self._h5f.getNode(self.path)
+        except NoSuchNodeError:
+            return
+        if isinstance(node, tables.Table):
+            _truncate(self._h5f, self.path, frames)
+            return
+        for array in node._v_children.values():
+            if array.nrows > frames:
+                print "Truncating %s from %d to %d rows" % (array._v_pathname, array.nrows, frames)
+                array.truncate(frames)
+    
+
+def write_block(h5f, nodes, block, root=''):
+    """ Append a block returned by drain_block to the file below the group root.
+    
+    nodes caches the Table, Array and RaggedArray objects by path between calls.
+    New nodes are created with the storage options and expected rows of the
+    node which sent the block.
+    """
+    kind, path = block[0], root + block[1]
+    if kind == 'table':
+        if path not in nodes:
+            nodes[path] = Table(h5f, path, block[3])
+            nodes[path].expected_rows = block[4]
+        for (name, format, rows, labels) in block[2]:
+            col = nodes[path].column(name, format)
+            if labels is not None:
+                col.set_labels(labels)
+            col.load(rows)
+    elif kind == 'array':
+        if path not in nodes:
+            nodes[path] = Array(h5f, path, block[2], block[4])
+            nodes[path].expected_rows = block[6]
+        if block[5] is not None:
+            nodes[path].set_labels(block[5])
+        nodes[path].load(block[3])
+    elif kind == 'ragged':
+        if path not in nodes:
+            nodes[path] = RaggedArray(h5f, path, block[4])
+            nodes[path].expected_rows = block[5]
+        nodes[path].set_labels(block[2])
+        nodes[path].load(block[3])
+    else:
+        raise Exception('Unknown block type: %s' % kind)
+    nodes[path].write()
@@ -0,0 +1,85 @@
+""" Fingerprints of stored results.
+
+The fingerprint of a stored path is a hash of everything its results depend
+on: the topology and trajectory files of the analyzed and of the reference
+Universe, the frame selection and the class and constructor arguments of the
+processor. Trajectory files are identified by their size, modification time
+and a checksum of a few sampled blocks, so they are never read completely.
+Analysis.run(reuse=True) skips the nodes whose stored fingerprints match.
+"""
+import os
+import hashlib
+
+import numpy
+
+from batcha.coordinates import atom_indices
+
+# number and size (bytes) of the blocks of a trajectory file in its checksum
+SAMPLES = 16
+SAMPLE_SIZE = 4096
+
+def file_identity(filename, samples=SAMPLES, sample_size=SAMPLE_SIZE):
+    """ Returns (size, mtime, checksum) of a file, the checksum covers samples
+    evenly spaced blocks of sample_size bytes and the last block.
+    """
+    size = os.path.getsize(filename)
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        offsets = [ size*i/samples for i in xrange(samples) ] + [ max(size - sample_size, 0) ]
+        for offset in offsets:
+            f.seek(offset)
+            h.update(f.read(sample_size))
+    return (size, int(os.path.getmtime(filename)), h.hexdigest())
+
+def topology_hash(universe):
+    """ Returns the hash of the topology file of a Universe (or of its atoms without a file) """
+    h = hashlib.sha1()
+    filename = getattr(universe, 'filename', None)
+    if filename and os.path.isfile(filename):
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), ''):
+                h.update(block)
+    else:
+        for a in universe.atoms:
+            h.update('%s %s %s %s\n' % (a.segid, a.resid, a.resname, a.name))
+    return h.hexdigest()
+
+def trajectory_identity(universe):
+    """ Returns the identity of the trajectory file of a Universe (its number of frames without a file) """
+    trajectory = universe.trajectory
+    filename = getattr(trajectory, 'filename', None)
+    if filename and os.path.isfile(filename):
+        return file_identity(filename)
+    return trajectory.numframes
+
+def describe(value):
+    """ Returns a hashable description of a value: numbers, strings and their
+    containers as they are, arrays by their checksum and atoms by their indices.
+    Other objects (e.g. caches) are only described by their class.
+    """
+    if value is None or isinstance(value, (bool, int, long, float, basestring)):
+        return value
+    if isinstance(value, numpy.generic):
+        return value.item()
+    if isinstance(value, numpy.ndarray):
+        return ('array', str(value.dtype), value.shape, hashlib.sha1(numpy.ascontiguousarray(value).tostring()).hexdigest())
+    if isinstance(value, (list, tuple)):
+        return tuple([ describe(v) for v in value ])
+    if isinstance(value, dict):
+        return tuple(sorted([ (str(k), describe(v)) for k, v in value.items() ]))
+    if hasattr(value, 'atoms'):
+        return ('atoms', tuple(atom_indices(value).tolist()))
+    if hasattr(value, 'number'):
+        return ('atom', value.number)
+    return ('object', value.__class__.__name__)
+
+def processor_description(processor):
+    """ Returns the description of a processor or timeseries: its class and the
+    attributes set by its constructor (call it before the processor is prepared).
+    """
+    cls = processor.__class__
+    return (cls.__module__, cls.__name__, describe(getattr(processor, '__dict__', {})))
+
+def fingerprint(*parts):
+    """ Returns the hex digest of the descriptions of parts """
+    return hashlib.sha1(repr(describe(parts))).hexdigest()
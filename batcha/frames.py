@@ -0,0 +1,65 @@
+""" Frame selection for Analysis.run.
+
+A run processes a list of 0-based frame indices, either a start/stop/step
+range or an explicit list. The trajectory is positioned on the selected
+frames directly so skipped frames are never decoded.
+"""
+import numpy
+
+def select_frames(numframes, start=None, stop=None, step=None, frames=None):
+    """ Returns the array of frame indices selected by start/stop/step (like a
+    slice of range(numframes)) or by an explicit list of frame indices.
+    """
+    if frames is not None:
+        if start is not None or stop is not None or step is not None:
+            raise Exception('Give either a frame list or start/stop/step, not both')
+        indices = numpy.array(frames, dtype=numpy.int64).ravel()
+        indices[indices < 0] += numframes
+        if numpy.any(indices < 0) or numpy.any(indices >= numframes):
+            raise Exception('Frame indices out of range for a trajectory with %d frames' % numframes)
+        return indices
+    if step is not None and step <= 0:
+        raise Exception('step must be positive')
+    return numpy.arange(*slice(start, stop, step).indices(numframes), dtype=numpy.int64)
+
+def regular_step(indices):
+    """ Returns the step of an increasing evenly spaced frame list or None """
+    if len(indices) == 0:
+        return None
+    if len(indices) == 1:
+        return 1
+    steps = numpy.diff(indices)
+    if steps[0] > 0 and numpy.all(steps == steps[0]):
+        return int(steps[0])
+    return None
+
+def iter_frames(trajectory, indices):
+    """ Yields (index, Timestep) for every frame in indices, seeking to each one.
+    Frames are decoded lazily and the Timestep is reused by the reader.
+    """
+    step = regular_step(indices)
+    if step is not None and indices[0] == 0 and step == 1 and len(indices) == trajectory.numframes:
+        # the whole trajectory is read sequentially
+        frames = iter(trajectory)
+    elif step is not None:
+        frames = iter(trajectory[int(indices[0]):int(indices[-1])+1:step])
+    else:
+        frames = ( trajectory[int(i)] for i in indices )
+    for i in indices:
+        yield (i, frames.next())
+
+def start_time(trajectory):
+    """ Returns the time of the first frame of the trajectory (0 if the reader
+    has no frame times). The trajectory is rewound.
+    """
+    trajectory.rewind()
+    return float(getattr(trajectory.ts, 'time', 0.0))
+
+def frame_times(trajectory, indices, start=0.0):
+    """ Returns the times of the frame indices: the time start of the first
+    frame plus index times the time step of the trajectory.
+    """
+    dt = getattr(trajectory, 'dt', None)
+    if dt is None:
+        return numpy.repeat(numpy.nan, len(indices))
+    return start + indices*float(dt)
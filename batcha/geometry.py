@@ -0,0 +1,98 @@
+""" Vectorized geometry kernels shared by the analysis modules. """
+import numpy
+
+def cylinder_coordinates(points, a, b, height):
+    """ Cylinder coordinates of an (M, 3) array of points for the axis a -> b.
+
+    Returns two (M,) arrays: the distance of every point to the axis and its
+    offset along the axis measured from a. The offset is negative for points
+    further than height away from b (behind a).
+    """
+    pa = points - a
+    pb = points - b
+    distance_to_vector = numpy.sqrt(numpy.sum(numpy.cross(pa, pb)**2, axis=1))/height
+    distance_to_a = numpy.sqrt(numpy.sum(pa*pa, axis=1))
+    distance_to_b = numpy.sqrt(numpy.sum(pb*pb, axis=1))
+    cylinder_offset = numpy.sqrt(numpy.maximum(distance_to_a**2 - distance_to_vector**2, 0.0))
+    cylinder_offset[distance_to_b > height] *= -1
+    return distance_to_vector, cylinder_offset
+
+_IMAGE_SHIFTS = numpy.array([ (i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1) ], dtype=numpy.float64)
+
+def box_matrix(dimensions):
+    """ Returns the 3x3 matrix of box vectors (rows) for the unit cell
+    [a, b, c, alpha, beta, gamma] or None if the cell is not defined.
+    """
+    a, b, c, alpha, beta, gamma = [ float(x) for x in dimensions[:6] ]
+    if a <= 0 or b <= 0 or c <= 0:
+        return None
+    cosines = numpy.cos(numpy.radians([alpha, beta, gamma]))
+    # right angles give exactly orthorhombic boxes
+    cosines[numpy.abs(cosines) < 1e-8] = 0.0
+    (cos_alpha, cos_beta, cos_gamma) = cosines
+    sin_gamma = numpy.sqrt(1.0 - cos_gamma**2)
+    cx = c*cos_beta
+    cy = c*(cos_alpha - cos_beta*cos_gamma)/sin_gamma
+    return numpy.array([[a, 0.0, 0.0],
+                        [b*cos_gamma, b*sin_gamma, 0.0],
+                        [cx, cy, numpy.sqrt(max(c*c - cx*cx - cy*cy, 0.0))]])
+
+def unit_cell(ts):
+    """ Returns the box matrix of the unit cell of the Timestep ts or None """
+    return box_matrix(ts.dimensions)
+
+def minimum_image(d, box):
+    """ Apply the minimum image convention to an (..., 3) array of difference vectors.
+
+    box is a 3x3 box matrix (see box_matrix) or None for no periodic boundaries.
+    For triclinic boxes the vectors are wrapped in fractional coordinates and
+    the shortest of the 27 surrounding images is taken.
+    """
+    d = numpy.asarray(d, dtype=numpy.float64)
+    if box is None:
+        return d
+    if numpy.count_nonzero(box - numpy.diag(numpy.diag(box))) == 0:
+        lengths = numpy.diag(box)
+        return d - lengths*numpy.round(d/lengths)
+    s = numpy.dot(d, numpy.linalg.inv(box))
+    s -= numpy.round(s)
+    d = numpy.dot(s, box)
+    images = d[...,numpy.newaxis,:] + numpy.dot(_IMAGE_SHIFTS, box)
+    shortest = numpy.argmin(numpy.sum(images*images, axis=-1), axis=-1)
+    return numpy.take_along_axis(images, shortest[...,numpy.newaxis,numpy.newaxis], axis=-2)[...,0,:]
+
+def distances(a, b, box=None):
+    """ Minimum image distances between the points (or (..., 3) arrays) a and b """
+    d = minimum_image(numpy.asarray(b) - numpy.asarray(a), box)
+    return numpy.sqrt(numpy.sum(d*d, axis=-1))
+
+def center_of_mass(pos, masses, box=None):
+    """ Mass weighted center of the (N, 3) positions.
+
+    With a box the atoms are first made whole around the first atom, so groups
+    split over the periodic boundary get the right center.
+    """
+    pos = numpy.asarray(pos, dtype=numpy.float64)
+    if box is not None:
+        pos = pos[0] + minimum_image(pos - pos[0], box)
+    return numpy.dot(masses, pos)/masses.sum()
+
+def group_centers(pos, groups, masses, box=None):
+    """ Mass weighted centers of groups of atoms.
+
+    pos are the (N, 3) positions, groups the group index of every atom and
+    masses the (N,) atom masses. With a box every group is made whole around
+    its first atom. Returns a (G, 3) array.
+    """
+    pos = numpy.asarray(pos, dtype=numpy.float64)
+    num_groups = groups.max() + 1 if len(groups) else 0
+    if box is not None:
+        first = numpy.zeros(num_groups, dtype=numpy.intp)
+        first[groups[::-1]] = numpy.arange(len(groups))[::-1]
+        anchor = pos[first][groups]
+        pos = anchor + minimum_image(pos - anchor, box)
+    group_masses = numpy.bincount(groups, weights=masses, minlength=num_groups)
+    centers = numpy.empty((num_groups, 3))
+    for k in range(3):
+        centers[:,k] = numpy.bincount(groups, weights=masses*pos[:,k], minlength=num_groups)
+    return centers/group_masses[:,numpy.newaxis]
@@ -0,0 +1,84 @@
+""" Run instrumentation: where the time of an Analysis run goes.
+
+RunProfile records the time spent waiting for the trajectory to decode each
+frame and the bytes read meanwhile, the cumulative time of every processor
+and the time spent writing.
+The report is a plain dict which is returned by Analysis.run and can be
+stored in the HDF5 file as JSON.
+"""
+import time
+import resource
+
+def peak_memory():
+    """ Returns the peak resident memory of this process in kB (Linux units) """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def bytes_read():
+    """ Returns the bytes read by this process so far (rchar of /proc/self/io,
+    page cache hits included) or None where it is not available.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+class RunProfile(object):
+
+    def __init__(self):
+        self.frames = 0
+        self.read_time = 0.0
+        # None if the bytes read can not be measured
+        self.bytes_read = 0 if bytes_read() is not None else None
+        self.write_time = 0.0
+        self.processor_time = {}
+
+    def timed_frames(self, frame_iter):
+        """ Yields the items of frame_iter adding the time spent decoding them to
+        read_time and the bytes read meanwhile to bytes_read.
+        """
+        it = iter(frame_iter)
+        while True:
+            t = time.time()
+            r = bytes_read() if self.bytes_read is not None else None
+            try:
+                item = it.next()
+            except StopIteration:
+                return
+            self.read_time += time.time() - t
+            if r is not None:
+                self.bytes_read += bytes_read() - r
+            self.frames += 1
+            yield item
+
+    def process(self, path, processor, ts):
+        t = time.time()
+        processor.process(ts)
+        self.processor_time[path] = self.processor_time.get(path, 0.0) + time.time() - t
+
+    def add(self, other):
+        """ Add the times of another profile (e.g. of a parallel worker) """
+        self.frames += other.frames
+        self.read_time += other.read_time
+        if self.bytes_read is not None and other.bytes_read is not None:
+            self.bytes_read += other.bytes_read
+        else:
+            self.bytes_read = None
+        self.write_time += other.write_time
+        for path, t in other.processor_time.items():
+            self.processor_time[path] = self.processor_time.get(path, 0.0) + t
+
+    def report(self):
+        processors = {}
+        for path, t in self.processor_time.items():
+            processors[path] = { 'total_time': t, 'time_per_frame': t/self.frames if self.frames else 0.0 }
+        return { 'frames': self.frames,
+                 'read_time': self.read_time,
+                 'bytes_read': self.bytes_read,
+                 'process_time': sum(self.processor_time.values()),
+                 'write_time': self.write_time,
+                 'processors': processors,
+                 'peak_memory_kb': peak_memory() }
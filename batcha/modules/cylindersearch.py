@@ -1,16 +1,58 @@
 import numpy
 from numpy.linalg import norm
 
-import MDAnalysis.KDTree.NeighborSearch as NS
+from batcha.cache import NO_CACHE
+from batcha.geometry import cylinder_coordinates, group_centers, minimum_image, unit_cell
+from batcha.coordinates import CoordinateView
 
 import logging
 logger = logging.getLogger('cylindersearch')
 
+def search_groups(atom_group, level='R'):
+    """ Map the atoms of atom_group onto residues (level R) or atoms (level A).
+    
+    Returns a list of group labels, an array with the group index of every atom
+    and the residues of the groups (None for atoms).
+    """
+    labels = []
+    groups = []
+    residues = []
+    keys = {}
+    for a in atom_group.atoms:
+        if level == 'R':
+            # a residue is identified by its first atom, resids can repeat
+            key = a.residue.atoms[0].number
+            if key not in keys:
+                keys[key] = len(labels)
+                labels.append('%s:%s' % (a.resname, a.resid))
+                residues.append(a.residue)
+            groups.append(keys[key])
+        else:
+            groups.append(len(labels))
+            labels.append('%s:%s:%s' % (a.resname, a.resid, a.name))
+    return labels, numpy.array(groups, dtype=numpy.intp), (residues if level == 'R' else None)
+
+def residue_atoms(residues):
+    """ Returns the indices, group index and masses of all the atoms of residues,
+    so centers of mass cover whole residues even if only some atoms are selected.
+    """
+    indices = []
+    groups = []
+    masses = []
+    for i, r in enumerate(residues):
+        for a in r.atoms:
+            indices.append(a.number)
+            groups.append(i)
+            masses.append(a.mass)
+    return numpy.array(indices, dtype=numpy.intp), numpy.array(groups, dtype=numpy.intp), numpy.array(masses)
+
 class CylinderSearch(object):
     """ Count nearby residues of a given type from a given residue selection
     """
+    result_dtype = numpy.dtype([('residue', numpy.int32), ('offset', numpy.float32)])
+    frame_cache = NO_CACHE
     
-    def __init__(self, a, b, search, radius=10.0, extension=0.0, level='R', update_selections=True):
+    def __init__(self, a, b, search, radius=10.0, extension=0.0, level='R', update_selections=True, pbc=False):
         """Calculate hydrogen bonds between two selections.
 
         :Arguments:
@@ -28,8 +70,12 @@ class CylinderSearch(object):
             R or A (Residue or Atom) for searching. Residues' center of mass are used to calculate distances.
           *update_selections*
             Update selections for points A and B at each frame
+          *pbc*
+            Use minimum image distances and centers of mass in the unit cell of each frame
             
         The timeseries accessible as the attribute :attr:`CylinderSearch.timeseries`.
+        Every frame is a structured array of (residue, offset) records where
+        residue indexes into :attr:`CylinderSearch.labels` (stored with the node).
         """
 
         self.selection_a = a
@@ -39,6 +85,7 @@ class CylinderSearch(object):
         self.extension = extension
         self.level = level
         self.update_selections = update_selections
+        self.pbc = pbc
     
     def run(self, trj):
         """ Analyze trajectory and produce timeseries. """
@@ -53,45 +100,53 @@ class CylinderSearch(object):
         """ Prepare the trajectory (trj is a Universe object). No reference object is needed. """
         self.u = trj
         self.u.trajectory.rewind()
-        self.a_atomgroup = self.u.selectAtoms(self.selection_a)
-        self.b_atomgroup = self.u.selectAtoms(self.selection_b)
-        self.search_atomgroup = self.u.selectAtoms(self.selection_search)
+        self.a_atomgroup = self.frame_cache.select(self.u, self.selection_a)
+        self.b_atomgroup = self.frame_cache.select(self.u, self.selection_b)
+        self.search_atomgroup = self.frame_cache.select(self.u, self.selection_search)
+        # residue labels and the atom -> group map used for the mass weighted centers
+        self.labels, self._groups, residues = search_groups(self.search_atomgroup, self.level)
+        self._search_view = CoordinateView(self.search_atomgroup)
+        if residues is not None:
+            (indices, self._residue_groups, self._residue_masses) = residue_atoms(residues)
+            self._residue_view = CoordinateView(indices)
         self.timeseries = []  # final result
 
     def process(self, frame):
         """ Process a single trajectory frame """
         # atomgroup coordinates should update every frame
-        self.a = self.a_atomgroup.centerOfMass()
-        self.b = self.b_atomgroup.centerOfMass()
+        ts = self.u.trajectory.ts
+        box = unit_cell(ts) if self.pbc else None
+        self.a = self.frame_cache.center_of_mass(self.a_atomgroup, box)
+        self.b = self.a + minimum_image(self.frame_cache.center_of_mass(self.b_atomgroup, box) - self.a, box)
         self.midpoint = (self.a+self.b)/2.0
         self.height = norm(self.b-self.a)
         self.vector = self.b-self.a
         self.search_radius = self.height/2.0 + self.extension
         
-        # find all selection within r of A and B
-        self.ns = NS.AtomNeighborSearch(self.search_atomgroup)
-        near = set(self.ns.search(self.midpoint, self.search_radius, level=self.level))
-        res = []
-        for r in near:
-            if self.level == 'R':
-                point = r.centerOfMass() # center of mass of the found residue
-                name = '%s:%s' % (r.name, r.id)
-            else:
-                point = r.pos
-                name = '%s:%s:%s' % (r.resname, r.resid, r.name)
-            distance_to_vector = self._point_distance(point)
-            if distance_to_vector <= self.radius:
-                distance_to_a = norm(self.a-point)
-                distance_to_b = norm(self.b-point)
-                cylinder_offset = numpy.sqrt(distance_to_a**2-distance_to_vector**2)
-                if distance_to_b > self.height:
-                    cylinder_offset = -1*cylinder_offset
-                res.append((name, cylinder_offset))
-        self.timeseries.append(numpy.array(res))
+        # find all the groups with an atom within r of the midpoint
+        pos = self._search_view.get(ts)
+        d = minimum_image(pos - self.midpoint, box)
+        near = numpy.unique(self._groups[numpy.sum(d*d, axis=1) <= self.search_radius**2])
+        if self.level == 'R':
+            # center of mass of every (whole) residue
+            points = group_centers(self._residue_view.get(ts), self._residue_groups, self._residue_masses, box)[near]
+        else:
+            points = pos[near]
+        # the periodic images closest to the cylinder
+        points = self.midpoint + minimum_image(points - self.midpoint, box)
+        distance_to_vector, cylinder_offset = cylinder_coordinates(points, self.a, self.b, self.height)
+        inside = distance_to_vector <= self.radius
+        res = numpy.empty(numpy.count_nonzero(inside), dtype=self.result_dtype)
+        res['residue'] = near[inside]
+        res['offset'] = cylinder_offset[inside]
+        self.timeseries.append(res)
 
     def results(self):
         """ Returns an array containing the total count of hbonds per frame """
         return self.timeseries
 
-    def _point_distance(self, point):
-        return norm(numpy.cross(point-self.a, point-self.b))/self.height
+    def drain(self):
+        """ Returns the results of the frames processed since the last drain and releases them """
+        res = self.results()
+        self.timeseries = []
+        return res
@@ -1,12 +1,19 @@
 import numpy
+import tables
+
+from batcha.cache import NO_CACHE
+from batcha.geometry import distances, group_centers, unit_cell
+from batcha.coordinates import atom_indices
+
 import logging
 logger = logging.getLogger('distance')
 
 class DistanceAnalysis(object):
     """ Calculate distance between two selections
     """
+    frame_cache = NO_CACHE
     
-    def __init__(self, selection1, selection2):
+    def __init__(self, selection1, selection2, pbc=False):
         """Calculate distance between two selections.
 
         :Arguments:
@@ -14,12 +21,15 @@ class DistanceAnalysis(object):
             Selection string for first selection
           *selection2*
             Selection string for second selection
+          *pbc*
+            Use the minimum image distance between the centers of mass in the unit cell of each frame
             
         The timeseries accessible as the attribute :attr:`DistanceAnalysis.timeseries`.
         """
 
         self.selection1 = selection1
         self.selection2 = selection2
+        self.pbc = pbc
         
         if not (self.selection1 and self.selection2):
             raise Exception('DistanceAnalysis: invalid selections')
@@ -42,8 +52,8 @@ class DistanceAnalysis(object):
 
     def process(self, frame):
         """ Process a single trajectory frame """
-        r = self._s1.centerOfMass() - self._s2.centerOfMass()
-        d = numpy.sqrt(numpy.sum(r*r))
+        box = unit_cell(self.u.trajectory.ts) if self.pbc else None
+        d = distances(self.frame_cache.center_of_mass(self._s1, box), self.frame_cache.center_of_mass(self._s2, box), box)
         self.timeseries.append(d)
         return d 
 
@@ -51,7 +61,101 @@ class DistanceAnalysis(object):
         """ Returns an array containing the total count of nearby atoms """
         return self.timeseries
 
+    def drain(self):
+        """ Returns the results of the frames processed since the last drain and releases them """
+        res = self.results()
+        self.timeseries = []
+        return res
+
     def _update_selections(self):
-        self._s1 = self.u.selectAtoms(self.selection1)
-        self._s2 = self.u.selectAtoms(self.selection2)
+        self._s1 = self.frame_cache.select(self.u, self.selection1)
+        self._s2 = self.frame_cache.select(self.u, self.selection2)
+
+class MultiDistanceAnalysis(object):
+    """ Calculate the distances between the centers of mass of many pairs of selections
+    
+    Every selection is a group of entries in a sparse (COO) mass weighting matrix
+    built in prepare. Each frame computes all group centers with one weighted
+    reduction over the gathered coordinates and all pair distances with one
+    vectorized call, and yields one float32 array with a distance per pair.
+    The rows are stored in the table column of column_format(), the pair
+    labels are stored with the node.
+    """
+    frame_cache = NO_CACHE
+    labels = None
+    
+    def __init__(self, pairs, pbc=False):
+        """Calculate distances between pairs of selections.
+
+        :Arguments:
+          *pairs*
+            List of (selection1, selection2) selection string tuples
+          *pbc*
+            Use minimum image distances between the centers of mass in the unit cell of each frame
+            
+        The timeseries accessible as the attribute :attr:`MultiDistanceAnalysis.timeseries`.
+        """
+
+        self.pairs = list(pairs)
+        self.pbc = pbc
+        
+        if len(self.pairs) == 0 or not all([ s1 and s2 for (s1, s2) in self.pairs ]):
+            raise Exception('MultiDistanceAnalysis: invalid selections')
+
+    def run(self, trj):
+        """ Analyze trajectory and produce timeseries. """
+        self.timeseries = []
+        self.prepare(trj=trj)
+        for ts in self.u.trajectory:
+            logger.debug("Analyzing frame %d" % ts.frame)
+            self.process(ts.frame)
+        return self.timeseries
+
+    def prepare(self, ref=None, trj=None):
+        """ Prepare the trajectory (trj is a Universe object). No reference object is needed. """
+        self.u = trj
+        self.u.trajectory.rewind()
+        # every distinct selection string is one group
+        groups = {}
+        atoms = []
+        entry_groups = []
+        masses = []
+        for selection in [ s for pair in self.pairs for s in pair ]:
+            if selection in groups:
+                continue
+            groups[selection] = len(groups)
+            ag = self.frame_cache.select(self.u, selection)
+            atoms.append(atom_indices(ag))
+            masses.append(ag.masses())
+            entry_groups.append(numpy.repeat(groups[selection], len(ag)))
+        self._atoms = numpy.concatenate(atoms)
+        self._pos = numpy.empty((len(self._atoms), 3), dtype=numpy.float32)
+        self._masses = numpy.concatenate(masses)
+        self._entry_groups = numpy.concatenate(entry_groups)
+        self._pair_groups = numpy.array([ (groups[s1], groups[s2]) for (s1, s2) in self.pairs ], dtype=numpy.intp)
+        self.labels = [ '%s - %s' % (s1, s2) for (s1, s2) in self.pairs ]
+        self.timeseries = []  # final result
 
+    def process(self, frame):
+        """ Process a single trajectory frame """
+        ts = self.u.trajectory.ts
+        box = unit_cell(ts) if self.pbc else None
+        numpy.take(ts._pos, self._atoms, axis=0, out=self._pos)
+        centers = group_centers(self._pos, self._entry_groups, self._masses, box)
+        d = distances(centers[self._pair_groups[:,0]], centers[self._pair_groups[:,1]], box).astype(numpy.float32)
+        self.timeseries.append(d)
+        return d
+
+    def column_format(self):
+        """ Returns the table column of a row of pair distances """
+        return tables.Float32Col(shape=(len(self.pairs),))
+
+    def results(self):
+        """ Returns one array with the distance of every pair per frame """
+        return self.timeseries
+
+    def drain(self):
+        """ Returns the results of the frames processed since the last drain and releases them """
+        res = self.results()
+        self.timeseries = []
+        return res
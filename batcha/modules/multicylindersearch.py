@@ -1,15 +1,25 @@
 import numpy
 from numpy.linalg import norm
-import MDAnalysis.KDTree.NeighborSearch as NS
+
+from batcha.cache import NO_CACHE
+from batcha.geometry import cylinder_coordinates, group_centers, minimum_image, unit_cell
+from batcha.modules.cylindersearch import search_groups, residue_atoms
+from batcha.coordinates import CoordinateView
+from batcha.neighbors import GridEngine
 
 import logging
 logger = logging.getLogger('multicylindersearch')
 
+# smallest cell (A) of the per frame cell list, short paths would otherwise need very many cells
+MIN_CELL_SIZE = 4.0
+
 class MultiCylinderSearch(object):
     """ Count nearby residues of a given type from a given residue selection
     """
+    result_dtype = numpy.dtype([('residue', numpy.int32), ('path', numpy.int32), ('offset', numpy.float32)])
+    frame_cache = NO_CACHE
     
-    def __init__(self, paths, search, radius=10.0, extension=0.0, level='R', update_selections=True):
+    def __init__(self, paths, search, radius=10.0, extension=0.0, level='R', update_selections=True, pbc=False):
         """Calculate hydrogen bonds between two selections.
 
         :Arguments:
@@ -25,8 +35,12 @@ class MultiCylinderSearch(object):
             R or A (Residue or Atom) for searching. Residues' center of mass are used to calculate distances.
           *update_selections*
             Update selections for points A and B at each frame
+          *pbc*
+            Use minimum image distances and centers of mass in the unit cell of each frame
             
         The timeseries accessible as the attribute :attr:`CylinderSearch.timeseries`.
+        Every frame is a structured array of (residue, path, offset) records where
+        residue indexes into :attr:`MultiCylinderSearch.labels` (stored with the node).
         """
 
         self.paths = paths
@@ -35,6 +49,7 @@ class MultiCylinderSearch(object):
         self.extension = extension
         self.level = level
         self.update_selections = update_selections
+        self.pbc = pbc
     
     def run(self, trj):
         """ Analyze trajectory and produce timeseries. """
@@ -49,55 +64,71 @@ class MultiCylinderSearch(object):
         """ Prepare the trajectory (trj is a Universe object). No reference object is needed. """
         self.u = trj
         self.u.trajectory.rewind()
-        self.path_selections = [ (self.u.selectAtoms(a), self.u.selectAtoms(b)) for (a,b) in self.paths ]
-        self.search_atomgroup = self.u.selectAtoms(self.selection_search)
+        self.path_selections = [ (self.frame_cache.select(self.u, a), self.frame_cache.select(self.u, b)) for (a,b) in self.paths ]
+        self.search_atomgroup = self.frame_cache.select(self.u, self.selection_search)
+        self.labels, self._groups, residues = search_groups(self.search_atomgroup, self.level)
+        # one cell list of the searchable atoms per frame, shared by all the paths
+        self._engine = GridEngine(self.search_atomgroup, pbc=self.pbc)
+        if residues is not None:
+            (indices, self._residue_groups, self._residue_masses) = residue_atoms(residues)
+            self._residue_view = CoordinateView(indices)
         self.timeseries = []  # final result
 
     def process(self, frame):
         """ Process a single trajectory frame """
         # atomgroup coordinates should update every frame
+        ts = self.u.trajectory.ts
+        box = unit_cell(ts) if self.pbc else None
         results = []
-        seen_residues = []
+        seen_residues = numpy.zeros(len(self.labels), dtype=bool)
         
-        # for each defined path
-        for path_index, (sel_a, sel_b) in enumerate(self.path_selections):
-            a = sel_a.centerOfMass()
-            b = sel_b.centerOfMass()
-            midpoint = (a+b)/2.0
+        # search positions and residue centers are computed once per frame for all the paths
+        if self.level == 'R':
+            centers = group_centers(self._residue_view.get(ts), self._residue_groups, self._residue_masses, box)
+        else:
+            centers = self._engine.positions(ts)
+        
+        cylinders = []
+        for sel_a, sel_b in self.path_selections:
+            a = self.frame_cache.center_of_mass(sel_a, box)
+            b = a + minimum_image(self.frame_cache.center_of_mass(sel_b, box) - a, box)
             height = norm(b-a)
-            search_radius = height/2.0 + self.extension
+            cylinders.append((a, b, (a+b)/2.0, height, height/2.0 + self.extension))
+        if len(cylinders) == 0:
+            self.timeseries.append(numpy.empty(0, dtype=self.result_dtype))
+            return
+        # cells as wide as the largest search sphere so every path can query the same index
+        cell_list = self._engine.cell_list(ts, max(max([ c[4] for c in cylinders ]), MIN_CELL_SIZE))
         
-            # find all selection within r of A and B
-            ns = NS.AtomNeighborSearch(self.search_atomgroup)
-            near = set(ns.search(midpoint, search_radius, level=self.level))
-            for r in near:
-                if self.level == 'R':
-                    point = r.centerOfMass() # center of mass of the found residue
-                    name = '%s:%s' % (r.name, r.id)
-                else:
-                    point = r.pos
-                    name = '%s:%s:%s' % (r.resname, r.resid, r.name)
-                
-                # skip residues we have seen already
-                if name in seen_residues:
-                    continue
-                                
-                distance_to_vector = self._point_distance(a, b, height, point)
-                # if the distance to vector is within the radius
-                if distance_to_vector <= self.radius:
-                    distance_to_a = norm(a-point)
-                    distance_to_b = norm(b-point)
-                    # calculate the cylinder offset
-                    cylinder_offset = numpy.sqrt(distance_to_a**2-distance_to_vector**2)
-                    if distance_to_b > height:
-                        cylinder_offset = -1*cylinder_offset
-                    # add the result to the current path result array
-                    results.append((name, path_index, cylinder_offset))
-        self.timeseries.append(numpy.array(results))
+        # for each defined path
+        for path_index, (a, b, midpoint, height, search_radius) in enumerate(cylinders):
+            # find all the groups with an atom within r of the midpoint, skip the ones we have seen already
+            near = numpy.unique(self._groups[cell_list.search(midpoint, search_radius)])
+            near = near[~seen_residues[near]]
+            if len(near) == 0:
+                continue
+            
+            points = midpoint + minimum_image(centers[near] - midpoint, box)
+            distance_to_vector, cylinder_offset = cylinder_coordinates(points, a, b, height)
+            # keep the candidates within the radius of the cylinder
+            inside = distance_to_vector <= self.radius
+            seen_residues[near[inside]] = True
+            res = numpy.empty(numpy.count_nonzero(inside), dtype=self.result_dtype)
+            res['residue'] = near[inside]
+            res['path'] = path_index
+            res['offset'] = cylinder_offset[inside]
+            results.append(res)
+        if len(results) > 0:
+            self.timeseries.append(numpy.concatenate(results))
+        else:
+            self.timeseries.append(numpy.empty(0, dtype=self.result_dtype))
 
     def results(self):
         """ Returns an array containing the total count of hbonds per frame """
         return self.timeseries
 
-    def _point_distance(self, a, b, height, point):
-        return norm(numpy.cross(point-a, point-b))/height
+    def drain(self):
+        """ Returns the results of the frames processed since the last drain and releases them """
+        res = self.results()
+        self.timeseries = []
+        return res
@@ -7,14 +7,18 @@ from MDAnalysis.core.distances import self_distance_array
 from MDAnalysis.core.AtomGroup import AtomGroup
 import MDAnalysis.KDTree.NeighborSearch as NS
 
+from batcha.cache import NO_CACHE
+from batcha.neighbors import neighbor_engine
+
 import logging
 logger = logging.getLogger('nearbycount')
 
 class NearbyCountAnalysis(object):
     """ Count nearby residues of a given type from a given residue selection
     """
+    frame_cache = NO_CACHE
     
-    def __init__(self, selection1='protein', selection2='all', cutoff=3.0):
+    def __init__(self, selection1='protein', selection2='all', cutoff=3.0, engine=None, pbc=False):
         """Calculate hydrogen bonds between two selections.
 
         :Arguments:
@@ -24,6 +28,11 @@ class NearbyCountAnalysis(object):
             Selection string for second selection
           *cutoff*
             Distance cutoff
+          *engine*
+            Neighbor search backend: 'kdtree' (MDAnalysis KD-tree) or 'grid' (NumPy cell list),
+            by default 'grid' with pbc and 'kdtree' without
+          *pbc*
+            Use minimum image distances in the unit cell of each frame (not supported by 'kdtree')
             
         The timeseries accessible as the attribute :attr:`NearbyCountAnalysis.timeseries`.
         """
@@ -31,6 +40,8 @@ class NearbyCountAnalysis(object):
         self.selection1 = selection1
         self.selection2 = selection2
         self.cutoff = cutoff
+        self.engine = engine
+        self.pbc = pbc
         
         if not (self.selection1 and self.selection2):
             raise Exception('NearbyCountAnalysis: invalid selections')
@@ -53,8 +64,7 @@ class NearbyCountAnalysis(object):
 
     def process(self, frame):
         """ Process a single trajectory frame """
-        self._s2_ns = NS.AtomNeighborSearch(self._s2)
-        res = self._s2_ns.search_list(self._s1, self.cutoff)
+        res = self._engine.search(self._s1, self.u.trajectory.ts, self.cutoff)
         logger.debug("Got %d nearby" % len(res))
         self.timeseries.append(res)
         return res
@@ -63,16 +73,24 @@ class NearbyCountAnalysis(object):
         """ Returns an array containing the total count of nearby atoms """
         return [ len(f) for f in self.timeseries ]
 
+    def drain(self):
+        """ Returns the results of the frames processed since the last drain and releases them """
+        res = self.results()
+        self.timeseries = []
+        return res
+
     def _update_selections(self):
-        self._s1 = self.u.selectAtoms(self.selection1)
-        self._s2 = self.u.selectAtoms(self.selection2)
+        self._s1 = self.frame_cache.select(self.u, self.selection1)
+        self._s2 = self.frame_cache.select(self.u, self.selection2)
+        self._engine = neighbor_engine(self.engine, self._s2, pbc=self.pbc)
 
 class NearbyListAnalysis(object):
     """ Count nearby residues of a given type from a given residue selection
         returns a list of found atoms or residues.
     """
+    frame_cache = NO_CACHE
 
-    def __init__(self, selection1='protein', selection2='all', cutoff=3.0):
+    def __init__(self, selection1='protein', selection2='all', cutoff=3.0, engine=None, pbc=False):
         """Calculate hydrogen bonds between two selections.
 
         :Arguments:
@@ -82,6 +100,11 @@ class NearbyListAnalysis(object):
             Selection string for second selection
           *cutoff*
             Distance cutoff
+          *engine*
+            Neighbor search backend: 'kdtree' (MDAnalysis KD-tree) or 'grid' (NumPy cell list),
+            by default 'grid' with pbc and 'kdtree' without
+          *pbc*
+            Use minimum image distances in the unit cell of each frame (not supported by 'kdtree')
 
         The timeseries accessible as the attribute :attr:`NearbyCountAnalysis.timeseries`.
         """
@@ -89,6 +112,8 @@ class NearbyListAnalysis(object):
         self.selection1 = selection1
         self.selection2 = selection2
         self.cutoff = cutoff
+        self.engine = engine
+        self.pbc = pbc
 
         if not (self.selection1 and self.selection2):
             raise Exception('NearbyCountAnalysis: invalid selections')
@@ -111,16 +136,22 @@ class NearbyListAnalysis(object):
 
     def process(self, frame):
         """ Process a single trajectory frame """
-        self._s2_ns = NS.AtomNeighborSearch(self._s2)
-        res = self._s2_ns.search_list(self._s1, self.cutoff)
+        res = self._engine.search(self._s1, self.u.trajectory.ts, self.cutoff)
         logger.debug("Got %d nearby" % len(res))
-        self.timeseries.append(numpy.array([ float(r.number) for r in res ]))
+        self.timeseries.append(res.astype(numpy.float64))
         return res
 
     def results(self):
         """ Returns an array containing the total count of nearby atoms """
         return self.timeseries
 
+    def drain(self):
+        """ Returns the results of the frames processed since the last drain and releases them """
+        res = self.results()
+        self.timeseries = []
+        return res
+
     def _update_selections(self):
-        self._s1 = self.u.selectAtoms(self.selection1)
-        self._s2 = self.u.selectAtoms(self.selection2)
+        self._s1 = self.frame_cache.select(self.u, self.selection1)
+        self._s2 = self.frame_cache.select(self.u, self.selection2)
+        self._engine = neighbor_engine(self.engine, self._s2, pbc=self.pbc)
@@ -5,6 +5,9 @@ import numpy.linalg
 from MDAnalysis import *
 from MDAnalysis.core.AtomGroup import Residue, AtomGroup
 import MDAnalysis.core.rms_fitting
+
+from batcha.cache import NO_CACHE
+from batcha.coordinates import CoordinateView, atom_indices
     
 class FrameData(object):
     atoms = None
@@ -16,42 +19,124 @@ class FrameData(object):
     def __init__(self, atom_group, allocate_only=False):
         self.atoms = atom_group
         if allocate_only:
-            self.coordinates = atom_group.coordinates().copy()
+            self.coordinates = numpy.empty((len(atom_group.atoms), 3), dtype=numpy.float32)
         else:
             self.masses = atom_group.masses()
             self.com = atom_group.centerOfMass().astype(numpy.float32)
             self.coordinates = atom_group.coordinates() - self.com
 
+def batch_rotations(fit_block, ref_coordinates, masses):
+    """ Optimal (Kabsch) rotations for a block of frames.
+    
+    fit_block is a (K, N, 3) array of fit group coordinates, ref_coordinates the
+    (N, 3) centered reference coordinates and masses the (N,) weights. Returns the
+    (K, 3) centers of mass and the (K, 3, 3) rotation matrices R so that
+    (fit_block[k] - com[k]) * R is the best mass weighted fit onto the reference.
+    """
+    w = masses / masses.sum()
+    com = numpy.einsum('knj,n->kj', fit_block, w)
+    X = fit_block - com[:,numpy.newaxis,:]
+    H = numpy.einsum('kni,n,nj->kij', X, masses.astype(numpy.float64), ref_coordinates.astype(numpy.float64))
+    U, S, Vt = numpy.linalg.svd(H)
+    # avoid reflections
+    d = numpy.sign(numpy.linalg.det(numpy.matmul(U, Vt)))
+    U[:,:,2] *= d[:,numpy.newaxis]
+    return com, numpy.matmul(U, Vt)
+
+def batch_rmsd(rmsd_block, ref_coordinates, com, R, ref_com):
+    """ RMSDs of a (K, M, 3) block of frames against the (M, 3) reference coordinates
+    after moving every frame k by -com[k], rotating it by R[k] and moving it by ref_com.
+    """
+    fitted = numpy.matmul(rmsd_block - com[:,numpy.newaxis,:], R) + ref_com
+    fitted -= ref_coordinates
+    return numpy.sqrt(numpy.einsum('kmj,kmj->k', fitted, fitted)/rmsd_block.shape[1])
+
 class RMSD(object):
+    """ RMSD of a selection after fitting the backbone onto the reference.
+    
+    By default every frame is fitted on its own and the whole Timestep is moved
+    onto the reference, so processors which run after this one see fitted
+    coordinates. With block_size=K the batched engine is used instead: the fit
+    and rmsd group coordinates of K frames are gathered into preallocated
+    (K, N, 3) float32 buffers and the rotations and RMSDs of the whole block are
+    computed with a few vectorized calls. The batched engine does not modify
+    the Timestep.
+    """
     _selection = None
     _rmsds = []
+    frame_cache = NO_CACHE
     
     def _rmsd(self, a,b):
         """Returns RMSD between two coordinate sets a and b."""
         return numpy.sqrt(numpy.sum(numpy.power(a-b,2))/a.shape[0])
     
-    def __init__(self, selection):
-        self._selection = selection    
+    def __init__(self, selection, block_size=None):
+        self._selection = selection
+        self._block_size = block_size
 
     def prepare(self, ref, trj):
-        ref_atoms = ref.selectAtoms(self._selection)
-        trj_atoms = trj.selectAtoms(self._selection)
-        self.fit_ref = FrameData(ref.selectAtoms('backbone'))
-        self.fit_trj = FrameData(trj.selectAtoms('backbone'))
+        ref_atoms = self.frame_cache.select(ref, self._selection)
+        trj_atoms = self.frame_cache.select(trj, self._selection)
+        self.fit_ref = FrameData(self.frame_cache.select(ref, 'backbone'))
+        self.fit_trj = FrameData(self.frame_cache.select(trj, 'backbone'))
         self.rmsd_ref = FrameData(ref_atoms)
         self.rmsd_trj = FrameData(trj_atoms, allocate_only=True)
+        self._rmsds = []
+        # zero-copy views of the fit and rmsd groups and buffers reused for every frame
+        self._fit_view = CoordinateView(self.fit_trj.atoms)
+        self._rmsd_view = CoordinateView(self.rmsd_trj.atoms)
+        self._rmsd_ref_coordinates = self.rmsd_ref.atoms.coordinates().astype(numpy.float32)
+        self._diff = numpy.empty_like(self._rmsd_ref_coordinates)
+        self._pos = numpy.empty((len(trj.atoms), 3), dtype=numpy.float32)
+        if self._block_size:
+            self._fit_idx = atom_indices(self.fit_trj.atoms)
+            self._rmsd_idx = atom_indices(self.rmsd_trj.atoms)
+            self._fit_block = numpy.empty((self._block_size, len(self._fit_idx), 3), dtype=numpy.float32)
+            self._rmsd_block = numpy.empty((self._block_size, len(self._rmsd_idx), 3), dtype=numpy.float32)
+            self._pending = 0
         # print "Done RMSD prepare."
         
     def process(self, ts):
         # print "RMSD Fitting Frame %5d" % (ts.frame) 
-        x_com = self.fit_trj.atoms.centerOfMass().astype(numpy.float32)
-        self.fit_trj.coordinates[:] = self.fit_trj.atoms.coordinates() - x_com
-        R = numpy.matrix(MDAnalysis.core.rms_fitting.rms_rotation_matrix(self.fit_trj.coordinates, self.fit_ref.coordinates, self.fit_ref.masses),dtype=numpy.float32)
+        if self._block_size:
+            return self._process_batched(ts)
+        x_com = self.frame_cache.center_of_mass(self.fit_trj.atoms).astype(numpy.float32)
+        numpy.subtract(self._fit_view.get(ts), x_com, out=self.fit_trj.coordinates)
+        R = numpy.asarray(MDAnalysis.core.rms_fitting.rms_rotation_matrix(self.fit_trj.coordinates, self.fit_ref.coordinates, self.fit_ref.masses),dtype=numpy.float32)
         ts._pos   -= x_com
-        ts._pos[:] = ts._pos * R
+        numpy.dot(ts._pos, R, out=self._pos)
+        ts._pos[:] = self._pos
         ts._pos   += self.fit_ref.com
-        self._rmsds.append(self._rmsd(self.rmsd_ref.atoms.coordinates(),self.rmsd_trj.atoms.coordinates()))
+        # the coordinates moved, cached centers and coordinates are stale
+        self.frame_cache.invalidate()
+        numpy.subtract(self._rmsd_view.get(ts), self._rmsd_ref_coordinates, out=self._diff)
+        self._rmsds.append(numpy.sqrt(numpy.einsum('ij,ij->', self._diff, self._diff)/len(self._diff)))
         # print self._rmsds[-1]
         
+    def _process_batched(self, ts):
+        k = self._pending
+        numpy.take(ts._pos, self._fit_idx, axis=0, out=self._fit_block[k])
+        numpy.take(ts._pos, self._rmsd_idx, axis=0, out=self._rmsd_block[k])
+        self._pending += 1
+        if self._pending == self._block_size:
+            self._flush_block()
+    
+    def _flush_block(self):
+        """ Compute the RMSDs of the frames gathered in the block buffers """
+        if not self._block_size or self._pending == 0:
+            return
+        k = self._pending
+        com, R = batch_rotations(self._fit_block[:k], self.fit_ref.coordinates, self.fit_ref.masses)
+        rmsds = batch_rmsd(self._rmsd_block[:k], self._rmsd_ref_coordinates, com, R, self.fit_ref.com)
+        self._rmsds += list(rmsds.astype(numpy.float32))
+        self._pending = 0
+    
     def results(self):
+        self._flush_block()
         return self._rmsds
+    
+    def drain(self):
+        self._flush_block()
+        rmsds = self._rmsds
+        self._rmsds = []
+        return rmsds
@@ -1,11 +1,13 @@
-from analysis import Analysis
-
 import numpy
 import numpy.linalg
+import tables
 from MDAnalysis import *
 from MDAnalysis.core.AtomGroup import Residue, AtomGroup
 import MDAnalysis.core.rms_fitting
 
+from batcha.cache import NO_CACHE
+from batcha.coordinates import atom_indices
+
 def get_residues_for_atoms(atoms):
     # Get all protein segments and residues
     residues = []
@@ -19,68 +21,97 @@ def get_residues_for_atoms(atoms):
         last_seg = a.segment.name
     return residues
 
-class RMSD(Analysis):
+class RMSD(object):
+    """ RMSDs of the backbone and of every protein residue after a backbone fit.
+    
+    The atom indices of all groups are concatenated once in prepare, together
+    with the offsets of the group boundaries, so every frame is computed with a
+    single squared difference pass and a numpy.add.reduceat. Each frame yields
+    one row of len(labels) RMSDs (the first one is the backbone), so the results
+    form a dense (frames x residues) array. In a table they are stored in one
+    column of column_format(), the labels are stored with the node.
+    """
     table_name = 'RMSD'
     description = 'RMSDs of backbone and all protein residues'
-    _data = {}
-    
-    def _rmsd(self, a,b):
-        """Returns RMSD between two coordinate sets a and b."""
-        return numpy.sqrt(numpy.sum(numpy.power(a-b,2))/a.shape[0])
+    labels = None
+    frame_cache = NO_CACHE
     
     def __init__(self):
-        pass
+        self._rmsds = []
     
     def prepare(self, ref, trj):
         print "Preparing RMSD ref and trj"
-        ref_residues = get_residues_for_atoms(ref.selectAtoms('protein'))
+        ref_residues = get_residues_for_atoms(self.frame_cache.select(ref, 'protein'))
         print "Found %d protein residues in ref." % len(ref_residues)
 
         print "Getting all residues in trj..."
-        trj_residues = get_residues_for_atoms(trj.selectAtoms('protein'))
+        trj_residues = get_residues_for_atoms(self.frame_cache.select(trj, 'protein'))
         print "Found %d protein residues in ref." % len(trj_residues)
         
         if len(ref_residues) != len(trj_residues):
             raise SelectionError("Number of residues is difference between reference (%d) and trajectory (%d)." % (len(ref_residues), len(trj_residues)))
         
         ref_trj_residues = zip(ref_residues, trj_residues)
-        ref_trj_residues.insert(0, (ref.selectAtoms('backbone'), trj.selectAtoms('backbone')))
+        ref_trj_residues.insert(0, (self.frame_cache.select(ref, 'backbone'), self.frame_cache.select(trj, 'backbone')))
         
-        for i, r in enumerate(ref_trj_residues):
-            ref_atoms = r[0]
-            trj_atoms = r[1]
-            
+        self.labels = []
+        indices = []
+        ref_coordinates = []
+        for i, (ref_atoms, trj_atoms) in enumerate(ref_trj_residues):
             if i == 0:
-                k = 'backbone'
+                self.labels.append('backbone')
             else:
-                k = '%s_%d_%s' % (ref_atoms.segment.name, ref_atoms.id, ref_atoms.name)
-            ref_com = ref_atoms.centerOfMass().astype(numpy.float32)
-            self._data[k] = {   'rmsds': [],
-                                'ref': {    'atoms': ref_atoms, 
-                                            'masses': ref_atoms.masses(), 
-                                            'com': ref_com, 
-                                            'coordinates': ref_atoms.coordinates() - ref_com,
-                                        },
-                                'trj': {    'atoms': trj_atoms,
-                                            'coordinates': trj_atoms.coordinates().copy(),
-                                        },
-                            }
-        print "Done RMSD prepare."
+                self.labels.append('%s_%d_%s' % (ref_atoms.segment.name, ref_atoms.id, ref_atoms.name))
+            indices.append(atom_indices(trj_atoms))
+            ref_coordinates.append(ref_atoms.coordinates())
         
+        counts = numpy.array([ len(idx) for idx in indices ])
+        self._indices = numpy.concatenate(indices)
+        self._offsets = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+        self._counts = counts.astype(numpy.float32)
+        self._ref_coordinates = numpy.concatenate(ref_coordinates).astype(numpy.float32)
+        # buffers reused for every frame
+        self._diff = numpy.empty_like(self._ref_coordinates)
+        self._sq = numpy.empty(len(self._indices), dtype=numpy.float32)
+        self._segments = numpy.empty(len(counts), dtype=numpy.float32)
+        self._pos = numpy.empty((len(trj.atoms), 3), dtype=numpy.float32)
+        
+        # backbone fit
+        self._fit_atoms = ref_trj_residues[0][1]
+        fit_ref = ref_trj_residues[0][0]
+        self._fit_masses = fit_ref.masses()
+        self._fit_com = fit_ref.centerOfMass().astype(numpy.float32)
+        self._fit_coordinates = fit_ref.coordinates() - self._fit_com
+        self._rmsds = []
+        print "Done RMSD prepare."
 
     def process(self, ts):
-        print "RMSD Fitting Frame %5d" % (ts.frame) 
-        
-        x_com = self._data['backbone']['trj']['atoms'].centerOfMass().astype(numpy.float32)
-        self._data['backbone']['trj']['coordinates'][:] = self._data['backbone']['trj']['atoms'].coordinates() - x_com
-        R = numpy.matrix(MDAnalysis.core.rms_fitting.rms_rotation_matrix(self._data['backbone']['trj']['coordinates'], self._data['backbone']['ref']['coordinates'], self._data['backbone']['ref']['masses']),dtype=numpy.float32)
+        x_com = self.frame_cache.center_of_mass(self._fit_atoms).astype(numpy.float32)
+        R = numpy.asarray(MDAnalysis.core.rms_fitting.rms_rotation_matrix(self.frame_cache.coordinates(self._fit_atoms) - x_com, self._fit_coordinates, self._fit_masses),dtype=numpy.float32)
         ts._pos   -= x_com
-        ts._pos[:] = ts._pos * R
-        ts._pos   += self._data['backbone']['ref']['com']
+        numpy.dot(ts._pos, R, out=self._pos)
+        ts._pos[:] = self._pos
+        ts._pos   += self._fit_com
+        # the coordinates moved, cached centers and coordinates are stale
+        self.frame_cache.invalidate()
         
-        for k, v in self._data.items():
-            rmsd = self._rmsd(v['ref']['atoms'].coordinates(),v['trj']['atoms'].coordinates())
-            v['rmsds'].append(rmsd)
+        numpy.take(ts._pos, self._indices, axis=0, out=self._diff)
+        self._diff -= self._ref_coordinates
+        numpy.einsum('ij,ij->i', self._diff, self._diff, out=self._sq)
+        numpy.add.reduceat(self._sq, self._offsets, out=self._segments)
+        self._segments /= self._counts
+        # the row is kept, so it is the only array allocated per frame
+        self._rmsds.append(numpy.sqrt(self._segments))
+
+    def column_format(self):
+        """ Returns the table column of a row of RMSDs (known after prepare) """
+        return tables.Float32Col(shape=(len(self.labels),))
 
     def results(self):
-        return [ (k, numpy.array(v['rmsds'])) for k,v in self._data.items() ]
+        """ Returns one array of len(labels) RMSDs per frame """
+        return self._rmsds
+    
+    def drain(self):
+        rmsds = self._rmsds
+        self._rmsds = []
+        return rmsds
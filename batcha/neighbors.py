@@ -0,0 +1,173 @@
+""" Pluggable neighbor search backends.
+
+An engine is created for the searchable atoms of a processor and returns the
+atom numbers of the searchable atoms within a cutoff of any query atom:
+
+    engine = neighbor_engine('grid', search_atoms)
+    numbers = engine.search(query_atoms, ts, cutoff)
+
+The 'kdtree' engine wraps the MDAnalysis KD-tree (rebuilt every frame). The
+'grid' engine is a NumPy cell list working directly on the coordinate array
+of the Timestep, with periodic (orthorhombic or triclinic) boxes if pbc is set.
+Its cell_list(ts, cell_size) can be built once per frame and searched for
+several query points and cutoffs.
+"""
+import itertools
+
+import numpy
+
+import MDAnalysis.KDTree.NeighborSearch as NS
+
+from batcha.geometry import minimum_image, unit_cell
+from batcha.coordinates import CoordinateView
+
+def _cell_offsets(ncells, periodic):
+    """ Neighbor cell offsets for every dimension (without duplicates in small periodic grids) """
+    offsets = []
+    for n in ncells:
+        if periodic:
+            offsets.append(sorted(set([ o % n for o in (-1, 0, 1) ])))
+        else:
+            offsets.append([-1, 0, 1])
+    return itertools.product(*offsets)
+
+class CellList(object):
+    """ Cell list over an (N, 3) array of coordinates, built once and searched
+    with any cutoff up to cell_size (e.g. for several queries per frame).
+
+    With box (a 3x3 box matrix, see geometry.box_matrix) the cells are laid
+    out in fractional coordinates of the (possibly triclinic) unit cell and
+    minimum image distances are used.
+    """
+
+    def __init__(self, coordinates, cell_size, box=None):
+        self.coordinates = numpy.asarray(coordinates, dtype=numpy.float64)
+        self.cell_size = cell_size
+        self.box = box
+        if len(self.coordinates) == 0:
+            return
+        if box is not None:
+            self._inverse = numpy.linalg.inv(box)
+            fractional = numpy.dot(self.coordinates, self._inverse)
+            fractional -= numpy.floor(fractional)
+            # perpendicular widths of the cell
+            volume = abs(numpy.linalg.det(box))
+            widths = volume/numpy.sqrt(numpy.sum(numpy.cross(box[[1,2,0]], box[[2,0,1]])**2, axis=1))
+        else:
+            self._origin = self.coordinates.min(axis=0)
+            widths = numpy.maximum(self.coordinates.max(axis=0) - self._origin, cell_size)
+            self._widths = widths
+            fractional = (self.coordinates - self._origin)/widths
+        # cells are at least cell_size wide so only the 27 surrounding cells need to be searched
+        self._ncells = numpy.maximum(numpy.floor(widths/cell_size).astype(numpy.intp), 1)
+        cells = numpy.ravel_multi_index(self._cell_of(fractional).T, self._ncells)
+        self._order = numpy.argsort(cells, kind='mergesort')
+        self._counts = numpy.bincount(cells, minlength=numpy.prod(self._ncells))
+        self._starts = numpy.cumsum(self._counts) - self._counts
+
+    def _cell_of(self, x):
+        # points outside a non periodic grid fall into its border cells
+        return numpy.clip(numpy.floor(x*self._ncells).astype(numpy.intp), 0, self._ncells - 1)
+
+    def _fractional(self, points):
+        if self.box is not None:
+            fractional = numpy.dot(points, self._inverse)
+            return fractional - numpy.floor(fractional)
+        return (points - self._origin)/self._widths
+
+    def search(self, points, cutoff=None):
+        """ Returns the sorted indices into coordinates of the atoms within cutoff
+        (by default cell_size) of any of the (M, 3) points.
+        """
+        cutoff = self.cell_size if cutoff is None else cutoff
+        if cutoff > self.cell_size:
+            raise Exception('The cutoff %g is larger than the cells of the cell list (%g)' % (cutoff, self.cell_size))
+        points = numpy.atleast_2d(numpy.asarray(points, dtype=numpy.float64))
+        if len(points) == 0 or len(self.coordinates) == 0:
+            return numpy.zeros(0, dtype=numpy.intp)
+        periodic = self.box is not None
+        ncells = self._ncells
+        query_cells = self._cell_of(self._fractional(points))
+        found = []
+        for offset in _cell_offsets(ncells, periodic):
+            neighbor = query_cells + offset
+            if periodic:
+                neighbor %= ncells
+                query = numpy.arange(len(points))
+            else:
+                valid = numpy.all((neighbor >= 0) & (neighbor < ncells), axis=1)
+                query = numpy.flatnonzero(valid)
+                neighbor = neighbor[valid]
+            neighbor = numpy.ravel_multi_index(neighbor.T, ncells)
+            n = self._counts[neighbor]
+            total = n.sum()
+            if total == 0:
+                continue
+            # all (query point, atom in neighbor cell) pairs
+            q = numpy.repeat(query, n)
+            within_cell = numpy.arange(total) - numpy.repeat(numpy.cumsum(n) - n, n)
+            a = self._order[numpy.repeat(self._starts[neighbor], n) + within_cell]
+            d = minimum_image(self.coordinates[a] - points[q], self.box)
+            found.append(a[numpy.einsum('ij,ij->i', d, d) <= cutoff*cutoff])
+        if len(found) == 0:
+            return numpy.zeros(0, dtype=numpy.intp)
+        return numpy.unique(numpy.concatenate(found))
+
+def grid_search(points, coordinates, cutoff, box=None):
+    """ Cell list search of the coordinates within cutoff of any of the points.
+
+    points and coordinates are (M, 3) and (N, 3) arrays, see CellList for box.
+    Returns the sorted indices into coordinates of the atoms found.
+    """
+    return CellList(coordinates, cutoff, box).search(points, cutoff)
+
+class KDTreeEngine(object):
+    """ MDAnalysis KD-tree search, the tree is rebuilt for every frame """
+
+    def __init__(self, atoms, pbc=False):
+        if pbc:
+            raise Exception('The kdtree neighbor engine does not support periodic boxes, use the grid engine')
+        self.atoms = atoms
+
+    def search(self, query_atoms, ts, cutoff):
+        ns = NS.AtomNeighborSearch(self.atoms)
+        return numpy.array(sorted([ a.number for a in ns.search_list(query_atoms, cutoff) ]), dtype=numpy.intp)
+
+class GridEngine(object):
+    """ NumPy cell list search over the coordinate array of the Timestep """
+
+    def __init__(self, atoms, pbc=False):
+        self.atoms = atoms
+        self.pbc = pbc
+        self._view = CoordinateView(atoms)
+        self._query_views = {}
+
+    def positions(self, ts):
+        """ Returns the coordinates of the searchable atoms in the Timestep ts """
+        return self._view.get(ts)
+
+    def cell_list(self, ts, cell_size):
+        """ Returns the CellList of the searchable atoms in the Timestep ts, its
+        search returns indices into the searchable atoms.
+        """
+        box = unit_cell(ts) if self.pbc else None
+        return CellList(self.positions(ts), cell_size, box)
+
+    def search(self, query_atoms, ts, cutoff):
+        key = id(query_atoms)
+        if key not in self._query_views:
+            self._query_views[key] = CoordinateView(query_atoms)
+        idx = self.cell_list(ts, cutoff).search(self._query_views[key].get(ts), cutoff)
+        return self._view.indices[idx]
+
+ENGINES = { 'kdtree': KDTreeEngine, 'grid': GridEngine }
+
+def neighbor_engine(name, atoms, pbc=False):
+    """ Create the neighbor search engine called name for the searchable atoms,
+    without a name the grid engine is used for periodic boxes and the kdtree otherwise.
+    """
+    if name is None:
+        name = 'grid' if pbc else 'kdtree'
+    if name not in ENGINES:
+        raise Exception('Unknown neighbor search engine: %s (choose from %s)' % (name, ', '.join(ENGINES.keys())))
+    return ENGINES[name](atoms, pbc=pbc)
@@ -0,0 +1,96 @@
+""" Frame-chunked multiprocessing execution of sequential processors.
+
+The selected frames of a trajectory are split into contiguous blocks. Each worker
+opens its own Universe objects, prepares a private copy of every processor and
+processes its block. The per-block results are merged back in frame order.
+"""
+import multiprocessing
+
+from MDAnalysis import Universe
+
+from batcha.cache import FrameCache
+from batcha.frames import iter_frames, select_frames
+from batcha.instrument import RunProfile
+
+import logging
+logger = logging.getLogger('batcha.parallel')
+
+def universe_files(u):
+    """ Returns the (topology, trajectory) filenames needed to reopen a Universe """
+    return (u.filename, u.trajectory.filename)
+
+def frame_blocks(numframes, n_blocks):
+    """ Split range(numframes) into at most n_blocks contiguous (start, stop) blocks """
+    n_blocks = max(1, min(n_blocks, numframes))
+    size, extra = divmod(numframes, n_blocks)
+    blocks = []
+    start = 0
+    for i in range(n_blocks):
+        stop = start + size + (1 if i < extra else 0)
+        blocks.append((start, stop))
+        start = stop
+    return blocks
+
+def merge_results(processor, blocks):
+    """ Merge the per-block results of a processor in frame order.
+
+    Processors can define a merge(blocks) method if their results are not a
+    plain per-frame list.
+    """
+    if hasattr(processor, 'merge'):
+        return processor.merge(blocks)
+    merged = []
+    for b in blocks:
+        merged += list(b)
+    return merged
+
+def _process_block(args):
+    (trj_files, ref_files, universe_kwargs, processors, indices) = args
+    trj = Universe(*trj_files, **universe_kwargs)
+    ref = Universe(*ref_files, **universe_kwargs)
+    cache = FrameCache()
+    for path, p in processors:
+        if hasattr(p, 'frame_cache'):
+            p.frame_cache = cache
+        p.prepare(ref=ref, trj=trj)
+    profile = RunProfile()
+    for index, ts in profile.timed_frames(iter_frames(trj.trajectory, indices)):
+        cache.advance(index)
+        for path, p in processors:
+            profile.process(path, p, ts)
+    return ([ (p.results(), getattr(p, 'labels', None)) for path, p in processors ], profile, cache.stats())
+
+def run_parallel(processors, trj, ref, n_workers, universe_kwargs=None, indices=None, profile=None, cache=None):
+    """ Run the (path, processor) pairs over trj using n_workers processes.
+
+    The processors must not have been prepared yet (they are pickled and sent
+    to the workers). indices are the frames to process (all by default).
+    The timings of the workers are added to profile (a RunProfile) and the
+    hits and misses of their frame caches to cache (a FrameCache) if given.
+    Returns a list of merged results in the same order as processors.
+    """
+    universe_kwargs = universe_kwargs or {}
+    if indices is None:
+        indices = select_frames(trj.trajectory.numframes)
+    blocks = frame_blocks(len(indices), n_workers)
+    jobs = [ (universe_files(trj), universe_files(ref), universe_kwargs, processors, indices[start:stop]) for (start, stop) in blocks ]
+    logger.info("Processing %d frame blocks with %d workers" % (len(blocks), n_workers))
+    pool = multiprocessing.Pool(n_workers)
+    try:
+        block_results = pool.map(_process_block, jobs)
+    finally:
+        pool.close()
+        pool.join()
+    for (r, block_profile, block_cache) in block_results:
+        if profile is not None:
+            profile.add(block_profile)
+        if cache is not None:
+            cache.add(block_cache)
+    block_results = [ r for (r, block_profile, block_cache) in block_results ]
+    merged = []
+    for i, (path, p) in enumerate(processors):
+        merged.append(merge_results(p, [ r[i][0] for r in block_results ]))
+        # labels are built in prepare, every worker builds the same ones
+        if block_results[0][i][1] is not None:
+            p.labels = block_results[0][i][1]
+    return merged
@@ -0,0 +1,199 @@
+""" Lazy read access to stored results.
+
+    results = Analysis.open_results('analysis.h5')
+    rmsd = results['/protein/rmsd']          # a TableView, nothing is read yet
+    rmsd['backbone'][1000:1010]              # one column, 10 frames
+    rmsd[['backbone', 'all']][::100]         # column projection and striding
+    for chunk in rmsd.iter_chunks(): ...     # chunked iteration
+    results['/channel/cylinder'][5]          # one frame of a ragged array
+
+Views only read the rows of the requested slice, so only the HDF5 chunks
+holding them are read and decompressed. Tables in the column layout only
+read the arrays of the projected columns. The chunk cache of the file can be
+tuned with the chunk_cache_* arguments of open_results.
+"""
+import numpy
+import tables
+
+from batcha.datastore import is_column_table, table_rows, read_ragged
+
+def open_results(filename, chunk_cache_size=None, chunk_cache_nelmts=None, chunk_cache_preempt=None):
+    """ Open a datastore for reading and return its Results.
+
+    chunk_cache_size (bytes), chunk_cache_nelmts (slots) and chunk_cache_preempt
+    override the HDF5 chunk cache parameters of PyTables for this file.
+    """
+    params = {}
+    if chunk_cache_size is not None:
+        params['CHUNK_CACHE_SIZE'] = chunk_cache_size
+    if chunk_cache_nelmts is not None:
+        params['CHUNK_CACHE_NELMTS'] = chunk_cache_nelmts
+    if chunk_cache_preempt is not None:
+        params['CHUNK_CACHE_PREEMPT'] = chunk_cache_preempt
+    return Results(tables.openFile(filename, mode='r', **params))
+
+def _slice(key, length):
+    """ Returns (start, stop, step) for an int or slice key, or raises IndexError """
+    if isinstance(key, slice):
+        if key.step is not None and key.step <= 0:
+            raise IndexError('Only positive steps are supported')
+        return key.indices(length)
+    key = int(key)
+    if key < 0:
+        key += length
+    if key < 0 or key >= length:
+        raise IndexError('Frame %d out of range (%d frames)' % (key, length))
+    return (key, key+1, 1)
+
+class Results(object):
+    """ The stored results of a datastore file, by node path """
+
+    def __init__(self, h5f):
+        self._h5f = h5f
+
+    def __getitem__(self, path):
+        node = self._h5f.getNode(path)
+        if isinstance(node, tables.Table) or is_column_table(node):
+            return TableView(node)
+        if isinstance(node, tables.Group) and 'offsets' in node and 'values' in node:
+            return RaggedView(node)
+        if isinstance(node, tables.Leaf):
+            return ArrayView(node)
+        raise KeyError('%s is a group, not a result node' % path)
+
+    def __contains__(self, path):
+        try:
+            self._h5f.getNode(path)
+        except tables.NoSuchNodeError:
+            return False
+        return True
+
+    def paths(self):
+        """ Returns the paths of all result nodes """
+        paths = []
+        for node in self._h5f.walkNodes('/'):
+            if is_column_table(node) or (isinstance(node, tables.Group) and 'offsets' in node and 'values' in node):
+                paths.append(node._v_pathname)
+            elif isinstance(node, tables.Leaf) and not (node._v_parent._v_pathname in paths):
+                paths.append(node._v_pathname)
+        return paths
+
+    def close(self):
+        self._h5f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class _View(object):
+    """ Common slicing and chunked iteration of the views """
+
+    def __len__(self):
+        return self._node.nrows
+
+    def __getitem__(self, key):
+        (start, stop, step) = _slice(key, len(self))
+        rows = self._read(start, stop, step)
+        if not isinstance(key, slice):
+            return rows[0]
+        return rows
+
+    def iter_chunks(self, chunk_rows=None):
+        """ Yields consecutive slices of chunk_rows frames (by default the I/O buffer of the node) """
+        chunk_rows = chunk_rows or self._buffer_rows()
+        for start in xrange(0, len(self), chunk_rows):
+            yield self._read(start, min(start + chunk_rows, len(self)), 1)
+
+    def _buffer_rows(self):
+        return max(self._node.nrowsinbuf, 1)
+
+class TableView(_View):
+    """ Lazy view of a table (in either layout), or of some of its columns """
+
+    def __init__(self, node, columns=None):
+        self._node = node
+        if isinstance(node, tables.Table):
+            self._colnames = list(node.colnames)
+        else:
+            self._colnames = sorted(node._v_children.keys())
+        self.columns = columns or self._colnames
+
+    def __len__(self):
+        return table_rows(self._node)
+
+    def labels(self):
+        """ Returns the labels the values of a single column index into (or None) """
+        if len(self.columns) != 1 or isinstance(self._node, tables.Table):
+            return None
+        return getattr(self._node._f_getChild(self.columns[0])._v_attrs, 'BATCHA_LABELS', None)
+
+    def _coldtype(self, name):
+        if isinstance(self._node, tables.Table):
+            return self._node.coldtypes[name]
+        return self._node._f_getChild(name).atom.dtype
+
+    @property
+    def dtype(self):
+        if len(self.columns) == 1:
+            return self._coldtype(self.columns[0])
+        return numpy.dtype([ (c, self._coldtype(c)) for c in self.columns ])
+
+    def _buffer_rows(self):
+        if isinstance(self._node, tables.Table):
+            return max(self._node.nrowsinbuf, 1)
+        return max(min([ self._node._f_getChild(c).nrowsinbuf for c in self.columns ]), 1)
+
+    def _read_column(self, name, start, stop, step):
+        if isinstance(self._node, tables.Table):
+            return self._node.read(start, stop, step, field=name)
+        return self._node._f_getChild(name).read(start, stop, step)
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return TableView(self._node, [key])
+        if isinstance(key, (list, tuple)):
+            return TableView(self._node, list(key))
+        return super(TableView, self).__getitem__(key)
+
+    def _read(self, start, stop, step):
+        if len(self.columns) == 1:
+            return self._read_column(self.columns[0], start, stop, step)
+        if isinstance(self._node, tables.Table) and self.columns == list(self._node.colnames):
+            return self._node.read(start, stop, step)
+        rows = numpy.empty(len(xrange(start, stop, step)), dtype=self.dtype)
+        for c in self.columns:
+            rows[c] = self._read_column(c, start, stop, step)
+        return rows
+
+class ArrayView(_View):
+    """ Lazy view of an array of per-frame objects """
+
+    def __init__(self, node):
+        self._node = node
+
+    def labels(self):
+        """ Returns the labels the stored values index into (or None) """
+        return getattr(self._node._v_attrs, 'BATCHA_LABELS', None)
+
+    def _read(self, start, stop, step):
+        return self._node.read(start, stop, step)
+
+class RaggedView(_View):
+    """ Lazy view of a ragged array, every frame is a structured array """
+
+    def __init__(self, node):
+        self._node = node
+
+    def __len__(self):
+        return self._node.offsets.nrows - 1
+
+    def labels(self):
+        return self._node.labels.read()
+
+    def _buffer_rows(self):
+        return max(self._node.offsets.nrowsinbuf, 1)
+
+    def _read(self, start, stop, step):
+        return read_ragged(self._node, start, stop, step)
@@ -0,0 +1,88 @@
+""" Frame by frame evaluation of MDAnalysis timeseries.
+
+MDAnalysis computes the timeseries of a collection with its own pass over the
+trajectory. The FrameTimeseries processors compute the same quantities from
+the coordinates of each Timestep so that they can run in the same pass as the
+sequential processors. They only keep atom indices and masses, so they can be
+pickled and sent to parallel workers.
+"""
+import numpy
+
+from batcha.coordinates import CoordinateView, atom_indices
+
+SUPPORTED = ('CenterOfMass', 'CenterOfGeometry', 'Atom', 'Bond', 'Distance', 'Angle', 'Dihedral')
+
+def frame_timeseries(timeseries):
+    """ Returns a FrameTimeseries computing the given MDAnalysis timeseries or None
+    if the type of timeseries is not supported (it is then left to the collection).
+    """
+    kind = timeseries.__class__.__name__
+    code = getattr(timeseries, 'code', None)
+    if kind not in SUPPORTED or (kind == 'Distance' and code != 'r'):
+        return None
+    atoms = list(timeseries.atoms)
+    indices = atom_indices(atoms)
+    masses = numpy.array([ a.mass for a in atoms ])
+    return FrameTimeseries(kind, code, indices, masses)
+
+def _dihedral(p):
+    b1 = p[1] - p[0]
+    b2 = p[2] - p[1]
+    b3 = p[3] - p[2]
+    n1 = numpy.cross(b1, b2)
+    n2 = numpy.cross(b2, b3)
+    return numpy.arctan2(numpy.sqrt(numpy.dot(b2, b2))*numpy.dot(b1, n2), numpy.dot(n1, n2))
+
+def _angle(p):
+    u = p[0] - p[1]
+    v = p[2] - p[1]
+    c = numpy.dot(u, v)/numpy.sqrt(numpy.dot(u, u)*numpy.dot(v, v))
+    return numpy.arccos(numpy.clip(c, -1.0, 1.0))
+
+class FrameTimeseries(object):
+    """ Computes one MDAnalysis timeseries from the coordinates of every frame.
+
+    Like the collection loaded by Analysis.run, only the first component of
+    the timeseries is kept for every frame.
+    """
+
+    def __init__(self, kind, code, indices, masses):
+        self.kind = kind
+        self.code = code
+        self._indices = indices
+        self._masses = masses
+        self._values = []
+
+    def prepare(self, ref=None, trj=None):
+        self._values = []
+        self._view = CoordinateView(self._indices, dtype=numpy.float64)
+
+    def value(self, pos):
+        """ Returns the components of the timeseries for the (n, 3) coordinates pos """
+        if self.kind == 'CenterOfMass':
+            return numpy.dot(self._masses, pos)/self._masses.sum()
+        elif self.kind == 'CenterOfGeometry':
+            return pos.mean(axis=0)
+        elif self.kind == 'Atom':
+            if self.code == 'v':
+                return pos.ravel()
+            return pos[:,'xyz'.index(self.code)]
+        elif self.kind in ('Bond', 'Distance'):
+            d = pos[1] - pos[0]
+            return numpy.sqrt(numpy.dot(d, d))
+        elif self.kind == 'Angle':
+            return _angle(pos)
+        elif self.kind == 'Dihedral':
+            return _dihedral(pos)
+
+    def process(self, ts):
+        v = self.value(self._view.get(ts))
+        self._values.append(float(numpy.atleast_1d(v)[0]))
+
+    def results(self):
+        return self._values
+
+    def drain(self):
+        values = self._values
+        self._values = []
+        return values
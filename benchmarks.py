@@ -0,0 +1,429 @@
+""" Benchmarks for batcha.
+
+    python benchmarks.py [suite|table|neighbors|coordinates|read|storage ...] [--residues N] [--waters N] [--frames N] [--json FILE]
+
+The suite generates a synthetic system (PDB + DCD) with the given size, runs
+every module of batcha/modules on it in a separate process and measures the
+write throughput of the datastore. Its results are printed (or written) as
+JSON: frames/s, MB/s and peak memory per case. The other benchmarks compare
+the current implementation of one hot path with the original one.
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import multiprocessing
+
+import numpy
+import tables
+
+from batcha.datastore import Table, Array, RaggedArray, Storage, _require_group
+from batcha.utils import split_path
+from batcha.results import open_results
+from batcha.neighbors import grid_search
+from batcha.coordinates import CoordinateView
+
+def _write_rowwise(table, columns, num_rows):
+    """ The original Table.write loop: one PyTables row at a time into a PyTables Table """
+    (group, name) = split_path(table.path)
+    node = table._h5f.createTable(_require_group(table._h5f, group), name, table._description(), expectedrows=25000)
+    row = node.row
+    for i in range(num_rows):
+        for col in columns:
+            row[col.name] = col.next_dirty_row()
+        row.append()
+    node.flush()
+
+def bench_table_write(num_rows=100000, num_columns=3):
+    print "Benchmarking Table.write with %d rows and %d columns" % (num_rows, num_columns)
+    timings = {}
+    for mode in ('rowwise', 'bulk'):
+        (fd, filename) = tempfile.mkstemp(suffix='.h5')
+        os.close(fd)
+        h5f = tables.openFile(filename, mode='w')
+        table = Table(h5f, '/timeseries/bench')
+        columns = []
+        for c in range(num_columns):
+            col = table.column('col%d' % c, tables.Float32Col())
+            col.load(list(numpy.random.random(num_rows)))
+            columns.append(col)
+        start = time.time()
+        if mode == 'rowwise':
+            _write_rowwise(table, columns, num_rows)
+        else:
+            table.write()
+        timings[mode] = time.time() - start
+        h5f.close()
+        os.remove(filename)
+        print " %-8s %8.2f s" % (mode, timings[mode])
+    print " speedup: %.1fx" % (timings['rowwise']/timings['bulk'])
+    return timings
+
+def _kdtree_search(points, coordinates, cutoff):
+    """ The KD-tree path of NearbyCountAnalysis: a new tree and one query per point """
+    from MDAnalysis.KDTree.KDTree import KDTree
+    kdt = KDTree(3, 10)
+    kdt.set_coords(coordinates.astype(numpy.float32))
+    found = set()
+    for p in points:
+        kdt.search(p.astype(numpy.float32), cutoff)
+        found.update(kdt.get_indices())
+    return numpy.array(sorted(found))
+
+def bench_neighbor_search(num_atoms=100000, num_query=2000, cutoff=3.0, frames=5):
+    print "Benchmarking neighbor search: %d atoms, %d query atoms, cutoff %.1f" % (num_atoms, num_query, cutoff)
+    # a water box at roughly liquid density
+    side = (num_atoms/0.1)**(1/3.0)
+    timings = {}
+    for mode in ('kdtree', 'grid'):
+        numpy.random.seed(0)
+        start = time.time()
+        for f in range(frames):
+            coordinates = numpy.random.random((num_atoms, 3))*side
+            points = coordinates[:num_query]
+            if mode == 'kdtree':
+                found = _kdtree_search(points, coordinates, cutoff)
+            else:
+                found = grid_search(points, coordinates, cutoff)
+        timings[mode] = (time.time() - start)/frames
+        print " %-8s %8.3f s/frame (%d atoms found in the last frame)" % (mode, timings[mode], len(found))
+    print " speedup: %.1fx" % (timings['kdtree']/timings['grid'])
+    return timings
+
+class _Timestep(object):
+    def __init__(self, num_atoms):
+        self._pos = numpy.random.random((num_atoms, 3)).astype(numpy.float32)
+
+def bench_coordinate_access(num_atoms=200000, group_size=20000, frames=500):
+    print "Benchmarking coordinate access: %d atoms, groups of %d atoms, %d frames" % (num_atoms, group_size, frames)
+    ts = _Timestep(num_atoms)
+    contiguous = numpy.arange(group_size)
+    scattered = numpy.sort(numpy.random.permutation(num_atoms)[:group_size])
+    ref = numpy.random.random((group_size, 3)).astype(numpy.float32)
+    timings = {}
+    for (name, indices) in (('contiguous', contiguous), ('scattered', scattered)):
+        for mode in ('copy', 'view'):
+            view = CoordinateView(indices)
+            diff = numpy.empty_like(ref)
+            buffers = set()
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            start = time.time()
+            for f in range(frames):
+                if mode == 'copy':
+                    # the fancy indexing of the original modules: new arrays every frame
+                    pos = ts._pos[indices]
+                    d = pos - ref
+                else:
+                    pos = view.get(ts)
+                    d = numpy.subtract(pos, ref, out=diff)
+                buffers.add(id(d))
+                numpy.einsum('ij,ij->', d, d)
+            timings[(name, mode)] = (time.time() - start)/frames
+            growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+            print " %-10s %-4s %8.1f us/frame, peak RSS +%d kB, %s" % (name, mode, timings[(name, mode)]*1e6, growth,
+                    'output buffer reused' if len(buffers) == 1 else 'new output arrays')
+        print " %-10s speedup: %.1fx" % (name, timings[(name, 'copy')]/timings[(name, 'view')])
+    return timings
+
+_PDB_ATOM = "ATOM  %5d %-4s %-3s %1s%4d    %8.3f%8.3f%8.3f%6.2f%6.2f      %-4s\n"
+
+def synthetic_system(directory, num_residues=200, num_waters=10000, num_frames=100, seed=0):
+    """ Write a synthetic system to directory and return the (pdb, dcd) files.
+
+    The protein (segid PROT) is a straight chain of residues with N, CA, CB,
+    C and O atoms along the z axis, surrounded by TIP3 waters (segid SOLV) at
+    liquid density. Every frame adds random displacements to the first frame.
+    """
+    from MDAnalysis.coordinates.DCD import DCDWriter
+    from MDAnalysis.coordinates.base import Timestep
+    numpy.random.seed(seed)
+    backbone = [ ('N', (-0.5, 0.0, 0.0)), ('CA', (0.0, 0.0, 0.5)), ('CB', (1.0, 0.5, 0.5)), ('C', (0.5, 0.0, 1.0)), ('O', (1.0, -0.5, 1.5)) ]
+    atoms = []
+    for r in range(num_residues):
+        for (name, offset) in backbone:
+            atoms.append((name, 'ALA', r+1, 'PROT', numpy.array(offset) + (0.0, 0.0, 3.8*r)))
+    length = 3.8*num_residues
+    side = max(numpy.sqrt(num_waters*30.0/length), 20.0)
+    for w in range(num_waters):
+        o = (numpy.random.random(3) - 0.5)*(side, side, length)
+        o[2] += length/2
+        for (name, offset) in [ ('OH2', (0.0, 0.0, 0.0)), ('H1', (0.96, 0.0, 0.0)), ('H2', (-0.24, 0.93, 0.0)) ]:
+            atoms.append((name, 'TIP3', w % 9999 + 1, 'SOLV', o + offset))
+    pdb = os.path.join(directory, 'synthetic.pdb')
+    with open(pdb, 'w') as f:
+        for i, (name, resname, resid, segid, xyz) in enumerate(atoms):
+            f.write(_PDB_ATOM % ((i+1) % 100000, name, resname, 'X', resid, xyz[0], xyz[1], xyz[2], 1.0, 0.0, segid))
+        f.write("END\n")
+    coordinates = numpy.array([ a[4] for a in atoms ], dtype=numpy.float32)
+    dcd = os.path.join(directory, 'synthetic.dcd')
+    writer = DCDWriter(dcd, len(atoms))
+    ts = Timestep(len(atoms))
+    for frame in range(num_frames):
+        ts._pos[:] = coordinates + numpy.random.normal(0.0, 0.3, coordinates.shape).astype(numpy.float32)
+        ts.frame = frame + 1
+        writer.write_next_timestep(ts)
+    if hasattr(writer, 'close_trajectory'):
+        writer.close_trajectory()
+    else:
+        writer.close()
+    return (pdb, dcd)
+
+def module_cases(num_residues):
+    """ Returns (name, processor, add_to_sequence keyword arguments) for every module """
+    from batcha.modules.rmsd import RMSD
+    from batcha.modules.rmsd_all_residues import RMSD as ResidueRMSD
+    from batcha.modules.distance import DistanceAnalysis, MultiDistanceAnalysis
+    from batcha.modules.nearby import NearbyCountAnalysis, NearbyListAnalysis
+    from batcha.modules.cylindersearch import CylinderSearch
+    from batcha.modules.multicylindersearch import MultiCylinderSearch
+    first = 'segid PROT and resid 1'
+    last = 'segid PROT and resid %d' % num_residues
+    middle = 'segid PROT and resid %d' % max(num_residues/2, 1)
+    pairs = [ ('segid PROT and resid %d' % r, last) for r in range(1, num_residues, max(num_residues/50, 1)) ]
+    return [
+        ('rmsd', RMSD('name CA'), {}),
+        ('rmsd_batched', RMSD('name CA', block_size=64), {}),
+        ('rmsd_all_residues', ResidueRMSD(), {}),
+        ('distance', DistanceAnalysis(first, last), {}),
+        ('multidistance', MultiDistanceAnalysis(pairs), {}),
+        ('nearby_count', NearbyCountAnalysis('segid PROT', 'resname TIP3', 3.0, engine='grid'), {}),
+        ('nearby_list', NearbyListAnalysis('segid PROT', 'resname TIP3', 3.0, engine='grid'), { 'array': True }),
+        ('cylinder', CylinderSearch(first, last, 'resname TIP3', radius=10.0), { 'array': 'ragged' }),
+        ('multicylinder', MultiCylinderSearch([ (first, middle), (middle, last) ], 'resname TIP3', radius=10.0), { 'array': 'ragged' }),
+    ]
+
+def _bench_module(args):
+    """ Run one module over the synthetic trajectory (in its own process, so peak memory is its own) """
+    from MDAnalysis import Universe
+    from batcha.analysis import Analysis
+    (index, pdb, dcd, num_residues, directory) = args
+    (name, processor, kwargs) = module_cases(num_residues)[index]
+    trj = Universe(pdb, dcd)
+    ref = Universe(pdb, dcd)
+    filename = os.path.join(directory, '%s.h5' % name)
+    analysis = Analysis(filename, readonly=False)
+    analysis.add_to_sequence('/bench/%s' % name, processor, **kwargs)
+    start = time.time()
+    stats = analysis.run(trj=trj, ref=ref)
+    analysis.save()
+    analysis.close()
+    wall = time.time() - start
+    profile = stats['profile']
+    process_time = profile['process_time']
+    written = sum(profile['bytes_written'].values())
+    return { 'name': name,
+             'atoms': len(trj.atoms),
+             'frames': profile['frames'],
+             'frames_per_second': profile['frames']/process_time if process_time else None,
+             'wall_frames_per_second': profile['frames']/wall,
+             'time_per_frame': process_time/profile['frames'] if profile['frames'] else None,
+             'read_time': profile['read_time'],
+             'save_time': profile['save_time'],
+             'bytes_written': written,
+             'write_mb_per_second': written/1e6/profile['save_time'] if profile['save_time'] else None,
+             'peak_memory_kb': profile['peak_memory_kb'] }
+
+def bench_modules(num_residues=200, num_waters=10000, num_frames=100, only=None):
+    print "Benchmarking modules: %d residues, %d waters, %d frames" % (num_residues, num_waters, num_frames)
+    directory = tempfile.mkdtemp(prefix='batcha-bench-')
+    try:
+        (pdb, dcd) = synthetic_system(directory, num_residues, num_waters, num_frames)
+        names = [ name for (name, p, kwargs) in module_cases(num_residues) ]
+        results = []
+        for index, name in enumerate(names):
+            if only and name not in only:
+                continue
+            pool = multiprocessing.Pool(1)
+            try:
+                r = pool.apply(_bench_module, ((index, pdb, dcd, num_residues, directory),))
+            finally:
+                pool.close()
+                pool.join()
+            print " %-20s %10.1f frames/s %10d kB peak" % (name, r['frames_per_second'] or 0.0, r['peak_memory_kb'])
+            results.append(r)
+        return results
+    finally:
+        shutil.rmtree(directory)
+
+def _bench_write(kind, num_rows, frame_size):
+    (fd, filename) = tempfile.mkstemp(suffix='.h5')
+    os.close(fd)
+    h5f = tables.openFile(filename, mode='w')
+    try:
+        numpy.random.seed(0)
+        if kind == 'table':
+            node = Table(h5f, '/bench/table')
+            for c in range(3):
+                node.column('col%d' % c, tables.Float32Col()).load(list(numpy.random.random(num_rows).astype(numpy.float32)))
+        elif kind == 'array':
+            node = Array(h5f, '/bench/array')
+            node.load([ numpy.random.random(frame_size).astype(numpy.float32) for i in range(num_rows) ])
+        else:
+            node = RaggedArray(h5f, '/bench/ragged')
+            dtype = [('residue', numpy.int32), ('offset', numpy.float32)]
+            node.load([ numpy.zeros(numpy.random.randint(frame_size), dtype=dtype) for i in range(num_rows) ])
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        node.write()
+        h5f.flush()
+        seconds = time.time() - start
+        return { 'name': '%s_write' % kind,
+                 'rows': num_rows,
+                 'seconds': seconds,
+                 'rows_per_second': num_rows/seconds,
+                 'bytes_written': node.bytes_written,
+                 'mb_per_second': node.bytes_written/1e6/seconds,
+                 'peak_memory_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                 'peak_memory_growth_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss }
+    finally:
+        h5f.close()
+        os.remove(filename)
+
+def bench_datastore_write(num_rows=100000, frame_size=100):
+    print "Benchmarking datastore writes: %d rows" % num_rows
+    results = []
+    for kind, rows in (('table', num_rows), ('array', num_rows/10), ('ragged', num_rows/10)):
+        r = _bench_write(kind, rows, frame_size)
+        print " %-20s %10.1f MB/s %10.0f rows/s" % (r['name'], r['mb_per_second'], r['rows_per_second'])
+        results.append(r)
+    return results
+
+def bench_window_read(num_rows=10000000, window=10, reads=100):
+    print "Benchmarking %d frame window reads from a %d row table" % (window, num_rows)
+    (fd, filename) = tempfile.mkstemp(suffix='.h5')
+    os.close(fd)
+    try:
+        h5f = tables.openFile(filename, mode='w')
+        table = Table(h5f, '/bench/table')
+        block = 1000000
+        for start in range(0, num_rows, block):
+            for c in range(3):
+                table.column('col%d' % c, tables.Float32Col()).load(list(numpy.random.random(min(block, num_rows - start)).astype(numpy.float32)))
+            table.write()
+        h5f.close()
+        timings = {}
+        with open_results(filename) as results:
+            view = results['/bench/table']
+            starts = numpy.random.randint(0, num_rows - window, reads)
+            for (name, v) in (('all_columns', view), ('one_column', view['col0'])):
+                start = time.time()
+                for s in starts:
+                    v[s:s+window]
+                timings[name] = (time.time() - start)/reads
+                print " %-12s %8.3f ms/read" % (name, 1000*timings[name])
+        return timings
+    finally:
+        os.remove(filename)
+
+STORAGE_SETTINGS = [
+    ('legacy', None),
+    ('uncompressed', Storage(complevel=0)),
+    ('zlib1', Storage('zlib', 1)),
+    ('zlib5_noshuffle', Storage('zlib', 5, shuffle=False)),
+    ('blosc5', Storage('blosc', 5)),
+    ('blosc_lz4_5', Storage('blosc:lz4', 5)),
+    ('blosc5_chunk64k', Storage('blosc', 5, chunkshape=65536)),
+]
+
+def _result_node(h5f, shape, storage, num_rows):
+    """ A node loaded with num_rows of realistic results: smooth timeseries,
+    per-residue RMSD rows or ragged cylinder search frames.
+    """
+    numpy.random.seed(0)
+    if shape == 'timeseries':
+        node = Table(h5f, '/bench/timeseries', storage)
+        for c in range(3):
+            node.column('col%d' % c, tables.Float32Col()).load(list(numpy.cumsum(numpy.random.normal(0, 0.1, num_rows)).astype(numpy.float32)))
+    elif shape == 'residue_rmsd':
+        node = Table(h5f, '/bench/rmsd', storage)
+        base = numpy.random.random(300).astype(numpy.float32)
+        node.column('residues', tables.Float32Col(shape=(300,))).load([ base + numpy.random.normal(0, 0.05, 300).astype(numpy.float32) for i in range(num_rows) ])
+    else:
+        node = RaggedArray(h5f, '/bench/cylinder', storage)
+        dtype = [('residue', numpy.int32), ('offset', numpy.float32)]
+        frames = []
+        for i in range(num_rows):
+            frame = numpy.empty(numpy.random.randint(10, 30), dtype=dtype)
+            frame['residue'] = numpy.sort(numpy.random.randint(0, 5000, len(frame)))
+            frame['offset'] = numpy.random.random(len(frame))*20
+            frames.append(frame)
+        node.load(frames)
+    node.expected_rows = num_rows
+    return node
+
+def bench_storage(num_rows=1000000):
+    print "Benchmarking storage options"
+    results = []
+    for shape, rows in (('timeseries', num_rows), ('residue_rmsd', num_rows/50), ('cylinder', num_rows/10)):
+        for (name, storage) in STORAGE_SETTINGS:
+            (fd, filename) = tempfile.mkstemp(suffix='.h5')
+            os.close(fd)
+            try:
+                h5f = tables.openFile(filename, mode='w')
+                try:
+                    node = _result_node(h5f, shape, storage, rows)
+                    start = time.time()
+                    node.write()
+                    h5f.flush()
+                    write_time = time.time() - start
+                except Exception, e:
+                    print " %-12s %-16s not available: %s" % (shape, name, e)
+                    continue
+                finally:
+                    h5f.close()
+                with open_results(filename) as stored:
+                    view = stored[stored.paths()[0]]
+                    start = time.time()
+                    for chunk in view.iter_chunks():
+                        pass
+                    read_time = time.time() - start
+                size = os.path.getsize(filename)
+            finally:
+                os.remove(filename)
+            r = { 'shape': shape, 'storage': name, 'rows': rows,
+                  'write_mb_per_second': node.bytes_written/1e6/write_time,
+                  'read_mb_per_second': node.bytes_written/1e6/read_time,
+                  'file_size': size,
+                  'compression_ratio': node.bytes_written/float(size) }
+            print " %-12s %-16s write %8.1f MB/s  read %8.1f MB/s  size %10d  ratio %5.2f" % (shape, name, r['write_mb_per_second'], r['read_mb_per_second'], size, r['compression_ratio'])
+            results.append(r)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='batcha benchmarks')
+    parser.add_argument('benchmarks', nargs='*', default=['suite'], choices=['suite', 'table', 'neighbors', 'coordinates', 'read', 'storage'])
+    parser.add_argument('--residues', type=int, default=200, help='protein residues of the synthetic system')
+    parser.add_argument('--waters', type=int, default=10000, help='water molecules of the synthetic system')
+    parser.add_argument('--frames', type=int, default=100, help='frames of the synthetic trajectory')
+    parser.add_argument('--rows', type=int, default=100000, help='rows for the datastore writes')
+    parser.add_argument('--only', nargs='*', help='only run these modules')
+    parser.add_argument('--json', help='write the results to this file instead of stdout')
+    args = parser.parse_args(argv)
+    results = {}
+    if 'suite' in args.benchmarks:
+        results['config'] = { 'residues': args.residues, 'waters': args.waters, 'frames': args.frames, 'rows': args.rows }
+        results['modules'] = bench_modules(args.residues, args.waters, args.frames, args.only)
+        results['datastore'] = bench_datastore_write(args.rows)
+    if 'table' in args.benchmarks:
+        results['table'] = bench_table_write(args.rows)
+    if 'neighbors' in args.benchmarks:
+        results['neighbors'] = bench_neighbor_search()
+    if 'coordinates' in args.benchmarks:
+        results['coordinates'] = dict([ ('%s_%s' % k, v) for k, v in bench_coordinate_access().items() ])
+    if 'read' in args.benchmarks:
+        results['read'] = bench_window_read()
+    if 'storage' in args.benchmarks:
+        results['storage'] = bench_storage(args.rows*10)
+    output = json.dumps(results, indent=1, sort_keys=True, default=str)
+    if args.json:
+        with open(args.json, 'w') as f:
+            f.write(output)
+    else:
+        print output
+
+if __name__ == '__main__':
+    main()
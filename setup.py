@@ -4,4 +4,7 @@ setup(
     version = "0.1",
     packages = find_packages(),
     # scripts = ['script.py'],
+    entry_points = {
+        'console_scripts': ['batcha = batcha.cli:main'],
+    },
 )
@@ -1,29 +1,789 @@
+import os
+import shutil
+import tempfile
+
+import numpy
+
 from MDAnalysis import *
 from MDAnalysis.tests.datafiles import PSF,DCD
 
 from batcha import Analysis
+from batcha.modules.rmsd import RMSD
+
+TMP = None
+
+def setup_module():
+    global TMP
+    TMP = tempfile.mkdtemp(prefix='batcha-tests-')
+
+def teardown_module():
+    shutil.rmtree(TMP, ignore_errors=True)
+
+def universes():
+    """ Returns a (trajectory, reference) pair of the sample system """
+    return (Universe(PSF, DCD, permissive=True), Universe(PSF, DCD, permissive=True))
+
+def stored(filename):
+    """ Returns all result nodes of a file as {path: rows} """
+    results = Analysis.open_results(filename)
+    try:
+        return dict([ (path, results[path][:]) for path in results.paths() ])
+    finally:
+        results.close()
+
+def boxed_universe(filename, atoms, box):
+    """ Returns the Universe of a PDB file with an orthorhombic box of the three
+    given lengths, atoms are (name, resname, resid, segid, (x, y, z)) tuples.
+    """
+    with open(filename, 'w') as f:
+        f.write("CRYST1%9.3f%9.3f%9.3f%7.2f%7.2f%7.2f P 1           1\n" % (box[0], box[1], box[2], 90.0, 90.0, 90.0))
+        for i, (name, resname, resid, segid, xyz) in enumerate(atoms):
+            f.write("ATOM  %5d %-4s %-3s %1s%4d    %8.3f%8.3f%8.3f%6.2f%6.2f      %-4s\n" % (i+1, name, resname, 'X', resid, xyz[0], xyz[1], xyz[2], 1.0, 0.0, segid))
+        f.write("END\n")
+    return Universe(filename)
+
+def process_frames(processors, u, frames):
+    """ Prepares the processors on u and processes every (N, 3) coordinate array of frames as a frame """
+    for p in processors:
+        p.prepare(trj=u)
+    for i, coordinates in enumerate(frames):
+        u.trajectory.ts._pos[:] = coordinates
+        for p in processors:
+            p.process(i)
+    return [ p.results() for p in processors ]
+
+def same(a, b):
+    """ True if two stored results are exactly equal """
+    if isinstance(a, numpy.ndarray) or isinstance(b, numpy.ndarray):
+        a = numpy.asarray(a)
+        b = numpy.asarray(b)
+        if a.dtype.names or b.dtype.names:
+            return a.dtype == b.dtype and all([ same(a[n], b[n]) for n in a.dtype.names ])
+        if a.dtype == object or b.dtype == object:
+            return a.shape == b.shape and all([ same(x, y) for x, y in zip(a.ravel(), b.ravel()) ])
+        return a.dtype == b.dtype and a.shape == b.shape and numpy.array_equal(a, b)
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return len(a) == len(b) and all([ same(x, y) for x, y in zip(a, b) ])
+    if isinstance(a, dict) and isinstance(b, dict):
+        return sorted(a.keys()) == sorted(b.keys()) and all([ same(a[k], b[k]) for k in a ])
+    return a == b
+
+def assert_same_results(a, b):
+    assert sorted(a.keys()) == sorted(b.keys()), (sorted(a.keys()), sorted(b.keys()))
+    for path in a:
+        assert same(a[path], b[path]), 'results differ at %s' % path
 
 def test_run():
     print "Loading reference system: %s, %s" % (PSF, DCD)
     ref = Universe(PSF, DCD, permissive=True)
     print "Loading trajectory: %s" % (DCD)
     trj = Universe(PSF, DCD, permissive=True)
-    
+
     # add the metadata for this analysis to the database
-    analysis = Analysis('test.h5', readonly=False)
-    
+    analysis = Analysis(os.path.join(TMP, 'test.h5'), readonly=False)
+
     # Test metadata
     analysis.add_metadata('/metadata/test', { 'a': '1', 'b': '2' })
     analysis.add_metadata('/metadata/test1', { 'a': '1', 'b': '2' })
     analysis.add_metadata('/metadata/test2', { 'a': '1', 'b': '2' })
-    
+
     # Test timeseries
     analysis.add_timeseries('/timeseries/com/COM_ALL', Timeseries.CenterOfMass(ref.atoms))
     analysis.add_timeseries('/timeseries/com/COM_ALL1', Timeseries.CenterOfMass(ref.atoms))
     analysis.add_timeseries('/timeseries/com/COM_ALL2', Timeseries.CenterOfMass(ref.atoms))
+
+    analysis.run(trj=trj, ref=ref)
+    analysis.save()
+    analysis.close()
+
+def incremental_run(filename, **run_kwargs):
+    trj, ref = universes()
+    analysis = Analysis(filename, readonly=False)
+    analysis.add_timeseries('/timeseries/com/protein', Timeseries.CenterOfMass(trj.atoms))
+    # a distance vector is left to the timeseries collection
+    analysis.add_timeseries('/timeseries/distance/ends', Timeseries.Distance('d', trj.selectAtoms('resid 1 and name CA', 'resid 214 and name CA')))
+    analysis.add_to_sequence('/protein/rmsd/backbone', RMSD('backbone'))
+    analysis.run(trj=trj, ref=ref, **run_kwargs)
+    analysis.save()
+    analysis.close()
+
+def test_incremental():
+    full = os.path.join(TMP, 'full.h5')
+    incremental_run(full)
+    grown = os.path.join(TMP, 'incremental.h5')
+    # the trajectory "grows" from 50 frames to all of them
+    incremental_run(grown, incremental=True, stop=50)
+    incremental_run(grown, incremental=True)
+    assert_same_results(stored(full), stored(grown))
+    # no new frames: nothing is computed again
+    incremental_run(grown, incremental=True)
+    assert_same_results(stored(full), stored(grown))
+
+def test_search_groups_wrapped_resids():
+    from benchmarks import synthetic_system
+    from batcha.geometry import group_centers
+    from batcha.modules.cylindersearch import search_groups, residue_atoms
+    (pdb, dcd) = synthetic_system(TMP, num_residues=10, num_waters=10001, num_frames=2)
+    u = Universe(pdb, dcd)
+    # waters 0 and 9999 share resid 1 but are different residues
+    oxygens = u.selectAtoms('segid SOLV and name OH2')
+    labels, groups, residues = search_groups(oxygens)
+    assert len(labels) == 10001
+    assert len(set(groups)) == 10001
+    # centers cover the whole residues, not only the selected oxygens
+    indices, residue_groups, masses = residue_atoms(residues)
+    centers = group_centers(u.atoms.coordinates()[indices], residue_groups, masses)
+    for i in (0, 9999, 10000):
+        assert numpy.allclose(centers[i], residues[i].centerOfMass(), atol=1e-4)
+
+def test_cylinder_search_labels():
+    from batcha.modules.cylindersearch import CylinderSearch
+    trj, ref = universes()
+    filename = os.path.join(TMP, 'labels.h5')
+    analysis = Analysis(filename, readonly=False)
+    for path, array in (('/channel/pickled', True), ('/channel/ragged', 'ragged')):
+        analysis.add_to_sequence(path, CylinderSearch('resid 1 and name CA', 'resid 214 and name CA', 'resname ARG LYS', radius=8.0), array=array)
+    analysis.run(trj=trj, ref=ref)
+    analysis.save()
+    analysis.close()
+    results = Analysis.open_results(filename)
+    try:
+        pickled = results['/channel/pickled']
+        ragged = results['/channel/ragged']
+        # every storage kind keeps the labels the residue indices point to
+        assert list(pickled.labels()) == list(ragged.labels())
+        assert any([ len(frame) > 0 for frame in pickled[:] ])
+        for frame in pickled[:]:
+            assert all([ 0 <= r < len(pickled.labels()) for r in frame['residue'] ])
+        # strided reads only read the selected frames
+        for step in (2, 3, 7):
+            assert same(ragged[1::step], ragged[:][1::step])
+    finally:
+        results.close()
+
+def test_multi_distance_matches_distances():
+    from batcha.modules.distance import DistanceAnalysis, MultiDistanceAnalysis
+    pairs = [ ('resid 1', 'resid 5'), ('resid 2', 'resid 5'), ('resid 3 and name CA', 'resid 4') ]
+    # the declared column and labels store one row of pair distances per frame
+    trj, ref = universes()
+    filename = os.path.join(TMP, 'multidistance.h5')
+    analysis = Analysis(filename, readonly=False)
+    analysis.add_to_sequence('/distances/pairs', MultiDistanceAnalysis(pairs))
+    for i, (s1, s2) in enumerate(pairs):
+        analysis.add_to_sequence('/distances/pair%d' % i, DistanceAnalysis(s1, s2))
+    analysis.run(trj=trj, ref=ref)
+    analysis.save()
+    analysis.close()
+    results = Analysis.open_results(filename)
+    try:
+        rows = results['/distances']['pairs']
+        assert list(rows.labels()) == [ '%s - %s' % pair for pair in pairs ]
+        rows = rows[:]
+        assert rows.shape == (trj.trajectory.numframes, len(pairs))
+        for i in range(len(pairs)):
+            assert numpy.allclose(rows[:,i], results['/distances']['pair%d' % i][:], atol=1e-4)
+    finally:
+        results.close()
+    # frame by frame with and without periodic boundaries
+    numpy.random.seed(3)
+    atoms = [ ('CA', 'ALA', r, 'PROT', (0.0, 0.0, 0.0)) for r in range(1, 6) for n in range(3) ]
+    for pbc in (False, True):
+        u = boxed_universe(os.path.join(TMP, 'pairs.pdb'), atoms, (12.0, 14.0, 16.0))
+        frames = [ numpy.random.rand(len(atoms), 3)*(12.0, 14.0, 16.0) for f in range(5) ]
+        processors = [ MultiDistanceAnalysis(pairs, pbc=pbc) ] + [ DistanceAnalysis(s1, s2, pbc=pbc) for (s1, s2) in pairs ]
+        results = process_frames(processors, u, frames)
+        for f in range(len(frames)):
+            expected = [ results[i+1][f] for i in range(len(pairs)) ]
+            assert numpy.allclose(results[0][f], expected, atol=1e-4), (pbc, f)
+
+def test_minimum_image_across_box_face():
+    from batcha.modules.distance import DistanceAnalysis
+    from batcha.modules.cylindersearch import CylinderSearch
+    # the cylinder ends are 18 A apart in the box but 2 A apart across its x face
+    atoms = [ ('CA', 'ALA', 1, 'PROT', (1.0, 10.0, 10.0)),
+              ('CA', 'ALA', 2, 'PROT', (19.0, 10.0, 10.0)),
+              ('OH2', 'TIP3', 3, 'SOLV', (19.8, 10.0, 10.5)),
+              ('OH2', 'TIP3', 4, 'SOLV', (10.0, 10.0, 11.0)) ]
+    u = boxed_universe(os.path.join(TMP, 'face.pdb'), atoms, (20.0, 20.0, 20.0))
+    frames = [ numpy.array([ xyz for (name, resname, resid, segid, xyz) in atoms ]) ]
+    processors = [ DistanceAnalysis('resid 1', 'resid 2'), DistanceAnalysis('resid 1', 'resid 2', pbc=True),
+                   CylinderSearch('resid 1', 'resid 2', 'resname TIP3', radius=3.0), CylinderSearch('resid 1', 'resid 2', 'resname TIP3', radius=3.0, pbc=True) ]
+    (distance, periodic_distance, cylinder, periodic_cylinder) = process_frames(processors, u, frames)
+    assert numpy.allclose(distance, [18.0]) and numpy.allclose(periodic_distance, [2.0])
+    # without pbc the long axis through the box holds the other water
+    found = [ processors[2].labels[r] for r in cylinder[0]['residue'] ]
+    assert found == ['TIP3:4'] and numpy.allclose(cylinder[0]['offset'], [9.0], atol=1e-4)
+    found = [ processors[3].labels[r] for r in periodic_cylinder[0]['residue'] ]
+    assert found == ['TIP3:3'] and numpy.allclose(periodic_cylinder[0]['offset'], [1.2], atol=1e-4)
+
+def brute_force_cylinders(u, paths, search, radius, extension):
+    """ Returns the (label, path, offset) of every search residue in every cylinder, path by path """
+    from batcha.geometry import cylinder_coordinates
+    residues = []
+    for atom in u.selectAtoms(search).atoms:
+        if atom.residue not in residues:
+            residues.append(atom.residue)
+    found = []
+    for path_index, (sel_a, sel_b) in enumerate(paths):
+        a = u.selectAtoms(sel_a).centerOfMass()
+        b = u.selectAtoms(sel_b).centerOfMass()
+        height = numpy.linalg.norm(b - a)
+        for r in residues:
+            if numpy.min(numpy.sqrt(numpy.sum((r.coordinates() - (a+b)/2.0)**2, axis=1))) > height/2.0 + extension:
+                continue
+            d, offset = cylinder_coordinates(numpy.array([r.centerOfMass()]), a, b, height)
+            if d[0] <= radius:
+                found.append(('%s:%s' % (r.name, r.id), path_index, offset[0]))
+    return found
+
+def test_multi_cylinder_search_reports_residues_once():
+    from batcha.modules.multicylindersearch import MultiCylinderSearch
+    # two paths along z which overlap between z=5 and z=10, surrounded by waters
+    numpy.random.seed(4)
+    ends = [ (0.0, 0.0, 0.0), (0.0, 0.0, 10.0), (0.0, 0.0, 5.0), (0.0, 0.0, 15.0) ]
+    atoms = [ ('CA', 'ALA', i+1, 'PROT', xyz) for i, xyz in enumerate(ends) ]
+    for w in range(80):
+        for name in ('OH2', 'H1', 'H2'):
+            atoms.append((name, 'TIP3', w+5, 'SOLV', (0.0, 0.0, 0.0)))
+    u = boxed_universe(os.path.join(TMP, 'paths.pdb'), atoms, (40.0, 40.0, 40.0))
+    paths = [ ('resid 1', 'resid 2'), ('resid 3', 'resid 4') ]
+    frames = []
+    for f in range(5):
+        oxygens = numpy.random.rand(80, 3)*(12.0, 12.0, 24.0) - (6.0, 6.0, 2.0)
+        hydrogens = numpy.array([ (0.96, 0.0, 0.0), (-0.24, 0.93, 0.0) ])
+        waters = numpy.concatenate([ oxygens[:,None,:], oxygens[:,None,:] + hydrogens ], axis=1).reshape(-1, 3)
+        frames.append(numpy.concatenate([ numpy.array(ends), waters ]))
+    search = MultiCylinderSearch(paths, 'resname TIP3', radius=4.0, extension=1.0)
+    overlapping = 0
+    for f, coordinates in enumerate(frames):
+        rows = process_frames([ search ], u, [ coordinates ])[0][0]
+        expected = brute_force_cylinders(u, paths, 'resname TIP3', 4.0, 1.0)
+        # every residue once, under the first path which holds it
+        first = []
+        for (label, path_index, offset) in expected:
+            if label not in [ l for (l, p, o) in first ]:
+                first.append((label, path_index, offset))
+        overlapping += len(expected) - len(first)
+        assert [ (search.labels[r], p) for (r, p) in zip(rows['residue'], rows['path']) ] == [ (l, p) for (l, p, o) in first ]
+        assert numpy.allclose(rows['offset'], [ o for (l, p, o) in first ], atol=1e-3)
+    assert overlapping > 0
+
+def test_cell_list_matches_brute_force():
+    from batcha.geometry import minimum_image
+    from batcha.neighbors import CellList
+    numpy.random.seed(0)
+    coordinates = numpy.random.rand(2000, 3)*20.0
+    points = numpy.random.rand(30, 3)*22.0 - 1.0
+    for box in (None, numpy.array([[20.0, 0.0, 0.0], [3.0, 18.0, 0.0], [2.0, 4.0, 25.0]])):
+        # one cell list searched with every cutoff up to its cell size
+        cells = CellList(coordinates, 5.0, box)
+        for cutoff in (5.0, 3.2, 1.0):
+            d = minimum_image((coordinates[None,:,:] - points[:,None,:]).reshape(-1, 3), box).reshape(len(points), len(coordinates), 3)
+            expected = numpy.flatnonzero(numpy.any(numpy.sum(d*d, axis=2) <= cutoff*cutoff, axis=0))
+            assert numpy.all(cells.search(points, cutoff) == expected)
+
+def test_nearby_default_engine():
+    from batcha.neighbors import GridEngine, KDTreeEngine
+    from batcha.modules.nearby import NearbyCountAnalysis
+    trj, ref = universes()
+    # the default engine follows pbc, only an explicit kdtree with pbc is refused
+    for pbc, engine in ((False, KDTreeEngine), (True, GridEngine)):
+        nearby = NearbyCountAnalysis('resid 1', 'protein', 3.0, pbc=pbc)
+        nearby.prepare(ref=ref, trj=trj)
+        assert isinstance(nearby._engine, engine)
+    try:
+        NearbyCountAnalysis('resid 1', 'protein', 3.0, engine='kdtree', pbc=True).prepare(ref=ref, trj=trj)
+    except Exception:
+        pass
+    else:
+        raise AssertionError('kdtree engine accepted pbc')
+
+class FrameNumber(object):
+    """ Stores the frame number of every frame, failing at fail_frame (like a crashed run) """
+    
+    def __init__(self, fail_frame=None):
+        self.fail_frame = fail_frame
+    
+    def prepare(self, ref, trj):
+        self._frames = []
     
+    def process(self, ts):
+        if ts.frame == self.fail_frame:
+            raise RuntimeError('crashed at frame %d' % ts.frame)
+        self._frames.append(float(ts.frame))
+    
+    def results(self):
+        return self._frames
+
+def checkpointed_run(filename, fail_frame=None, **run_kwargs):
+    from batcha.modules.cylindersearch import CylinderSearch
+    trj, ref = universes()
+    analysis = Analysis(filename, readonly=False)
+    analysis.add_to_sequence('/protein/rmsd/backbone', RMSD('backbone'))
+    analysis.add_to_sequence('/crash/frame', FrameNumber(fail_frame))
+    for path, array in (('/channel/pickled', True), ('/channel/ragged', 'ragged')):
+        analysis.add_to_sequence(path, CylinderSearch('resid 1 and name CA', 'resid 214 and name CA', 'resname ARG LYS', radius=8.0), array=array)
+    try:
+        analysis.run(trj=trj, ref=ref, flush_every=10, **run_kwargs)
+        analysis.save()
+    finally:
+        analysis.close()
+
+def test_flush_and_resume():
+    full = os.path.join(TMP, 'checkpoint-full.h5')
+    checkpointed_run(full)
+    crashed = os.path.join(TMP, 'checkpoint-resumed.h5')
+    try:
+        checkpointed_run(crashed, fail_frame=45)
+    except RuntimeError:
+        pass
+    else:
+        assert False, 'the run did not crash'
+    # tables, arrays and ragged arrays were checkpointed at 40 frames
+    results = Analysis.open_results(crashed)
+    try:
+        for path in ('/protein/rmsd', '/channel/pickled', '/channel/ragged'):
+            assert len(results[path]) == 40, (path, len(results[path]))
+    finally:
+        results.close()
+    checkpointed_run(crashed, resume=True)
+    assert_same_results(stored(full), stored(crashed))
+
+def test_migrate_legacy_table():
+    import tables
+    from batcha.datastore import Table, is_column_table, read_column
+    filename = os.path.join(TMP, 'legacy.h5')
+    # a table written by earlier versions: one PyTables Table
+    h5f = tables.openFile(filename, mode='w')
+    group = h5f.createGroup('/', 'protein')
+    legacy = h5f.createTable(group, 'rmsd', { 'backbone': tables.Float32Col(), 'all': tables.Float32Col(), 'com': tables.Float32Col(shape=(3,)) })
+    rows = numpy.zeros(1000, dtype=legacy.dtype)
+    rows['backbone'] = numpy.arange(1000)
+    rows['all'] = numpy.arange(1000)*2
+    rows['com'] = numpy.arange(3000).reshape((1000, 3))
+    legacy.append(rows)
+    legacy._v_attrs.BATCHA_FRAMES = 1000
+    legacy._v_attrs.BATCHA_STATE = {}
+    h5f.close()
+    
+    def check(h5f):
+        for name in ('backbone', 'all', 'com'):
+            assert numpy.array_equal(read_column(h5f, '/protein/rmsd', name), rows[name])
+            assert numpy.array_equal(read_column(h5f, '/protein/rmsd', name, 10, 20), rows[name][10:20])
+    
+    h5f = tables.openFile(filename, mode='a')
+    check(h5f)
+    table = Table(h5f, '/protein/rmsd')
+    table.column('backbone', tables.Float32Col())
+    table.column('all', tables.Float32Col())
+    table.column('com', tables.Float32Col(shape=(3,)))
+    table.setup()
+    node = h5f.getNode('/protein/rmsd')
+    assert is_column_table(node)
+    assert table.checkpoint() == (1000, {})
+    check(h5f)
+    h5f.close()
+    
+    results = Analysis.open_results(filename)
+    try:
+        view = results['/protein/rmsd']
+        assert len(view) == 1000
+        assert numpy.array_equal(view['backbone'][:], rows['backbone'])
+        assert numpy.array_equal(view['com'][::7], rows['com'][::7])
+        both = view[['all', 'backbone']][100:200]
+        assert numpy.array_equal(both['all'], rows['all'][100:200])
+        assert numpy.array_equal(both['backbone'], rows['backbone'][100:200])
+        assert '/protein/rmsd_LEGACY' not in results
+    finally:
+        results.close()
+
+class CountedCenter(object):
+    """ Stores the center of mass x of a selection, counting the prepare and process calls """
+    calls = []
+    
+    def __init__(self, selection):
+        self.selection = selection
+    
+    def prepare(self, ref, trj):
+        CountedCenter.calls.append(('prepare', self.selection))
+        self._atoms = trj.selectAtoms(self.selection)
+        self._x = []
+    
+    def process(self, ts):
+        CountedCenter.calls.append(('process', self.selection))
+        self._x.append(float(self._atoms.centerOfMass()[0]))
+    
+    def results(self):
+        return self._x
+
+def reused_run(filename, selections, dcd=DCD, **run_kwargs):
+    """ Runs one CountedCenter per path of selections ({path: selection}) and returns the calls """
+    trj = Universe(PSF, dcd, permissive=True)
+    ref = Universe(PSF, dcd, permissive=True)
+    analysis = Analysis(filename, readonly=False)
+    for path, selection in sorted(selections.items()):
+        analysis.add_to_sequence(path, CountedCenter(selection))
+    CountedCenter.calls = []
+    try:
+        analysis.run(trj=trj, ref=ref, **run_kwargs)
+        analysis.save()
+    finally:
+        analysis.close()
+    return CountedCenter.calls
+
+def test_reuse_fingerprints():
+    dcd = os.path.join(TMP, 'reuse.dcd')
+    shutil.copy(DCD, dcd)
+    filename = os.path.join(TMP, 'reuse.h5')
+    selections = { '/first/x': 'name CA', '/second/x': 'backbone' }
+    assert len(reused_run(filename, selections, dcd)) > 0
+    first = stored(filename)
+    # nothing changed: no processor is prepared or processed again
+    assert reused_run(filename, selections, dcd, reuse=True) == []
+    assert_same_results(stored(filename), first)
+    # a changed selection only recomputes its node, and a new path only computes its own
+    selections.update({ '/second/x': 'name N', '/third/x': 'name C' })
+    calls = reused_run(filename, selections, dcd, reuse=True)
+    assert sorted(set([ selection for (call, selection) in calls ])) == ['name C', 'name N']
+    fresh = os.path.join(TMP, 'reuse-fresh.h5')
+    reused_run(fresh, selections, dcd)
+    assert_same_results(stored(filename), stored(fresh))
+    # a changed trajectory file recomputes everything
+    os.utime(dcd, (os.path.getatime(dcd), os.path.getmtime(dcd) + 10))
+    calls = reused_run(filename, selections, dcd, reuse=True)
+    assert sorted(set([ selection for (call, selection) in calls if call == 'prepare' ])) == sorted(selections.values())
+    assert_same_results(stored(filename), stored(fresh))
+
+def parallel_run(filename, n_workers, **run_kwargs):
+    from batcha.modules.cylindersearch import CylinderSearch
+    from batcha.modules.distance import DistanceAnalysis
+    trj, ref = universes()
+    analysis = Analysis(filename, readonly=False)
+    analysis.add_timeseries('/timeseries/com/protein', Timeseries.CenterOfMass(trj.atoms))
+    analysis.add_timeseries('/timeseries/dihedral/phi', Timeseries.Dihedral(trj.selectAtoms('resid 10 and name C', 'resid 11 and name N', 'resid 11 and name CA', 'resid 11 and name C')))
+    analysis.add_to_sequence('/protein/rmsd/backbone', RMSD('backbone'))
+    analysis.add_to_sequence('/protein/rmsd/batched', RMSD('name CA', block_size=16))
+    analysis.add_to_sequence('/protein/distance/ends', DistanceAnalysis('resid 1', 'resid 214'))
+    for path, array in (('/channel/pickled', True), ('/channel/ragged', 'ragged')):
+        analysis.add_to_sequence(path, CylinderSearch('resid 1 and name CA', 'resid 214 and name CA', 'resname ARG LYS', radius=8.0), array=array)
+    stats = analysis.run(trj=trj, ref=ref, n_workers=n_workers, universe_kwargs={ 'permissive': True }, **run_kwargs)
+    analysis.save()
+    analysis.close()
+    return stats
+
+def test_parallel_equals_serial():
+    serial = os.path.join(TMP, 'serial.h5')
+    parallel = os.path.join(TMP, 'parallel.h5')
+    parallel_run(serial, 1)
+    stats = parallel_run(parallel, 2)
+    assert_same_results(stored(serial), stored(parallel))
+    # the cylinder searches share the centers of their end points in every worker
+    assert stats['cache_hits'] > 0
+
+def stored_frames(filename):
+    """ Returns the (index, time) columns of the frames table of a file """
+    results = Analysis.open_results(filename)
+    try:
+        return (results[Analysis.FRAMES_PATH]['index'][:], results[Analysis.FRAMES_PATH]['time'][:])
+    finally:
+        results.close()
+
+def assert_frames(filename, indices):
+    """ Checks the stored frame indices and that their times and centers are the ones of the reader """
+    trj = Universe(PSF, DCD, permissive=True)
+    index, time = stored_frames(filename)
+    assert list(index) == list(indices)
+    atoms = trj.selectAtoms('name CA')
+    x = stored(filename)['/selection']['x']
+    for i, frame in enumerate(indices):
+        ts = trj.trajectory[int(frame)]
+        assert numpy.allclose(time[i], getattr(ts, 'time', frame*trj.trajectory.dt), rtol=1e-5)
+        assert numpy.allclose(x[i], atoms.centerOfMass()[0], atol=1e-4)
+
+def test_frame_selection():
+    from batcha.frames import select_frames
+    numframes = Universe(PSF, DCD, permissive=True).trajectory.numframes
+    # a regular step and an irregular list (read by seeking to every frame)
+    for name, run_kwargs, indices in (('step', { 'step': 3 }, range(0, numframes, 3)),
+                                      ('range', { 'start': 5, 'stop': 60, 'step': 7 }, range(5, 60, 7)),
+                                      ('list', { 'frames': [5, 2, 40, 41, numframes-1] }, [5, 2, 40, 41, numframes-1])):
+        filename = os.path.join(TMP, 'selection-%s.h5' % name)
+        reused_run(filename, { '/selection/x': 'name CA' }, **run_kwargs)
+        assert_frames(filename, indices)
+    # negative indices count from the end without changing the caller's array
+    frames = numpy.array([-1, 2], dtype=numpy.int64)
+    assert list(select_frames(numframes, frames=frames)) == [numframes-1, 2]
+    assert list(frames) == [-1, 2]
+
+def test_parallel_step_equals_serial():
+    serial = os.path.join(TMP, 'serial-step.h5')
+    parallel = os.path.join(TMP, 'parallel-step.h5')
+    parallel_run(serial, 1, step=3)
+    parallel_run(parallel, 2, step=3)
+    assert_same_results(stored(serial), stored(parallel))
+    numframes = Universe(PSF, DCD, permissive=True).trajectory.numframes
+    for filename in (serial, parallel):
+        assert list(stored_frames(filename)[0]) == range(0, numframes, 3)
+
+def batch_spec(analysis, trj, ref):
+    from batcha.modules.cylindersearch import CylinderSearch
+    analysis.add_timeseries('/timeseries/com/protein', Timeseries.CenterOfMass(trj.atoms))
+    analysis.add_to_sequence('/protein/rmsd/backbone', RMSD('backbone'))
+    analysis.add_to_sequence('/channel/ragged', CylinderSearch('resid 1 and name CA', 'resid 214 and name CA', 'resname ARG LYS', radius=8.0), array='ragged')
+
+def failing_spec(analysis, trj, ref):
+    batch_spec(analysis, trj, ref)
+    analysis.add_to_sequence('/crash/frame', FrameNumber(fail_frame=5))
+
+def test_batch_equals_plain_runs():
+    from batcha.batch import run_batch
+    dcd = os.path.join(TMP, 'replica.dcd')
+    shutil.copy(DCD, dcd)
+    inputs = [ ('first', PSF, DCD), ('second', PSF, dcd) ]
+    filename = os.path.join(TMP, 'batch.h5')
+    run_batch(filename, batch_spec, inputs, n_workers=2, universe_kwargs={ 'permissive': True }, flush_every=20, stop=50)
+    batch = stored(filename)
+    for name, psf, trajectory in inputs:
+        plain = os.path.join(TMP, 'plain-%s.h5' % name)
+        trj = Universe(psf, trajectory, permissive=True)
+        ref = Universe(psf, trajectory, permissive=True)
+        analysis = Analysis(plain, readonly=False)
+        batch_spec(analysis, trj, ref)
+        analysis.run(trj=trj, ref=ref, stop=50)
+        analysis.save()
+        analysis.close()
+        # the group of every trajectory holds the results of a plain run
+        prefix = '/%s' % name
+        assert_same_results(dict([ (path[len(prefix):], rows) for path, rows in batch.items() if path.startswith(prefix + '/') ]), stored(plain))
+    # a failing worker stops the batch and its writer instead of hanging
+    try:
+        run_batch(os.path.join(TMP, 'failed.h5'), failing_spec, inputs, n_workers=2, universe_kwargs={ 'permissive': True }, stop=50)
+    except RuntimeError:
+        pass
+    else:
+        raise AssertionError('the failing worker was not reported')
+
+def test_cli_run_json_config():
+    import json
+    from batcha import cli
+    from batcha.modules.cylindersearch import CylinderSearch
+    config = {
+        'output': os.path.join(TMP, 'cli.h5'),
+        'topology': PSF,
+        'trajectory': DCD,
+        'universe': { 'permissive': True },
+        'chunk_size': 20,
+        'frames': { 'stop': 50, 'step': 2 },
+        'metadata': [ { 'path': '/metadata/trajectory', 'data': { 'psf': PSF, 'dcd': DCD } } ],
+        'timeseries': [ { 'path': '/timeseries/com/protein', 'type': 'CenterOfMass', 'selection': 'protein' } ],
+        'sequence': [ { 'path': '/protein/rmsd/backbone', 'module': 'rmsd.RMSD', 'kwargs': { 'selection': 'backbone' } },
+                      { 'path': '/channel/ragged', 'module': 'cylindersearch.CylinderSearch', 'args': ['resid 1 and name CA', 'resid 214 and name CA', 'resname ARG LYS'], 'kwargs': { 'radius': 8.0 }, 'array': 'ragged' } ],
+    }
+    filename = os.path.join(TMP, 'config.json')
+    with open(filename, 'w') as f:
+        json.dump(config, f)
+    assert cli.load_config(filename) == json.loads(json.dumps(config))
+    assert cli.main(['run', filename]) == 0
+    # the same results as the Analysis the config describes
+    trj, ref = universes()
+    plain = os.path.join(TMP, 'cli-plain.h5')
+    analysis = Analysis(plain, readonly=False)
+    analysis.add_metadata('/metadata/trajectory', { 'psf': PSF, 'dcd': DCD })
+    analysis.add_timeseries('/timeseries/com/protein', Timeseries.CenterOfMass(trj.selectAtoms('protein')))
+    analysis.add_to_sequence('/protein/rmsd/backbone', RMSD('backbone'))
+    analysis.add_to_sequence('/channel/ragged', CylinderSearch('resid 1 and name CA', 'resid 214 and name CA', 'resname ARG LYS', radius=8.0), array='ragged')
+    analysis.run(trj=trj, ref=ref, stop=50, step=2)
+    analysis.save()
+    analysis.close()
+    assert_same_results(stored(config['output']), stored(plain))
+    assert list(stored_frames(config['output'])[0]) == range(0, 50, 2)
+    # unknown and invalid keys are reported before anything runs
+    for key, value, reported in (('sequnce', [], 'sequnce'), ('workers', 0, 'workers'), ('frames', { 'stride': 2 }, 'stride'),
+                                 ('storage', { 'level': 9 }, 'level'),
+                                 ('sequence', [ { 'path': '/a/b', 'module': 'rmsd.RMSD', 'array': 'sparse' } ], 'sparse'),
+                                 ('sequence', [ { 'module': 'rmsd.RMSD' } ], 'path'),
+                                 ('timeseries', [ { 'path': '/a/b', 'type': 'CenterOfMass', 'selction': 'protein' } ], 'selction')):
+        invalid = dict(config, output=os.path.join(TMP, 'invalid.h5'))
+        invalid[key] = value
+        with open(filename, 'w') as f:
+            json.dump(invalid, f)
+        try:
+            cli.main(['run', filename])
+        except Exception, e:
+            assert reported in str(e), str(e)
+        else:
+            raise AssertionError('invalid %s accepted' % key)
+        assert not os.path.exists(invalid['output'])
+
+def reported_run(filename):
+    """ Runs two processors with a report and returns the last stored report """
+    import json
+    import tables
+    trj, ref = universes()
+    analysis = Analysis(filename, readonly=False)
+    analysis.add_to_sequence('/protein/rmsd/backbone', RMSD('backbone'))
+    analysis.add_to_sequence('/crash/frame', FrameNumber())
+    analysis.run(trj=trj, ref=ref, report_path='/batcha/reports')
+    analysis.save()
+    analysis.close()
+    h5f = tables.openFile(filename, mode='r')
+    try:
+        return json.loads(h5f.getNode('/batcha/reports')[-1])
+    finally:
+        h5f.close()
+
+def test_run_report():
+    from batcha import instrument
+    numframes = Universe(PSF, DCD, permissive=True).trajectory.numframes
+    report = reported_run(os.path.join(TMP, 'report.h5'))
+    profile = report['profile']
+    assert report['frames_decoded'] == numframes and profile['frames'] == numframes
+    assert sorted(profile['processors'].keys()) == ['/crash/frame', '/protein/rmsd/backbone']
+    for t in profile['processors'].values():
+        assert t['total_time'] >= 0 and numpy.allclose(t['time_per_frame'], t['total_time']/numframes)
+    assert profile['peak_memory_kb'] > 0
+    assert profile['bytes_read'] is None or profile['bytes_read'] >= 0
+    assert len(profile['bytes_written']) > 0 and profile['save_time'] >= 0
+    # without /proc/self/io the bytes read are not measured but estimated from the trajectory size
+    def unavailable(*args):
+        raise IOError('no such file')
+    instrument.open = unavailable
+    try:
+        assert instrument.bytes_read() is None
+        assert instrument.RunProfile().bytes_read is None
+        report = reported_run(os.path.join(TMP, 'report-noio.h5'))
+    finally:
+        del instrument.open
+    assert report['profile']['bytes_read'] is None
+    assert report['bytes_read_estimated'] and report['bytes_read'] > 0
+
+def test_batched_rmsd_matches_per_frame():
+    from MDAnalysis.core.rms_fitting import rms_rotation_matrix
+    from batcha.modules.rmsd import FrameData, batch_rotations, batch_rmsd
+    trj, ref = universes()
+    fit_ref = FrameData(ref.selectAtoms('backbone'))
+    fit = trj.selectAtoms('backbone')
+    block = numpy.array([ fit.coordinates() for ts in trj.trajectory ], dtype=numpy.float32)
+    com, R = batch_rotations(block, fit_ref.coordinates, fit_ref.masses)
+    for k in range(len(block)):
+        expected = rms_rotation_matrix((block[k] - com[k]).astype(numpy.float32), fit_ref.coordinates, fit_ref.masses)
+        assert numpy.allclose(R[k], expected, atol=1e-4), k
+    
+    # a mirror image of the reference: the unconstrained fit would be a reflection
+    mirrored = (fit_ref.coordinates*(-1.0, 1.0, 1.0))[numpy.newaxis].astype(numpy.float32)
+    com, R = batch_rotations(mirrored, fit_ref.coordinates, fit_ref.masses)
+    assert numpy.allclose(numpy.linalg.det(R[0]), 1.0, atol=1e-6)
+    expected = rms_rotation_matrix((mirrored[0] - com[0]).astype(numpy.float32), fit_ref.coordinates, fit_ref.masses)
+    assert numpy.allclose(R[0], expected, atol=1e-4)
+    fitted = numpy.dot(mirrored[0] - com[0], expected) + fit_ref.com
+    rmsd = numpy.sqrt(numpy.sum((fitted - (fit_ref.coordinates + fit_ref.com))**2)/len(fitted))
+    assert numpy.allclose(batch_rmsd(mirrored, fit_ref.coordinates + fit_ref.com, com, R, fit_ref.com)[0], rmsd, atol=1e-3)
+    
+    # the processor gives the same RMSDs with both engines
+    rmsds = []
+    for block_size in (None, 7):
+        trj, ref = universes()
+        p = RMSD('name CA', block_size=block_size)
+        p.prepare(ref=ref, trj=trj)
+        for ts in trj.trajectory:
+            p.process(ts)
+        rmsds.append(numpy.array(p.results()))
+    assert numpy.allclose(rmsds[0], rmsds[1], atol=1e-3)
+
+def test_residue_rmsd_table():
+    from batcha.modules.rmsd_all_residues import RMSD as ResidueRMSD
+    trj, ref = universes()
+    filename = os.path.join(TMP, 'residues.h5')
+    analysis = Analysis(filename, readonly=False)
+    analysis.add_to_sequence('/protein/residues/rmsd', ResidueRMSD())
     analysis.run(trj=trj, ref=ref)
     analysis.save()
     analysis.close()
+    results = Analysis.open_results(filename)
+    try:
+        view = results['/protein/residues']['rmsd']
+        labels = view.labels()
+        # a dense frames x (backbone + residues) table column
+        assert labels[0] == 'backbone' and len(labels) == 215
+        assert view[:].shape == (trj.trajectory.numframes, len(labels))
+    finally:
+        results.close()
+
+def test_frame_timeseries_match_collection():
+    from MDAnalysis import collection
+    from batcha.timeseries import frame_timeseries
+    trj, ref = universes()
+    sel = trj.selectAtoms
+    atoms = [ sel('resid 10 and name %s' % name) for name in ('N', 'CA', 'C') ] + [ sel('resid 11 and name N') ]
+    cases = [
+        Timeseries.CenterOfMass(sel('resid 1:20')),
+        Timeseries.CenterOfGeometry(sel('resid 1:20')),
+        Timeseries.Atom('x', atoms[1]),
+        Timeseries.Atom('y', atoms[1]),
+        Timeseries.Atom('z', atoms[1]),
+        Timeseries.Atom('v', atoms[1]),
+        Timeseries.Bond(atoms[0] + atoms[1]),
+        Timeseries.Distance('r', atoms[0] + atoms[3]),
+        Timeseries.Angle(atoms[0] + atoms[1] + atoms[2]),
+        # psi of residue 10 and a dihedral of the opposite sign
+        Timeseries.Dihedral(atoms[0] + atoms[1] + atoms[2] + atoms[3]),
+        Timeseries.Dihedral(atoms[3] + atoms[2] + atoms[1] + atoms[0]),
+    ]
+    collection.clear()
+    for t in cases:
+        collection.addTimeseries(t)
+    collection.compute(trj.trajectory)
+    for i, t in enumerate(cases):
+        p = frame_timeseries(t)
+        assert p is not None, t
+        p.prepare(ref=ref, trj=trj)
+        for ts in trj.trajectory:
+            p.process(ts)
+        # same units (radians for angles) and signs as the collection
+        assert numpy.allclose(p.results(), collection[i][0], atol=1e-4), (t.__class__.__name__, getattr(t, 'code', None))
+
+def test_node_storage():
+    import tables
+    from batcha import Storage
+    from batcha.datastore import Table, write_block
+    own = Storage(complevel=9)
+    analysis = Analysis(os.path.join(TMP, 'storage.h5'), readonly=False, storage=Storage(complevel=1))
+    analysis.add_to_sequence('/frames_seen/a', FrameNumber(), storage=own)
+    # a column without its own storage keeps the storage of its table
+    analysis.add_to_sequence('/frames_seen/b', FrameNumber())
+    assert analysis._nodes['/frames_seen'].storage is own
+    analysis.close()
+    
+    # blocks sent to the batch writer keep the expected rows of their node
+    h5f = tables.openFile(os.path.join(TMP, 'blocks.h5'), mode='w')
+    try:
+        sized = Table(h5f, '/sized', Storage(complevel=1))
+        sized.expected_rows = 10000000
+        sized.column('value', tables.Float32Col()).load(range(10))
+        nodes = {}
+        write_block(h5f, nodes, sized.drain_block(), root='/trajectory')
+        assert nodes['/trajectory/sized'].expected_rows == 10000000
+        direct = Table(h5f, '/direct', Storage(complevel=1))
+        direct.expected_rows = 10000000
+        direct.column('value', tables.Float32Col()).load(range(10))
+        direct.write()
+        assert h5f.getNode('/trajectory/sized/value').chunkshape == h5f.getNode('/direct/value').chunkshape
+        # without a Storage the chunks still follow the frames of the run
+        legacy = Table(h5f, '/legacy')
+        legacy.expected_rows = 10000000
+        legacy.column('value', tables.Float32Col()).load(range(10))
+        legacy.write()
+        large = h5f.createEArray('/', 'large', tables.Float32Atom(), (0,), expectedrows=10000000)
+        small = h5f.createEArray('/', 'small', tables.Float32Atom(), (0,), expectedrows=25000)
+        assert h5f.getNode('/legacy/value').chunkshape == large.chunkshape != small.chunkshape
+    finally:
+        h5f.close()
 
-test_run()
+if __name__ == '__main__':
+    setup_module()
+    try:
+        for name, test in sorted(globals().items()):
+            if name.startswith('test_') and callable(test):
+                test()
+    finally:
+        teardown_module()